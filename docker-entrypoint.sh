@@ -0,0 +1,10 @@
+#!/bin/sh
+set -e
+
+# metrics files of earlier runs would otherwise be merged into /metrics
+if [ -n "$PROMETHEUS_MULTIPROC_DIR" ]; then
+    mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+    rm -f "$PROMETHEUS_MULTIPROC_DIR"/*.db
+fi
+
+exec "$@"
@@ -1,12 +1,31 @@
+import math
 import logging
 
+from rest_framework import status
+from rest_framework.exceptions import APIException
 from rest_framework.views import exception_handler
+from backend.utils import CircuitOpenError
 
 
 logger = logging.getLogger(__name__)
 
 
+class IndexerUnavailable(APIException):
+  status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+  default_detail = "indexer_unavailable"
+  default_code = "indexer_unavailable"
+
+  def __init__(self, wait=None):
+    super().__init__()
+    self.wait = wait
+
+
 def custom_exception_handler(exc, context):
+  if isinstance(exc, CircuitOpenError):
+    # the indexer is known to be down, clients should come back once the
+    # circuit lets the next trial call through
+    exc = IndexerUnavailable(wait=max(1, math.ceil(exc.retry_after)))
+
   response = exception_handler(exc, context)
   logger.exception(exc)
 
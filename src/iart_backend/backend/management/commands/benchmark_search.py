@@ -0,0 +1,335 @@
+import sys
+import json
+import time
+import uuid
+import random
+import threading
+import statistics
+
+from concurrent import futures
+
+import grpc
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import Client, override_settings
+from backend.utils import IndexerPool, search_cache, entry_cache, query_image_cache, version_cache
+from backend.views.utils import RPCView
+from backend.views.search import Search
+
+if settings.INDEXER_PATH is not None:
+    sys.path.append(settings.INDEXER_PATH)
+
+from iart_indexer import indexer_pb2, indexer_pb2_grpc
+
+
+def fill_message(message, rng, *, list_size, vector_dim, field_sizes=None, depth=0):
+    """
+    Fills every field of a proto message with random values, using only its
+    descriptor. Repeated numbers get vector_dim values, repeated messages
+    list_size entries and one field of every oneof is set.
+    """
+
+    field_sizes = field_sizes if field_sizes is not None else {}
+    skipped = set()
+
+    for oneof in message.DESCRIPTOR.oneofs:
+        chosen = rng.choice(oneof.fields)
+        skipped.update(x.name for x in oneof.fields if x is not chosen)
+
+    for field in message.DESCRIPTOR.fields:
+        if field.name in skipped:
+            continue
+
+        if field.message_type is not None:
+            if field.message_type.GetOptions().map_entry or depth >= 3:
+                continue
+
+            if is_repeated(field):
+                for _ in range(field_sizes.get(field.name, list_size)):
+                    fill_message(
+                        getattr(message, field.name).add(),
+                        rng,
+                        list_size=list_size,
+                        vector_dim=vector_dim,
+                        field_sizes=field_sizes,
+                        depth=depth + 1,
+                    )
+            else:
+                fill_message(
+                    getattr(message, field.name),
+                    rng,
+                    list_size=list_size,
+                    vector_dim=vector_dim,
+                    field_sizes=field_sizes,
+                    depth=depth + 1,
+                )
+
+            continue
+
+        if is_repeated(field):
+            getattr(message, field.name).extend(
+                random_value(field, rng) for _ in range(field_sizes.get(field.name, vector_dim))
+            )
+        else:
+            setattr(message, field.name, random_value(field, rng))
+
+    return message
+
+
+def is_repeated(field):
+    # FieldDescriptor.label is gone in recent protobuf releases
+    if hasattr(field, "is_repeated"):
+        return field.is_repeated
+
+    return field.label == field.LABEL_REPEATED
+
+
+def random_value(field, rng):
+    if field.type in (field.TYPE_DOUBLE, field.TYPE_FLOAT):
+        return rng.random()
+
+    if field.type == field.TYPE_BOOL:
+        return rng.random() < 0.5
+
+    if field.type == field.TYPE_STRING:
+        return f"{field.name}_{rng.randrange(1000)}"
+
+    if field.type == field.TYPE_BYTES:
+        return b""
+
+    if field.type == field.TYPE_ENUM:
+        return rng.choice(field.enum_type.values).number
+
+    return rng.randrange(100)
+
+
+class FakeIndexer(indexer_pb2_grpc.IndexerServicer):
+    """
+    Stand-in for the indexer that answers search, list_search_result and get
+    with synthetic entries. The replies are built once per result size, so
+    the benchmark measures the backend and not the fake.
+    """
+
+    # coordinates are 2d, everything else gets the configured sizes
+    FIELD_SIZES = {"coordinates": 2}
+
+    def __init__(self, *, vector_dim, list_size, seed=0):
+        self.vector_dim = vector_dim
+        self.list_size = list_size
+        self.rng = random.Random(seed)
+        self.entries = 0
+        self.replies = {}
+
+    def fill(self, message):
+        return fill_message(
+            message,
+            self.rng,
+            list_size=self.list_size,
+            vector_dim=self.vector_dim,
+            field_sizes=self.FIELD_SIZES,
+        )
+
+    def search_reply(self, entries):
+        if entries not in self.replies:
+            reply = indexer_pb2.ListSearchResultReply()
+
+            for i in range(entries):
+                entry = self.fill(reply.entries.add())
+                entry.id = uuid.UUID(int=i).hex
+
+            self.replies[entries] = reply
+
+        return self.replies[entries]
+
+    def search(self, request, context):
+        return indexer_pb2.SearchReply(id=uuid.uuid4().hex)
+
+    def list_search_result(self, request, context):
+        return self.search_reply(self.entries)
+
+    def get(self, request, context):
+        reply = self.fill(indexer_pb2.GetReply())
+        reply.id = request.id
+
+        return reply
+
+
+def percentile(values, p):
+    values = sorted(values)
+
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class Command(BaseCommand):
+    help = "Benchmarks the search and get views against a local fake indexer"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--entries", type=int, nargs="+", default=[100, 1000])
+        parser.add_argument("--requests", type=int, default=50)
+        parser.add_argument("--concurrency", type=int, default=1)
+        parser.add_argument("--vector_dim", type=int, default=512)
+        parser.add_argument("--list_size", type=int, default=3)
+        parser.add_argument("--port", type=int, default=0)
+        parser.add_argument("--json", action="store_true")
+
+    def handle(self, *args, **options):
+        servicer = FakeIndexer(vector_dim=options["vector_dim"], list_size=options["list_size"])
+
+        server = grpc.server(futures.ThreadPoolExecutor(max_workers=max(4, 2 * options["concurrency"])))
+        indexer_pb2_grpc.add_IndexerServicer_to_server(servicer, server)
+        port = server.add_insecure_port(f"localhost:{options['port']}")
+        server.start()
+
+        views = [RPCView]
+
+        if settings.ASYNC_VIEWS:
+            from backend.views.aio import AsyncRPCView
+
+            views.append(AsyncRPCView)
+
+        indexer = RPCView.indexer
+        self.local = threading.local()
+
+        for view in views:
+            view.indexer = IndexerPool([f"localhost:{port}"], probe_interval=None)
+
+        # benchmark searches must neither be logged, and later warmed against
+        # the real indexer, nor fill the shared cache
+        isolated = override_settings(
+            QUERY_LOG=False,
+            CACHES={
+                "default": {
+                    "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                    "LOCATION": "benchmark_search",
+                }
+            },
+        )
+
+        try:
+            with isolated:
+                version_cache.clear()
+                results = self.run_benchmarks(servicer, options)
+        finally:
+            for view in views:
+                view.indexer = indexer
+
+            for x in (search_cache, entry_cache, query_image_cache):
+                x.local.clear()
+
+            # versions of the benchmark cache must not outlive it
+            version_cache.clear()
+
+            server.stop(None)
+
+        if options["json"]:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+
+        self.stdout.write(f"{'scenario':<16}{'entries':>9}{'requests':>10}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+
+        for x in results:
+            self.stdout.write(
+                f"{x['scenario']:<16}{x['entries']:>9}{x['requests']:>10}"
+                f"{x['throughput']:>10.1f}{x['p50_ms']:>10.2f}{x['p99_ms']:>10.2f}"
+            )
+
+    def run_benchmarks(self, servicer, options):
+        results = []
+
+        for entries in options["entries"]:
+            servicer.entries = entries
+            query = f"benchmark {uuid.uuid4().hex}"
+
+            # the conversion of the indexer reply on its own
+            reply = servicer.search_reply(entries)
+            results.append(self.measure("convert", entries, options, lambda i: Search().result_from_proto(reply)))
+
+            # every request is a different query and misses all caches
+            results.append(
+                self.measure("search_cold", entries, options, lambda i: self.search(f"benchmark {uuid.uuid4().hex}"))
+            )
+
+            # first request fills the cache, the rest are served from it
+            self.search(query)
+            results.append(self.measure("search_warm", entries, options, lambda i: self.search(query)))
+
+            # served from the shared cache, the process local cache is dropped
+            def search_remote(i):
+                search_cache.local.clear()
+                return self.search(query)
+
+            results.append(self.measure("search_remote", entries, options, search_remote))
+
+        entries = 1
+        hash_id = uuid.uuid4().hex
+        self.get(hash_id)
+
+        results.append(self.measure("get_cold", entries, options, lambda i: self.get(uuid.uuid4().hex)))
+        results.append(self.measure("get_warm", entries, options, lambda i: self.get(hash_id)))
+
+        def get_remote(i):
+            entry_cache.local.clear()
+            return self.get(hash_id)
+
+        results.append(self.measure("get_remote", entries, options, get_remote))
+
+        return results
+
+    @property
+    def client(self):
+        # test clients are not thread safe, each thread gets its own
+        client = getattr(self.local, "client", None)
+
+        if client is None:
+            client = self.local.client = Client(SERVER_NAME="localhost")
+
+        return client
+
+    def search(self, query):
+        response = self.client.post(
+            "/search",
+            {"params": {"query": [{"type": "txt", "positive": True, "value": query}], "wait": True}},
+            content_type="application/json",
+        )
+
+        if response.status_code != 200 or "entries" not in response.json():
+            raise RuntimeError(f"search failed with {response.status_code}: {response.content[:200]}")
+
+        return response
+
+    def get(self, hash_id):
+        response = self.client.post(
+            "/get",
+            {"params": {"id": hash_id}},
+            content_type="application/json",
+        )
+
+        if response.status_code != 200:
+            raise RuntimeError(f"get failed with {response.status_code}: {response.content[:200]}")
+
+        return response
+
+    def measure(self, scenario, entries, options, fn):
+        latencies = []
+
+        def run(i):
+            start = time.perf_counter()
+            fn(i)
+            latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+
+        with futures.ThreadPoolExecutor(max_workers=options["concurrency"]) as executor:
+            list(executor.map(run, range(options["requests"])))
+
+        duration = time.perf_counter() - start
+
+        return {
+            "scenario": scenario,
+            "entries": entries,
+            "requests": options["requests"],
+            "throughput": options["requests"] / duration,
+            "p50_ms": statistics.median(latencies) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+        }
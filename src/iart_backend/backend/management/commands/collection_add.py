@@ -1,5 +1,4 @@
 import json
-import grpc
 import sys
 import os
 import uuid
@@ -7,11 +6,12 @@ from django.core.management.base import BaseCommand, CommandError
 from django.contrib import auth
 from django.conf import settings
 from backend.models import Collection, Image
+from backend.utils import invalidate_entries, invalidate_collection, indexer_pool
 
 if settings.INDEXER_PATH is not None:
     sys.path.append(settings.INDEXER_PATH)
 
-from iart_indexer import indexer_pb2, indexer_pb2_grpc
+from iart_indexer import indexer_pb2
 
 
 class Command(BaseCommand):
@@ -57,16 +57,6 @@ class Command(BaseCommand):
         )
         collection_db.save()
         try:
-        
-            channel = grpc.insecure_channel(
-                f"{settings.GRPC_HOST}:{settings.GRPC_PORT}",
-                options=[
-                    ("grpc.max_send_message_length", 50 * 1024 * 1024),
-                    ("grpc.max_receive_message_length", 50 * 1024 * 1024),
-                ],
-            )
-
-            stub = indexer_pb2_grpc.IndexerStub(channel)
             def entry_generator(entries, collection_id, collection_name, visibility):
                 for i, entry in enumerate(entries):
                     print(i,entry["id"], flush=True)
@@ -136,6 +126,7 @@ class Command(BaseCommand):
                         hash_id=entry["id"],
                     )
                     image_db.save()
+                    collection_db.image_count += 1
                     yield request
 
             gen_iter = entry_generator(
@@ -148,11 +139,15 @@ class Command(BaseCommand):
 
             # print(next(gen_iter))
             # return
-            for i, entry in enumerate(stub.indexing(gen_iter)):
-                count += 1
+            with indexer_pool.endpoint() as endpoint:
+                for i, entry in enumerate(endpoint.stub.indexing(gen_iter)):
+                    count += 1
 
-                collection_db.progress = count / len(entries)
-                collection_db.save()
+                    collection_db.progress = count / len(entries)
+                    collection_db.save()
+
+            invalidate_entries([x["id"] for x in entries])
+            invalidate_collection(collection_db.hash_id)
 
             collection_db.progress = 1.0
             if count > 0:
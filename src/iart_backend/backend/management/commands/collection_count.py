@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+from backend.models import Collection
+
+
+class Command(BaseCommand):
+    help = "Recomputes the stored image count of all collections"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--collection_id", type=str)
+
+    def handle(self, *args, **options):
+        collections = Collection.objects.all()
+
+        if options["collection_id"] is not None:
+            collections = collections.filter(hash_id=options["collection_id"])
+
+        updated = 0
+
+        for collection in collections.annotate(count=Count("image")):
+            if collection.image_count != collection.count:
+                Collection.objects.filter(pk=collection.pk).update(image_count=collection.count)
+                updated += 1
+
+        self.stdout.write(self.style.SUCCESS(f"Updated image count of {updated} collections"))
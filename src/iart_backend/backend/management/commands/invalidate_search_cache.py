@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from backend.utils import invalidate_collection
+
+
+class Command(BaseCommand):
+    help = "Invalidates cached searches of collections, e.g. after the default index was changed in the indexer"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--collection_id", type=str, nargs="+", default=[])
+        parser.add_argument("--default", action="store_true", help="invalidate searches of the default index")
+
+    def handle(self, *args, **options):
+        hash_ids = list(options["collection_id"])
+
+        if options["default"]:
+            hash_ids.append(None)
+
+        for hash_id in hash_ids:
+            invalidate_collection(hash_id)
+
+        self.stdout.write(self.style.SUCCESS(f"Invalidated searches of {len(hash_ids)} collections"))
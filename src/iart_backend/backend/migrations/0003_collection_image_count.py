@@ -0,0 +1,18 @@
+# Generated by Django 4.1.6 on 2026-10-18 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0002_alter_customuser_options_customuser_is_oidc_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='collection',
+            name='image_count',
+            field=models.IntegerField(default=0),
+        ),
+    ]
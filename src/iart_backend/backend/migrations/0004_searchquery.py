@@ -0,0 +1,25 @@
+# Generated by Django 4.1.6 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backend', '0003_collection_image_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchQuery',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('request_hash', models.CharField(db_index=True, max_length=256)),
+                ('fields', models.CharField(max_length=256)),
+                ('request', models.BinaryField(blank=True, null=True)),
+                ('latency', models.FloatField()),
+                ('cache', models.CharField(max_length=8)),
+            ],
+        ),
+    ]
@@ -17,6 +17,15 @@ class Collection(models.Model):
     status = models.CharField(max_length=2, choices=[("U", "Upload"), ("R", "Ready"), ("E", "Error")], default="U")
     progress = models.FloatField(default=0.0)
     date = models.DateTimeField(auto_now_add=True)
+    image_count = models.IntegerField(default=0)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # remember the stored visibility so that signals can detect changes
+        instance._loaded_visibility = instance.__dict__.get("visibility")
+
+        return instance
 
 
 class Image(models.Model):
@@ -42,6 +51,16 @@ class ImageUserRelation(models.Model):
         return f"{self.user} {self.image.hash_id} {self.library}"
 
 
+class SearchQuery(models.Model):
+    # canonical search request, empty if it was too large to be kept
+    date = models.DateTimeField(auto_now_add=True, db_index=True)
+    request_hash = models.CharField(max_length=256, db_index=True)
+    fields = models.CharField(max_length=256)
+    request = models.BinaryField(blank=True, null=True)
+    latency = models.FloatField()
+    cache = models.CharField(max_length=8)
+
+
 class ImageUserTag(models.Model):
     name = models.CharField(max_length=256)
     ImageUserRelation = models.ForeignKey(ImageUserRelation, on_delete=models.CASCADE)
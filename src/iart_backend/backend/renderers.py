@@ -0,0 +1,129 @@
+import gzip
+
+import msgpack
+import orjson
+
+from django.http import HttpResponse
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+JSON_MEDIA_TYPE = "application/json"
+
+
+class PackedResult(bytes):
+    """
+    Result that is already msgpack encoded, e.g. read from the search cache.
+    The msgpack renderer sends it as it is.
+    """
+
+
+class EncodedBody(bytes):
+    """
+    Rendered json response compressed with the given content encoding.
+    """
+
+    def __new__(cls, data, encoding):
+        body = super().__new__(cls, data)
+        body.encoding = encoding
+
+        return body
+
+
+def default(obj):
+    # lazy translations, decimals and everything else orjson does not know
+    return JSONEncoder().default(obj)
+
+
+def dumps_json(data):
+    return orjson.dumps(data, default=default, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+
+
+def dumps_msgpack(data):
+    if isinstance(data, PackedResult):
+        return bytes(data)
+
+    return msgpack.packb(data, default=default)
+
+
+def compress_body(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=5)
+
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=6)
+
+    raise ValueError(f"Unknown encoding {encoding}")
+
+
+def body_encodings(encodings):
+    return [x for x in encodings if x == "gzip" or (x == "br" and brotli is not None)]
+
+
+def preferred_encoding(request, encodings):
+    """
+    Returns the first of the given encodings the client accepts, or None.
+    """
+
+    accepted = set()
+    refused = set()
+
+    for value in request.headers.get("Accept-Encoding", "").split(","):
+        name, _, params = value.strip().partition(";")
+        name = name.strip().lower()
+        params = params.replace(" ", "")
+
+        if params.startswith("q=") and params[2:] in ("0", "0.0", "0.00", "0.000"):
+            refused.add(name)
+        else:
+            accepted.add(name)
+
+    for encoding in encodings:
+        # an explicit q=0 also holds against a wildcard
+        if encoding in refused:
+            continue
+
+        if encoding in accepted or "*" in accepted:
+            return encoding
+
+    return None
+
+
+def encoded_response(body, **kwargs):
+    response = HttpResponse(bytes(body), content_type=JSON_MEDIA_TYPE, **kwargs)
+    response["Content-Encoding"] = body.encoding
+    response["Vary"] = "Accept, Accept-Encoding"
+
+    return response
+
+
+def accepts_msgpack(request):
+    # json stays the default for clients that accept anything
+    return request.get_preferred_type([JSON_MEDIA_TYPE, MSGPACK_MEDIA_TYPE]) == MSGPACK_MEDIA_TYPE
+
+
+class ORJSONRenderer(JSONRenderer):
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+
+        return dumps_json(data)
+
+
+class MsgpackRenderer(BaseRenderer):
+    media_type = MSGPACK_MEDIA_TYPE
+    format = "msgpack"
+    charset = None
+    render_style = "binary"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+
+        return dumps_msgpack(data)
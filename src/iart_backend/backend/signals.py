@@ -0,0 +1,17 @@
+from django.dispatch import receiver
+from django.db.models.signals import post_save, post_delete
+from backend.models import Collection
+from backend.utils import invalidate_collection_access
+
+
+@receiver(post_save, sender=Collection)
+def collection_saved(sender, instance, created, **kwargs):
+    if created or getattr(instance, "_loaded_visibility", instance.visibility) != instance.visibility:
+        invalidate_collection_access()
+
+    instance._loaded_visibility = instance.visibility
+
+
+@receiver(post_delete, sender=Collection)
+def collection_deleted(sender, instance, **kwargs):
+    invalidate_collection_access()
@@ -1,18 +1,32 @@
 import os
 import sys
-import grpc
 import uuid
 import imageio
 import logging
 
+from datetime import timedelta
+
 from celery import shared_task
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.exceptions import BadRequest
-from backend.models import Collection, Image, UploadedImage
-from backend.utils import TarArchive, ZipArchive, check_extension
-
-from iart_indexer import indexer_pb2, indexer_pb2_grpc
+from django.db.models import Count, Max
+from django.utils import timezone
+from backend.models import Collection, Image, UploadedImage, SearchQuery
+from backend.renderers import dumps_json, compress_body, body_encodings
+from backend.utils import (
+    TarArchive,
+    ZipArchive,
+    check_extension,
+    invalidate_entries,
+    invalidate_collection,
+    indexer_pool,
+    search_cache,
+    timed,
+    stage,
+)
+
+from iart_indexer import indexer_pb2
 from iart_indexer.utils import image_resize
 
 if settings.INDEXER_PATH is not None:
@@ -22,6 +36,7 @@ logger = logging.getLogger(__name__)
 
 
 @shared_task(bind=True)
+@timed("collection_upload")
 def collection_upload(self, args):
     user_id = args.get("user_id")
     collection_name = args.get("collection_name")
@@ -50,16 +65,6 @@ def collection_upload(self, args):
 
     logger.info(f"Client: Start indexing {len(entries)} images")
 
-    channel = grpc.insecure_channel(
-        f"{settings.GRPC_HOST}:{settings.GRPC_PORT}",
-        options=[
-            ("grpc.max_send_message_length", 50 * 1024 * 1024),
-            ("grpc.max_receive_message_length", 50 * 1024 * 1024),
-        ],
-    )
-
-    stub = indexer_pb2_grpc.IndexerStub(channel)
-
     def entry_generator(entries, collection_id, collection_name, visibility):
         for entry in entries:
             request = indexer_pb2.IndexingRequest()
@@ -130,21 +135,27 @@ def collection_upload(self, args):
 
     with archive as ar:
         for entry in entries:
-            image = imageio.imread(archive.read(entry["path"]))
+            with stage("decode"):
+                image = imageio.imread(archive.read(entry["path"]))
+
             hash_value = uuid.uuid4().hex
             image_output_file = None
 
             for res in settings.IMAGE_RESOLUTIONS:
                 min_size = res.get("min_size", 200)
                 suffix = res.get("suffix", "")
-                new_image = image_resize(image, min_dim=min_size)
+
+                with stage("resize"):
+                    new_image = image_resize(image, min_dim=min_size)
 
                 image_output_dir = os.path.join(settings.UPLOAD_ROOT, hash_value[0:2], hash_value[2:4])
                 os.makedirs(image_output_dir, exist_ok=True)
                 image_output_file = os.path.join(image_output_dir, f"{hash_value}{suffix}.jpg")
 
                 logger.info(f"Client: Created image {image_output_file}")
-                imageio.imwrite(image_output_file, new_image)
+
+                with stage("write"):
+                    imageio.imwrite(image_output_file, new_image)
 
             if image_output_file is not None:
                 new_entries.append(
@@ -155,12 +166,16 @@ def collection_upload(self, args):
                     }
                 )
 
-                image_db = Image.objects.create(
-                    collection=collection,
-                    owner=user,
-                    hash_id=hash_value,
-                )
-                image_db.save()
+                with stage("db"):
+                    image_db = Image.objects.create(
+                        collection=collection,
+                        owner=user,
+                        hash_id=hash_value,
+                    )
+                    image_db.save()
+
+    collection.image_count = len(new_entries)
+    collection.save()
 
     if len(new_entries) == 0:
         collection.status = "E"
@@ -176,11 +191,15 @@ def collection_upload(self, args):
     )
     count = 0
 
-    for i, entry in enumerate(stub.indexing(gen_iter)):
-        count += 1
+    with stage("index"), indexer_pool.endpoint() as endpoint:
+        for i, entry in enumerate(endpoint.stub.indexing(gen_iter)):
+            count += 1
 
-        collection.progress = count / len(entries)
-        collection.save()
+            collection.progress = count / len(entries)
+            collection.save()
+
+    invalidate_entries([x["id"] for x in new_entries])
+    invalidate_collection(collection_id)
 
     if len(entries) == count:
         collection.status = "R"
@@ -199,3 +218,71 @@ def remove_upload_image(path: str, img_hash: str):
     logging.info(f'Removing uploaded image: {path}')
     UploadedImage.objects.delete(hash_id=img_hash)
     os.remove(path)
+
+
+@shared_task(ignore_result=True)
+@timed("warm_search_cache")
+def warm_search_cache():
+    # views import the tasks module, import them only when the task runs
+    from backend.views.search import Search
+
+    since = timezone.now() - timedelta(seconds=settings.SEARCH_WARM_WINDOW)
+    top = (
+        SearchQuery.objects.filter(date__gte=since, request__isnull=False)
+        .values("request_hash", "fields")
+        .annotate(count=Count("id"), last=Max("id"))
+        .order_by("-count")[: settings.SEARCH_WARM_TOP]
+    )
+    queries = SearchQuery.objects.in_bulk([x["last"] for x in top])
+
+    search = Search()
+    warmed = 0
+
+    for x in top:
+        query = queries[x["last"]]
+        fields = tuple(y for y in query.fields.split("+") if y)
+
+        try:
+            request = indexer_pb2.SearchRequest.FromString(bytes(query.request))
+            warmed += search.warm(request, fields, timeout=settings.SEARCH_WARM_TIMEOUT)
+        except Exception as e:
+            logger.error(f"warm_search_cache {query.request_hash} {e}")
+
+    logger.info(f"warm_search_cache: {warmed} of {len(top)} searches cached")
+
+
+@shared_task(ignore_result=True)
+@timed("cache_search_bodies")
+def cache_search_bodies(key: str):
+    encodings = body_encodings(settings.SEARCH_CACHE_BODY_ENCODINGS)
+    result = search_cache.get(key)
+
+    if not encodings or result is None:
+        return
+
+    with stage("render"):
+        body = dumps_json(result)
+
+    if len(body) > settings.SEARCH_CACHE_BODY_MAX_BYTES:
+        # empty bodies mark the result as too large, hits stop asking for them
+        search_cache.set_bodies(key, {x: b"" for x in encodings})
+        return
+
+    with stage("compress"):
+        search_cache.set_bodies(key, {x: compress_body(body, x) for x in encodings})
+
+
+@shared_task(ignore_result=True)
+def prune_query_log():
+    since = timezone.now() - timedelta(seconds=settings.QUERY_LOG_MAX_AGE)
+    SearchQuery.objects.filter(date__lt=since).delete()
+
+    # rows beyond the newest QUERY_LOG_MAX_ROWS are dropped as well
+    cutoff = (
+        SearchQuery.objects.order_by("-id")
+        .values_list("id", flat=True)[settings.QUERY_LOG_MAX_ROWS : settings.QUERY_LOG_MAX_ROWS + 1]
+        .first()
+    )
+
+    if cutoff is not None:
+        SearchQuery.objects.filter(id__lte=cutoff).delete()
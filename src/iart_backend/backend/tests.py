@@ -1,3 +1,1676 @@
-from django.test import TestCase
+import io
+import os
+import json
+import zlib
+import uuid
+import time
+import base64
+import tempfile
+import collections
 
-# Create your tests here.
+from unittest import mock, skipIf
+from concurrent import futures
+
+import grpc
+import imageio
+import msgpack
+import numpy as np
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.test import TestCase, RequestFactory, AsyncRequestFactory, override_settings
+from django.db import connection
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from rest_framework.test import APIClient
+from backend.models import Collection, Image, ImageUserRelation, SearchQuery
+from backend.utils import (
+    IndexerPool,
+    DeadlineClientInterceptor,
+    RetryOnRpcErrorClientInterceptor,
+    AdmissionController,
+    CircuitBreaker,
+    CircuitOpenError,
+    RetryBudget,
+    ResultCache,
+    search_cache,
+    entry_cache,
+    query_image_cache,
+    entry_cache_key,
+    invalidate_entries,
+    invalidate_collection_access,
+    upload_url_to_image,
+    query_log,
+    invalidate_collection,
+    collection_version_name,
+    cache_version,
+    version_cache,
+)
+from backend.utils.communication import replace_timeout
+from backend.views.utils import RPCView, DEFAULT_FIELDS, parse_fields
+from backend.views.search import Search
+from backend.views.metrics import metrics
+from backend.utils.metrics import registry
+from backend.tasks import warm_search_cache, cache_search_bodies
+from backend.renderers import brotli, compress_body, body_encodings, preferred_encoding
+from backend.views.aio import AsyncRPCView, AsyncSearch, AsyncGet, AsyncGetMany
+from backend.management.commands.benchmark_search import FakeIndexer
+from iart_indexer import indexer_pb2, indexer_pb2_grpc
+
+
+class RecordingIndexer(FakeIndexer):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.calls = collections.Counter()
+        self.search_delay = 0
+        # status code list_search_result fails with, e.g. a running job
+        self.result_status = None
+        self.delete_status = None
+
+    def search(self, request, context):
+        self.calls["search"] += 1
+        time.sleep(self.search_delay)
+        return super().search(request, context)
+
+    def list_search_result(self, request, context):
+        self.calls["list_search_result"] += 1
+
+        if self.result_status is not None:
+            context.abort(self.result_status, "no result")
+
+        return super().list_search_result(request, context)
+
+    def get(self, request, context):
+        self.calls["get"] += 1
+        return super().get(request, context)
+
+    def collection_delete(self, request, context):
+        self.calls["collection_delete"] += 1
+
+        if self.delete_status is not None:
+            context.abort(self.delete_status, "not deleted")
+
+        return indexer_pb2.CollectionDeleteReply()
+
+
+class FakeIndexerTestCase(TestCase):
+    """
+    Runs the views against the stand-in indexer of benchmark_search.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+
+        cls.servicer = RecordingIndexer(vector_dim=4, list_size=1)
+        cls.server = grpc.server(futures.ThreadPoolExecutor(max_workers=4))
+        indexer_pb2_grpc.add_IndexerServicer_to_server(cls.servicer, cls.server)
+        port = cls.server.add_insecure_port("localhost:0")
+        cls.server.start()
+
+        cls.indexer = RPCView.indexer
+        RPCView.indexer = AsyncRPCView.indexer = IndexerPool([f"localhost:{port}"], probe_interval=None)
+
+    @classmethod
+    def tearDownClass(cls):
+        RPCView.indexer = AsyncRPCView.indexer = cls.indexer
+        cls.server.stop(None)
+
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        search_cache.local.clear()
+        entry_cache.local.clear()
+        version_cache.clear()
+
+        self.servicer.calls.clear()
+        self.servicer.entries = 5
+        self.servicer.search_delay = 0
+        self.servicer.result_status = None
+        self.servicer.delete_status = None
+
+        query_log.entries.clear()
+
+    def search(self, client=None, query="cat", **params):
+        client = client if client is not None else APIClient()
+        params = {"query": [{"type": "txt", "positive": True, "value": query}], "wait": True, **params}
+
+        return client.post("/search", {"params": params}, format="json")
+
+
+class BookmarkQueryCountTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user("bookmark_user", password="bookmark_password")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def add_bookmarks(self, count):
+        hash_ids = []
+
+        for _ in range(count):
+            image = Image.objects.create(hash_id=uuid.uuid4().hex)
+            ImageUserRelation.objects.create(user=self.user, image=image, library=True)
+            hash_ids.append(image.hash_id)
+
+        return hash_ids
+
+    def count_list_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post("/list_bookmark", {"params": {}}, format="json")
+
+        self.assertEqual(response.status_code, 200)
+
+        return len(context.captured_queries), response.json()
+
+    def test_bookmark_list_constant_queries(self):
+        hash_ids = self.add_bookmarks(1)
+        queries_small, result = self.count_list_queries()
+        self.assertEqual([x["id"] for x in result], hash_ids)
+
+        hash_ids += self.add_bookmarks(20)
+        queries_large, result = self.count_list_queries()
+        self.assertEqual(sorted(x["id"] for x in result), sorted(hash_ids))
+
+        self.assertEqual(queries_small, queries_large)
+
+    def test_search_add_user_data_single_query(self):
+        from backend.views.search import Search
+
+        hash_ids = self.add_bookmarks(20)
+        result = {
+            "entries": [{"id": x} for x in hash_ids + ["not_bookmarked"]],
+            "aggregations": [],
+        }
+
+        with self.assertNumQueries(1):
+            result = Search().add_user_data(result, self.user)
+
+        bookmarked = {x["id"]: x["user"]["bookmarked"] for x in result["entries"]}
+        self.assertTrue(all(bookmarked[x] for x in hash_ids))
+        self.assertFalse(bookmarked["not_bookmarked"])
+
+
+class CollectionRemoveTest(FakeIndexerTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.owner = get_user_model().objects.create_user("collection_owner")
+        self.other = get_user_model().objects.create_user("collection_other")
+        self.collection = Collection.objects.create(user=self.owner, hash_id=uuid.uuid4().hex, name="owned")
+        Image.objects.create(hash_id=uuid.uuid4().hex, collection=self.collection)
+
+    def remove(self, user):
+        client = APIClient()
+        client.force_authenticate(user=user)
+
+        return client.post("/remove_collection", {"params": {"hash_id": self.collection.hash_id}}, format="json")
+
+    def test_other_user_cannot_remove(self):
+        response = self.remove(self.other)
+
+        self.assertEqual(response.status_code, 500)
+        self.assertTrue(Collection.objects.filter(id=self.collection.id).exists())
+        self.assertEqual(Image.objects.filter(collection=self.collection).count(), 1)
+        self.assertEqual(self.servicer.calls["collection_delete"], 0)
+
+    def test_owner_can_remove(self):
+        response = self.remove(self.owner)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(Collection.objects.filter(id=self.collection.id).exists())
+        self.assertEqual(self.servicer.calls["collection_delete"], 1)
+
+    def test_failed_indexer_delete_still_invalidates(self):
+        self.servicer.delete_status = grpc.StatusCode.INTERNAL
+        image_ids = list(Image.objects.filter(collection=self.collection).values_list("hash_id", flat=True))
+        version = cache_version(collection_version_name(self.collection.hash_id))
+
+        for x in image_ids:
+            entry_cache.set(entry_cache_key(x, DEFAULT_FIELDS), {"id": x})
+
+        with self.assertLogs("backend.views.collection", "ERROR"):
+            response = self.remove(self.owner)
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(self.servicer.calls["collection_delete"], 1)
+        self.assertFalse(Collection.objects.filter(id=self.collection.id).exists())
+        self.assertNotEqual(cache_version(collection_version_name(self.collection.hash_id)), version)
+        self.assertFalse(any(entry_cache.get(entry_cache_key(x, DEFAULT_FIELDS)) for x in image_ids))
+
+
+class ResultCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.cache = ResultCache(max_bytes=1024 * 1024)
+
+    def test_round_trip(self):
+        value = {"entries": [{"id": "a", "score": 0.5}], "aggregations": []}
+        self.cache.set("result", value)
+
+        self.assertEqual(self.cache.get("result"), value)
+        self.assertEqual(self.cache.get_packed("result"), msgpack.packb(value))
+
+        # served from the shared cache once the process local cache is gone
+        self.cache.local.clear()
+        self.assertEqual(self.cache.get("result"), value)
+        self.assertEqual(self.cache.get_many(["result", "missing"]), {"result": value})
+
+        stats = self.cache.stats()
+        self.assertEqual(stats["hits_local"], 3)
+        self.assertEqual(stats["hits_remote"], 1)
+        self.assertEqual(stats["misses"], 1)
+
+    def test_local_size_is_estimated_from_packed_size(self):
+        value = {"entries": [{"id": str(i)} for i in range(100)]}
+        self.cache.set("result", value)
+
+        self.assertEqual(self.cache.local.bytes, len(msgpack.packb(value)) * (ResultCache.OBJECT_FACTOR + 1))
+
+    def test_local_hits_are_not_unpacked(self):
+        value = {"entries": [{"id": str(i)} for i in range(100)]}
+        self.cache.set("result", value)
+        self.cache.local.clear()
+
+        # a remote hit through get_packed is unpacked once, on the first get
+        packed = self.cache.get_packed("result")
+
+        with mock.patch("backend.utils.cache.msgpack.unpackb", wraps=msgpack.unpackb) as unpackb:
+            first = self.cache.get("result")
+            self.assertIs(self.cache.get("result"), first)
+            self.assertIs(self.cache.get_many(["result"])["result"], first)
+            self.assertIs(self.cache.get_packed("result"), packed)
+
+        self.assertEqual(unpackb.call_count, 1)
+        self.assertEqual(first, value)
+
+    def test_codec_fallback(self):
+        value = {"id": "a"}
+        packed = msgpack.packb(value)
+
+        # entries stored uncompressed or before compression was introduced
+        cache.set("plain", ResultCache.CODEC_NONE + packed)
+        cache.set("legacy", packed)
+        cache.set("zlib", ResultCache.CODEC_ZLIB + zlib.compress(packed))
+
+        for key in ("plain", "legacy", "zlib"):
+            self.assertEqual(self.cache.get(key), value)
+
+        cache.set("broken", ResultCache.CODEC_ZLIB + b"not zlib")
+        self.assertIsNone(self.cache.get("broken"))
+
+    def test_cache_errors_are_misses(self):
+        with mock.patch("backend.utils.cache.cache.get", side_effect=ConnectionError):
+            self.assertIsNone(self.cache.get("result"))
+
+        with mock.patch("backend.utils.cache.cache.get_many", side_effect=ConnectionError):
+            self.assertEqual(self.cache.get_many(["result"]), {})
+
+        self.assertEqual(self.cache.stats()["misses"], 2)
+
+
+class SearchRequestKeyTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def canonical_request(self, params):
+        search = Search()
+
+        return search.canonicalize_search_request(search.parse_search_request(params))
+
+    def key(self, params):
+        return Search().search_request_key(self.canonical_request(params))
+
+    def text_query(self, *values):
+        return [{"type": "txt", "positive": True, "value": x} for x in values]
+
+    def test_order_does_not_change_key(self):
+        self.assertEqual(
+            self.key({"query": self.text_query("cat", "dog"), "filters": {"meta.artist_name": ["a", "b"]}}),
+            self.key({"query": self.text_query("dog", "cat"), "filters": {"meta.artist_name": ["b", "a"]}}),
+        )
+        self.assertEqual(
+            self.key({"query": self.text_query("cat"), "aggregate": ["meta.title", "meta.location"]}),
+            self.key({"query": self.text_query("cat"), "aggregate": ["meta.location", "meta.title"]}),
+        )
+
+    def test_different_requests_have_different_keys(self):
+        self.assertNotEqual(self.key({"query": self.text_query("cat")}), self.key({"query": self.text_query("dog")}))
+        self.assertNotEqual(
+            self.key({"query": self.text_query("cat")}),
+            self.key({"query": self.text_query("cat"), "aggregate": ["meta.title"]}),
+        )
+
+    def test_canonicalization_adds_no_empty_aggregate(self):
+        request = self.canonical_request({"query": self.text_query("cat")})
+
+        self.assertFalse(request.HasField("aggregate"))
+
+        raw_request = Search().parse_search_request({"query": self.text_query("cat")})
+        self.assertEqual(
+            request.SerializeToString(deterministic=True),
+            raw_request.SerializeToString(deterministic=True),
+        )
+
+
+class CollectionVersionKeyTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        version_cache.clear()
+
+    def key(self, collection_ids=None, filtered=None):
+        params = {"query": [{"type": "txt", "positive": True, "value": "cat"}]}
+
+        if filtered is not None:
+            # only the filtered collection, without the default index
+            params["filters"] = {"collection": [{"hash_id": filtered}]}
+
+        search = Search()
+        request = search.parse_search_request(params, collection_ids=collection_ids)
+
+        return search.search_request_key(search.canonicalize_search_request(request))
+
+    def keys(self):
+        return {
+            "default": self.key(),
+            "a": self.key(filtered="a"),
+            "b": self.key(filtered="b"),
+            "default+a": self.key(collection_ids=["a"]),
+        }
+
+    def test_collection_change_moves_keys_that_include_it(self):
+        before = self.keys()
+
+        self.assertEqual(len(set(before.values())), 4)
+        self.assertEqual(self.keys(), before)
+
+        invalidate_collection("a")
+        after = self.keys()
+
+        self.assertEqual([x for x in before if before[x] != after[x]], ["a", "default+a"])
+
+    def test_default_index_change(self):
+        before = self.keys()
+        invalidate_collection()
+        after = self.keys()
+
+        self.assertEqual([x for x in before if before[x] != after[x]], ["default", "default+a"])
+
+    def test_lost_counter_does_not_reuse_a_key(self):
+        invalidate_collection("a")
+        invalidate_collection("a")
+        before = self.key(filtered="a")
+
+        # the counter is lost and the local copy expired
+        cache.delete(f"version:{collection_version_name('a')}")
+        version_cache.clear()
+
+        with mock.patch("backend.utils.cache.time.time_ns", return_value=time.time_ns() + 1000):
+            self.assertNotEqual(self.key(filtered="a"), before)
+
+    def test_versions_are_kept_per_process(self):
+        before = self.key(filtered="a")
+
+        with mock.patch.object(cache, "get_many", wraps=cache.get_many) as get_many:
+            self.assertEqual(self.key(filtered="a"), before)
+            get_many.assert_not_called()
+
+        # a bump of another process is seen once the local copy expired
+        cache.incr(f"version:{collection_version_name('a')}")
+        self.assertEqual(self.key(filtered="a"), before)
+
+        expired = time.monotonic() + settings.CACHE_VERSION_LOCAL_TIMEOUT + 1
+
+        with mock.patch("backend.utils.cache.time.monotonic", return_value=expired):
+            self.assertNotEqual(self.key(filtered="a"), before)
+
+
+class LongPollTest(FakeIndexerTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.servicer.result_status = grpc.StatusCode.FAILED_PRECONDITION
+        self.now = 100.0
+        self.sleeps = []
+
+        def sleep(seconds):
+            self.sleeps.append(seconds)
+            self.now += seconds
+
+        for patcher in (
+            mock.patch("backend.views.search.time.monotonic", lambda: self.now),
+            mock.patch("backend.views.utils.time.sleep", sleep),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    @override_settings(SEARCH_WAIT_MIN_INTERVAL=0.05, SEARCH_WAIT_MAX_INTERVAL=1.0)
+    def test_pending_job_returns_job_id_after_timeout(self):
+        result = Search().wait_for_result("job", timeout=3)
+
+        self.assertEqual(result, {"job_id": "job"})
+        np.testing.assert_allclose(self.sleeps, [0.05, 0.1, 0.2, 0.4, 0.8, 1.0, 0.45])
+        self.assertEqual(self.servicer.calls["list_search_result"], len(self.sleeps) + 1)
+
+    @override_settings(SEARCH_SYNC_WAIT_TIMEOUT=1)
+    def test_search_view_answers_with_job_id(self):
+        result = self.search().json()
+
+        self.assertEqual(set(result), {"job_id"})
+        self.assertAlmostEqual(sum(self.sleeps), 1)
+
+        # the client polls again with the job id
+        self.servicer.result_status = None
+        result = self.search(job_id=result["job_id"]).json()
+
+        self.assertEqual(len(result["entries"]), 5)
+
+
+class SearchPaginationTest(FakeIndexerTestCase):
+    def test_pages_share_one_search(self):
+        result = self.search().json()
+        ids = [x["id"] for x in result["entries"]]
+
+        self.assertEqual(len(ids), 5)
+        self.assertEqual((result["offset"], result["limit"], result["total"]), (0, None, 5))
+
+        result = self.search(offset=1, limit=2).json()
+
+        self.assertEqual([x["id"] for x in result["entries"]], ids[1:3])
+        self.assertEqual((result["offset"], result["limit"], result["total"]), (1, 2, 5))
+
+        result = self.search(offset=4, limit=10).json()
+        self.assertEqual([x["id"] for x in result["entries"]], ids[4:])
+
+        # every page is cut from the same cached result
+        self.assertEqual(self.servicer.calls["search"], 1)
+        self.assertEqual(self.servicer.calls["list_search_result"], 1)
+
+    def test_invalid_pagination(self):
+        response = self.search(limit="many")
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.json()["detail"], "invalid_pagination")
+
+
+class FieldProjectionTest(FakeIndexerTestCase):
+    def test_search_fields(self):
+        entry = self.search(fields=["meta"]).json()["entries"][0]
+
+        self.assertIn("meta", entry)
+        self.assertNotIn("feature", entry)
+        self.assertNotIn("classifier", entry)
+
+        entry = self.search().json()["entries"][0]
+        self.assertTrue({"meta", "origin", "classifier", "feature"} <= set(entry))
+
+    def test_get_fields(self):
+        client = APIClient()
+
+        entry = client.get("/get", {"id": "a", "fields": "meta,origin"}).json()["entry"]
+        self.assertEqual(set(entry) - {"id", "path", "preview"}, {"meta", "origin"})
+
+        entry = client.post("/get", {"params": {"id": "a", "fields": ["feature"]}}, format="json").json()["entry"]
+        self.assertEqual(set(entry) - {"id", "path", "preview"}, {"feature"})
+
+    def test_unknown_field(self):
+        response = self.search(fields=["password"])
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.json()["detail"], "unknown_fields")
+
+
+class PackedVectorsTest(FakeIndexerTestCase):
+    def test_vectors_reference_one_buffer(self):
+        plain = self.search(limit=2).json()
+        packed = self.search(limit=2, vectors="float32").json()
+
+        vectors = packed["vectors"]
+        self.assertEqual((vectors["dtype"], vectors["byteorder"]), ("float32", "little"))
+
+        buffer = np.frombuffer(base64.b64decode(vectors["data"]), dtype="<f4")
+        self.assertEqual(len(buffer), vectors["length"])
+
+        for plain_entry, packed_entry in zip(plain["entries"], packed["entries"]):
+            reference = packed_entry["coordinates"]
+            values = buffer[reference["offset"] : reference["offset"] + reference["length"]]
+            np.testing.assert_allclose(values, plain_entry["coordinates"], rtol=1e-6)
+
+    def test_unknown_dtype(self):
+        response = self.search(vectors="int8")
+
+        self.assertEqual(response.json()["detail"], "unknown_vector_dtype")
+
+
+class ColumnsFormatTest(FakeIndexerTestCase):
+    def test_columns_match_entries(self):
+        entries = self.search().json()["entries"]
+        result = self.search(format="columns").json()
+        columns = result["columns"]
+
+        self.assertNotIn("entries", result)
+        self.assertEqual(set(columns), {"id", "x", "y", "cluster", "distance", "padded", "collection"})
+        self.assertEqual(columns["id"], [x["id"] for x in entries])
+        self.assertEqual(columns["cluster"], [x["cluster"] for x in entries])
+        self.assertEqual(columns["padded"], [x["padded"] for x in entries])
+        self.assertEqual(columns["collection"], [x["collection"]["id"] for x in entries])
+        np.testing.assert_allclose(columns["distance"], [x["distance"] for x in entries], rtol=1e-6)
+        np.testing.assert_allclose(columns["x"], [x["coordinates"][0] for x in entries], rtol=1e-6)
+        np.testing.assert_allclose(columns["y"], [x["coordinates"][1] for x in entries], rtol=1e-6)
+
+    def test_pagination_and_vectors(self):
+        ids = self.search(format="columns").json()["columns"]["id"]
+        result = self.search(format="columns", offset=1, limit=2, vectors="float32").json()
+
+        self.assertEqual(result["columns"]["id"], ids[1:3])
+        self.assertEqual((result["offset"], result["limit"], result["total"]), (1, 2, 5))
+
+        x = result["columns"]["x"]
+        self.assertEqual((x["dtype"], x["length"]), ("float32", 2))
+        self.assertEqual(len(base64.b64decode(x["data"])), 8)
+
+        self.assertEqual(self.servicer.calls["list_search_result"], 1)
+
+    def test_unmapped_points_are_null(self):
+        response = indexer_pb2.ListSearchResultReply()
+        response.entries.add(id="a", coordinates=[1.0, 2.0])
+        response.entries.add(id="b")
+
+        columns = Search().columns_from_proto(response)["columns"]
+
+        self.assertEqual((columns["x"], columns["y"]), ([1.0, None], [2.0, None]))
+
+    def test_unknown_format(self):
+        self.assertEqual(self.search(format="table").json()["detail"], "unknown_format")
+
+
+class MsgpackResultTest(FakeIndexerTestCase):
+    def search_msgpack(self, **params):
+        client = APIClient(headers={"Accept": "application/msgpack"})
+
+        return self.search(client, **params)
+
+    def test_cached_result_is_sent_packed(self):
+        json_result = self.search().json()
+        response = self.search_msgpack()
+
+        self.assertEqual(response["Content-Type"], "application/msgpack")
+        self.assertEqual(msgpack.unpackb(response.content), json_result)
+
+        # the stored bytes are sent without unpacking and packing them again
+        with mock.patch("backend.renderers.msgpack.packb") as packb:
+            response = self.search_msgpack()
+
+        packb.assert_not_called()
+        self.assertEqual(msgpack.unpackb(response.content), json_result)
+        self.assertEqual(self.servicer.calls["search"], 1)
+
+    def test_pages_are_packed_by_the_renderer(self):
+        self.search_msgpack()
+        result = msgpack.unpackb(self.search_msgpack(limit=2).content)
+
+        self.assertEqual((result["offset"], result["limit"], len(result["entries"])), (0, 2, 2))
+
+    def test_get_packed_keeps_local_bytes(self):
+        results = ResultCache(max_bytes=1 << 20)
+        results.set("key", {"entries": [1, 2, 3]})
+
+        with mock.patch("backend.utils.cache.msgpack.packb") as packb:
+            packed = results.get_packed("key")
+            self.assertIs(results.get_packed("key"), packed)
+
+        packb.assert_not_called()
+        self.assertEqual(msgpack.unpackb(packed), {"entries": [1, 2, 3]})
+
+
+class PrecompressedBodyTest(FakeIndexerTestCase):
+    def setUp(self):
+        super().setUp()
+
+        # runs the task in the request, as an eager worker would
+        patcher = mock.patch.object(cache_search_bodies, "delay", side_effect=cache_search_bodies)
+        self.delay = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def gzip_search(self, **params):
+        return self.search(APIClient(headers={"Accept-Encoding": "gzip"}), **params)
+
+    def test_bodies_are_compressed_after_the_first_hit(self):
+        with mock.patch("backend.tasks.compress_body", wraps=compress_body) as compress:
+            result = self.search().json()
+
+            # storing the result does not compress it
+            compress.assert_not_called()
+            self.delay.assert_not_called()
+
+            response = self.gzip_search()
+
+            self.assertFalse(response.has_header("Content-Encoding"))
+            self.assertEqual(response.json(), result)
+            self.assertEqual(self.delay.call_count, 1)
+            self.assertEqual(
+                sorted(x.args[1] for x in compress.call_args_list),
+                sorted(body_encodings(settings.SEARCH_CACHE_BODY_ENCODINGS)),
+            )
+            compress.reset_mock()
+
+            response = self.gzip_search()
+
+            # hits are sent as stored
+            compress.assert_not_called()
+            self.assertEqual(self.delay.call_count, 1)
+
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(json.loads(zlib.decompress(response.content, 16 + zlib.MAX_WBITS)), result)
+
+    def test_rendered_hits_do_not_compress(self):
+        self.search()
+
+        # pages and user data are rendered per request
+        self.gzip_search(limit=2)
+        self.gzip_search(offset=2)
+
+        user = get_user_model().objects.create_user("user", password="password")
+        client = APIClient(headers={"Accept-Encoding": "gzip"})
+        client.force_authenticate(user)
+        self.search(client)
+
+        self.delay.assert_not_called()
+
+    def test_task_is_scheduled_once(self):
+        self.delay.side_effect = None
+        self.search()
+
+        self.gzip_search()
+        self.gzip_search()
+
+        self.assertEqual(self.delay.call_count, 1)
+
+    def test_failed_scheduling_is_served(self):
+        self.delay.side_effect = OSError("broker unavailable")
+        result = self.search().json()
+
+        with self.assertLogs("backend.views.search", "ERROR"):
+            response = self.gzip_search()
+
+        self.assertEqual(response.json(), result)
+
+    @skipIf(brotli is None, "brotli is not installed")
+    def test_encoding_selection(self):
+        result = self.search().json()
+        self.gzip_search()
+
+        response = self.search(APIClient(headers={"Accept-Encoding": "gzip;q=0, br"}))
+        self.assertEqual(response["Content-Encoding"], "br")
+        self.assertEqual(json.loads(brotli.decompress(response.content)), result)
+
+        response = self.search(APIClient(headers={"Accept-Encoding": "identity"}))
+        self.assertFalse(response.has_header("Content-Encoding"))
+        self.assertEqual(response.json(), result)
+
+        response = self.gzip_search(limit=2)
+        self.assertFalse(response.has_header("Content-Encoding"))
+
+    @override_settings(SEARCH_CACHE_BODY_MAX_BYTES=10)
+    def test_large_bodies_are_not_compressed(self):
+        result = self.search().json()
+
+        with mock.patch("backend.tasks.compress_body", wraps=compress_body) as compress:
+            self.gzip_search()
+            response = self.gzip_search()
+
+            # the size is checked before compressing
+            compress.assert_not_called()
+
+        self.assertFalse(response.has_header("Content-Encoding"))
+        self.assertEqual(response.json(), result)
+
+        self.assertEqual(self.delay.call_count, 1)
+
+
+class UrlTemplatesTest(FakeIndexerTestCase):
+    def expand(self, template, hash_id):
+        return template.replace("{id[0:2]}", hash_id[0:2]).replace("{id[2:4]}", hash_id[2:4]).replace("{id}", hash_id)
+
+    def test_templates_build_the_entry_urls(self):
+        entries = self.search().json()["entries"]
+        result = self.search(urls="templates").json()
+        templates = result["url_templates"]
+
+        for entry, template_entry in zip(entries, result["entries"]):
+            self.assertNotIn("path", template_entry)
+            self.assertNotIn("preview", template_entry)
+            self.assertEqual(self.expand(templates["image"], entry["id"]), entry["path"])
+            self.assertEqual(self.expand(templates["preview"], entry["id"]), entry["preview"])
+
+        self.assertEqual(self.expand(templates["upload_image"], "abcdef"), upload_url_to_image("abcdef"))
+
+    def test_unknown_urls(self):
+        self.assertEqual(self.search(urls="none").json()["detail"], "unknown_urls")
+
+
+class QueryLogTest(FakeIndexerTestCase):
+    def test_searches_are_written_in_bulk(self):
+        self.search(query="cat")
+        self.search(query="dog")
+        self.search(query="cat", limit=2)
+
+        self.assertEqual(SearchQuery.objects.count(), 0)
+
+        with CaptureQueriesContext(connection) as queries:
+            query_log.flush()
+
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(
+            sorted(SearchQuery.objects.values_list("cache", flat=True)),
+            ["hit", "miss", "miss"],
+        )
+        self.assertEqual(len(set(SearchQuery.objects.values_list("request_hash", flat=True))), 2)
+
+    def test_flush_when_full(self):
+        with mock.patch.object(query_log, "max_entries", 2):
+            self.search(query="cat")
+            self.assertEqual(SearchQuery.objects.count(), 0)
+
+            self.search(query="dog")
+            self.assertEqual(SearchQuery.objects.count(), 2)
+            self.assertEqual(query_log.entries, [])
+
+
+class WarmSearchCacheTest(FakeIndexerTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.search(query="cat")
+        query_log.flush()
+
+        self.servicer.calls.clear()
+
+    def key(self):
+        # clearing the cache drops the version counters, keys are computed anew
+        search = Search()
+        request = indexer_pb2.SearchRequest.FromString(bytes(SearchQuery.objects.get().request))
+
+        return search.result_key(search.search_request_key(request), DEFAULT_FIELDS)
+
+    def test_fresh_result_is_kept(self):
+        warm_search_cache()
+
+        self.assertEqual(self.servicer.calls["search"], 0)
+        self.assertLess(search_cache.age(self.key()), 60)
+
+    def test_expired_result_is_searched_again(self):
+        cache.clear()
+        search_cache.local.clear()
+
+        warm_search_cache()
+
+        self.assertEqual(self.servicer.calls["search"], 1)
+        self.assertIsNotNone(search_cache.get(self.key()))
+
+    def test_old_result_is_searched_again(self):
+        with override_settings(SEARCH_WARM_MAX_AGE=0):
+            warm_search_cache()
+
+        self.assertEqual(self.servicer.calls["search"], 1)
+        self.assertEqual(self.servicer.calls["list_search_result"], 1)
+        self.assertLess(search_cache.age(self.key()), 60)
+
+        # the refreshed result is answered from the cache
+        self.search(query="cat")
+        self.assertEqual(self.servicer.calls["search"], 1)
+
+
+class PreferredEncodingTest(TestCase):
+    def preferred(self, accept_encoding):
+        request = RequestFactory().get("/search", headers={"Accept-Encoding": accept_encoding})
+
+        return preferred_encoding(request, ["br", "gzip"])
+
+    def test_preferred_encoding(self):
+        self.assertEqual(self.preferred("gzip, deflate, br"), "br")
+        self.assertEqual(self.preferred("gzip"), "gzip")
+        self.assertEqual(self.preferred("GZIP;q=0.5"), "gzip")
+        self.assertEqual(self.preferred("*"), "br")
+        self.assertIsNone(self.preferred("identity"))
+        self.assertIsNone(self.preferred(""))
+
+    def test_refused_encodings(self):
+        self.assertEqual(self.preferred("br;q=0, gzip"), "gzip")
+        self.assertEqual(self.preferred("br;q=0, *"), "gzip")
+        self.assertEqual(self.preferred("*, br; q=0.0"), "gzip")
+        self.assertIsNone(self.preferred("br;q=0, gzip;q=0, *"))
+        self.assertIsNone(self.preferred("*;q=0"))
+
+
+class CollectionAccessTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+        self.owner = get_user_model().objects.create_user("access_owner")
+        self.other = get_user_model().objects.create_user("access_other")
+        self.collection = Collection.objects.create(
+            user=self.owner, hash_id=uuid.uuid4().hex, name="shared", visibility="V"
+        )
+
+    def check(self, user):
+        return Search().check_collection_access([self.collection.hash_id], user)
+
+    def test_access_is_cached(self):
+        self.assertTrue(self.check(self.other))
+
+        with self.assertNumQueries(0):
+            self.assertTrue(self.check(self.other))
+
+    def test_visibility(self):
+        self.collection.visibility = "U"
+        self.collection.save()
+
+        self.assertTrue(self.check(self.owner))
+        self.assertFalse(self.check(self.other))
+        self.assertFalse(self.check(AnonymousUser()))
+
+    def test_save_invalidates(self):
+        self.assertTrue(self.check(self.other))
+
+        self.collection.visibility = "U"
+        self.collection.save()
+
+        self.assertFalse(self.check(self.other))
+
+    def test_delete_invalidates(self):
+        self.assertTrue(self.check(self.other))
+
+        Collection.objects.filter(id=self.collection.id).delete()
+
+        self.assertFalse(self.check(self.other))
+
+    def test_bulk_update(self):
+        self.assertTrue(self.check(self.other))
+
+        # queryset updates send no signals, the caller invalidates
+        Collection.objects.filter(id=self.collection.id).update(visibility="U")
+        invalidate_collection_access()
+
+        self.assertFalse(self.check(self.other))
+
+    def test_access_expires(self):
+        with mock.patch("backend.views.search.cache.set", wraps=cache.set) as cache_set:
+            self.check(self.other)
+
+        self.assertEqual(cache_set.call_args.args[2], settings.COLLECTION_ACCESS_TIMEOUT)
+
+
+class CollectionImageCountTest(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user("count_user")
+        self.client = APIClient()
+        self.client.force_authenticate(user=self.user)
+
+    def add_collection(self, images):
+        collection = Collection.objects.create(user=self.user, hash_id=uuid.uuid4().hex, name="counted")
+
+        for _ in range(images):
+            Image.objects.create(hash_id=uuid.uuid4().hex, collection=collection)
+
+        return collection
+
+    def test_collection_count_command(self):
+        collections = [self.add_collection(x) for x in (0, 3, 7)]
+
+        call_command("collection_count", stdout=io.StringIO())
+
+        for collection, count in zip(collections, (0, 3, 7)):
+            collection.refresh_from_db()
+            self.assertEqual(collection.image_count, count)
+
+    def test_list_reads_stored_count(self):
+        Collection.objects.filter(id=self.add_collection(3).id).update(image_count=3)
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get("/list_collection")
+
+        self.assertEqual([x["count"] for x in response.json()], [3])
+        self.assertFalse(any("backend_image" in x["sql"] for x in context.captured_queries))
+
+
+class QueryImageTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        query_image_cache.local.clear()
+
+        self.root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.root.cleanup)
+
+    def write_image(self, root, image_id, shape):
+        path = os.path.join(self.root.name, root, image_id[0:2], image_id[2:4], f"{image_id}.jpg")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        imageio.imwrite(path, np.zeros((*shape, 3), dtype=np.uint8))
+
+        return path
+
+    def feature_term(self, image_id, roi=None):
+        term = indexer_pb2.FeatureSearchTerm()
+
+        with self.settings(
+            UPLOAD_ROOT=os.path.join(self.root.name, "upload"),
+            MEDIA_ROOT=os.path.join(self.root.name, "media"),
+            QUERY_IMAGE_MAX_DIM=64,
+        ):
+            Search().build_image_query(term, image_id, roi, {"clip_embedding_feature": 1})
+
+        return term
+
+    def test_upload_is_shrunk_and_shared(self):
+        image_id = uuid.uuid4().hex
+        path = self.write_image("upload", image_id, (200, 100))
+
+        term = self.feature_term(image_id)
+        self.assertEqual(imageio.imread(term.image.encoded).shape[:2], (64, 32))
+
+        # another worker gets the term from the shared cache without the file
+        os.remove(path)
+        query_image_cache.local.clear()
+
+        self.assertEqual(self.feature_term(image_id), term)
+
+    def test_indexed_image_is_sent_by_id(self):
+        image_id = uuid.uuid4().hex
+
+        term = self.feature_term(image_id)
+
+        self.assertEqual(term.image.id, image_id)
+        self.assertFalse(term.image.encoded)
+
+    def test_roi_reads_media_file(self):
+        image_id = uuid.uuid4().hex
+        self.write_image("media", image_id, (200, 100))
+        roi = {"x": 0.1, "y": 0.1, "width": 0.5, "height": 0.5}
+
+        term = self.feature_term(image_id, roi)
+
+        # the region refers to the stored image, which is sent as it is
+        self.assertEqual(imageio.imread(term.image.encoded).shape[:2], (200, 100))
+        self.assertAlmostEqual(term.image.roi.width, 0.5)
+
+    def test_roi_without_file_falls_back_to_id(self):
+        image_id = uuid.uuid4().hex
+        roi = {"x": 0.1, "y": 0.1, "width": 0.5, "height": 0.5}
+
+        term = self.feature_term(image_id, roi)
+
+        self.assertEqual(term.image.id, image_id)
+        self.assertFalse(term.image.encoded)
+
+        # not cached, the file is read once it exists
+        self.write_image("media", image_id, (200, 100))
+        self.assertTrue(self.feature_term(image_id, roi).image.encoded)
+
+
+class SingleFlightTest(FakeIndexerTestCase):
+    def test_concurrent_searches_share_one_job(self):
+        # the first search is still running when the others arrive
+        self.servicer.search_delay = 0.2
+
+        with self.settings(QUERY_LOG=False), futures.ThreadPoolExecutor(max_workers=4) as executor:
+            responses = list(executor.map(lambda i: self.search(wait=False), range(4)))
+
+        job_ids = {x.json()["job_id"] for x in responses}
+
+        self.assertEqual(len(job_ids), 1)
+        self.assertEqual(self.servicer.calls["search"], 1)
+
+    def test_claim_is_exclusive_until_released(self):
+        search = Search()
+        grpc_request, grpc_request_hash = search.prepare_search(
+            {"query": [{"type": "txt", "positive": True, "value": "cat"}]}
+        )
+
+        self.assertTrue(search.claim_inflight(grpc_request_hash))
+        self.assertFalse(search.claim_inflight(grpc_request_hash))
+
+        search.release_inflight(grpc_request_hash)
+        self.assertTrue(search.claim_inflight(grpc_request_hash))
+
+    def inflight(self):
+        _, grpc_request_hash = Search().prepare_search({"query": [{"type": "txt", "positive": True, "value": "cat"}]})
+
+        return cache.get(f"inflight:{grpc_request_hash}")
+
+    def test_marker_is_dropped_with_the_stored_result(self):
+        job_id = self.search(wait=False).json()["job_id"]
+        self.assertEqual(self.inflight(), job_id)
+
+        self.search(job_id=job_id)
+        self.assertIsNone(self.inflight())
+
+    def test_failed_job_is_not_joined(self):
+        self.servicer.result_status = grpc.StatusCode.INTERNAL
+
+        self.assertEqual(self.search().json()["detail"], "unknown_error")
+        self.assertIsNone(self.inflight())
+
+        # the next identical search starts a job of its own
+        self.servicer.result_status = None
+        result = self.search().json()
+
+        self.assertEqual(len(result["entries"]), 5)
+        self.assertEqual(self.servicer.calls["search"], 2)
+
+
+class GetManyTest(FakeIndexerTestCase):
+    def get_many(self, ids, **params):
+        return APIClient().post("/get_many", {"params": {"ids": ids, **params}}, format="json")
+
+    def test_entries_in_request_order(self):
+        ids = [uuid.uuid4().hex for _ in range(3)]
+
+        result = self.get_many([ids[0], ids[1], ids[0], ids[2]]).json()
+
+        self.assertEqual([x["id"] for x in result["entries"]], ids)
+        self.assertEqual(result["missing"], [])
+        self.assertEqual(self.servicer.calls["get"], 3)
+
+        # cached entries are not requested again
+        self.get_many(ids)
+        self.assertEqual(self.servicer.calls["get"], 3)
+
+    def test_too_many_ids(self):
+        with self.settings(GET_MANY_MAX_IDS=2):
+            response = self.get_many(["a", "b", "c"])
+
+        self.assertEqual(response.json()["detail"], "too_many_ids")
+        self.assertEqual(self.servicer.calls["get"], 0)
+
+    def test_invalid_ids(self):
+        for ids in ("a", [1, 2], None):
+            self.assertEqual(self.get_many(ids).json()["detail"], "unknown_resource")
+
+    def test_get_is_not_allowed(self):
+        self.assertEqual(APIClient().get("/get_many").status_code, 405)
+
+
+class GetConditionalTest(FakeIndexerTestCase):
+    def get(self, hash_id, **headers):
+        return APIClient().get("/get", {"id": hash_id}, headers=headers)
+
+    def test_etag(self):
+        response = self.get("a")
+        etag = response["ETag"]
+
+        self.assertEqual(response.status_code, 200)
+
+        response = self.get("a", if_none_match=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+        self.assertEqual(response.content, b"")
+
+        self.assertEqual(self.get("a", if_none_match='"other"').status_code, 200)
+        self.assertEqual(self.get("a", if_none_match="*").status_code, 304)
+
+        # validators are cached with the entry
+        self.assertEqual(self.servicer.calls["get"], 1)
+
+    def test_if_modified_since(self):
+        modified = self.get("a")["Last-Modified"]
+
+        self.assertEqual(self.get("a", if_modified_since=modified).status_code, 304)
+        self.assertEqual(
+            self.get("a", if_modified_since="Mon, 01 Jan 2001 00:00:00 GMT").status_code,
+            200,
+        )
+
+    def test_invalidation_drops_every_projection(self):
+        projections = [["meta"], ["feature", "meta"], ["classifier", "feature", "meta", "origin"]]
+
+        for fields in projections:
+            APIClient().post("/get", {"params": {"id": "a", "fields": fields}}, format="json")
+
+        entry_keys = [entry_cache_key("a", parse_fields({"fields": x})) for x in projections]
+        self.assertEqual(len(entry_cache.get_many(entry_keys)), len(projections))
+
+        invalidate_entries(["a"])
+
+        self.assertEqual(entry_cache.get_many(entry_keys), {})
+
+
+class AsyncViewTest(FakeIndexerTestCase):
+    """
+    The async views run the flows of the sync views, both have to answer
+    alike.
+    """
+
+    async def call(self, view, path, params=None, **headers):
+        factory = AsyncRequestFactory()
+
+        if params is None:
+            request = factory.get(path, headers=headers)
+        else:
+            request = factory.post(path, {"params": params}, content_type="application/json", headers=headers)
+
+        async def auser():
+            return AnonymousUser()
+
+        request.auser = auser
+
+        return await view.as_view()(request)
+
+    def text_query(self, value="cat", **params):
+        return {"query": [{"type": "txt", "positive": True, "value": value}], "wait": True, **params}
+
+    async def test_search_matches_sync_view(self):
+        response = await self.call(AsyncSearch, "/search", self.text_query(limit=3))
+        result = json.loads(response.content)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((result["offset"], result["limit"], result["total"]), (0, 3, 5))
+
+        # the sync view is served from the cache the async view filled
+        sync_result = await sync_to_async(lambda: self.search(limit=3).json())()
+
+        self.assertEqual(result, sync_result)
+        self.assertEqual(self.servicer.calls["search"], 1)
+
+    async def test_get_and_get_many(self):
+        response = await self.call(AsyncGet, "/get?id=a&fields=meta")
+        etag = response["ETag"]
+
+        self.assertEqual(set(json.loads(response.content)["entry"]), {"id", "meta", "path", "preview"})
+        self.assertEqual((await self.call(AsyncGet, "/get?id=a&fields=meta", if_none_match=etag)).status_code, 304)
+
+        response = await self.call(AsyncGetMany, "/get_many", {"ids": ["a", "b"], "fields": ["meta"]})
+        self.assertEqual([x["id"] for x in json.loads(response.content)["entries"]], ["a", "b"])
+
+        self.assertEqual((await self.call(AsyncGetMany, "/get_many")).status_code, 405)
+
+    async def test_errors_match_sync_view(self):
+        response = await self.call(AsyncSearch, "/search", self.text_query(limit="many"))
+        sync_response = await sync_to_async(lambda: self.search(limit="many"))()
+
+        self.assertEqual(response.status_code, sync_response.status_code)
+        self.assertEqual(json.loads(response.content), sync_response.json())
+
+    async def test_throttled_sends_retry_after(self):
+        with mock.patch.object(Search, "admission") as admission:
+            admission.acquire.return_value = None
+            admission.retry_after = 7
+
+            response = await self.call(AsyncSearch, "/search", self.text_query())
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "7")
+        self.assertEqual(json.loads(response.content)["status_code"], 429)
+
+    async def test_failed_conversion_is_an_error(self):
+        with mock.patch.object(Search, "result_from_proto", side_effect=ValueError):
+            response = await self.call(AsyncSearch, "/search", self.text_query())
+            sync_response = await sync_to_async(lambda: self.search(query="dog"))()
+
+        self.assertEqual(json.loads(response.content)["detail"], "unknown_error")
+        self.assertEqual(sync_response.json()["detail"], "unknown_error")
+
+
+class CircuitBreakerTest(TestCase):
+    def setUp(self):
+        self.now = 100.0
+        patcher = mock.patch("backend.utils.communication.time.monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10)
+
+    def test_opens_after_consecutive_failures(self):
+        self.breaker.failure()
+        self.breaker.success()
+        self.breaker.failure()
+
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+        self.breaker.failure()
+
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.assertFalse(self.breaker.available())
+
+    def test_single_trial_after_reset_timeout(self):
+        self.breaker.failure()
+        self.breaker.failure()
+        self.now += 10
+
+        self.assertTrue(self.breaker.available())
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(self.breaker.allow())
+
+        # a failed trial opens the circuit again right away
+        self.breaker.failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+        self.now += 10
+        self.assertTrue(self.breaker.allow())
+        self.breaker.success()
+
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(self.breaker.allow())
+
+    def test_lost_trial_is_replaced(self):
+        self.breaker.failure()
+        self.breaker.failure()
+        self.now += 10
+
+        self.assertTrue(self.breaker.allow())
+        self.now += 9
+        self.assertFalse(self.breaker.allow())
+        self.now += 1
+        self.assertTrue(self.breaker.allow())
+
+    def test_pool_fails_fast_on_open_circuit(self):
+        pool = IndexerPool(["localhost:1"], failure_threshold=1, probe_interval=None)
+        endpoint = pool.endpoints[0]
+
+        with self.assertRaises(grpc.RpcError):
+            with pool.track(endpoint):
+                raise CircuitOpenError("localhost:1")
+
+        self.assertEqual(endpoint.breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(endpoint.outstanding, 0)
+
+        with self.assertRaises(CircuitOpenError):
+            with pool.track(endpoint):
+                pass
+
+
+class IndexerPoolTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def pool(self, **kwargs):
+        return IndexerPool(["localhost:1", "localhost:2", "localhost:3"], probe_interval=None, **kwargs)
+
+    def test_least_outstanding(self):
+        pool = self.pool()
+        first, second, third = pool.endpoints
+        first.outstanding, third.outstanding = 2, 1
+
+        self.assertEqual({pool.select() for _ in range(10)}, {second})
+
+        second.outstanding = 2
+        self.assertEqual({pool.select() for _ in range(10)}, {third})
+
+    def test_round_robin(self):
+        pool = self.pool(balancing="round_robin")
+
+        selected = [pool.select().address for _ in range(6)]
+
+        self.assertEqual(selected[:3], selected[3:])
+        self.assertEqual(set(selected), set(pool.addresses))
+
+    def test_failed_probe_ejects_endpoint(self):
+        pool = self.pool(balancing="round_robin")
+        first = pool.endpoints[0]
+
+        with mock.patch.object(first, "probe", return_value=False):
+            pool.probe(first)
+
+        self.assertFalse(first.healthy)
+        self.assertNotIn(first, {pool.select() for _ in range(6)})
+
+        with mock.patch.object(first, "probe", return_value=True):
+            pool.probe(first)
+
+        self.assertIn(first, {pool.select() for _ in range(6)})
+
+    def test_open_circuits_are_skipped_unless_all_are_open(self):
+        pool = self.pool(failure_threshold=1)
+
+        for endpoint in pool.endpoints[:2]:
+            endpoint.breaker.failure()
+
+        self.assertEqual({pool.select() for _ in range(10)}, {pool.endpoints[2]})
+
+        pool.endpoints[2].breaker.failure()
+        self.assertEqual({pool.select() for _ in range(30)}, set(pool.endpoints))
+
+    def test_job_calls_go_to_the_endpoint_of_the_job(self):
+        pool = self.pool()
+        endpoint = pool.endpoints[2]
+        pool.bind_job("job", endpoint)
+
+        # busier than the others, follow-up calls still have to go there
+        endpoint.outstanding = 5
+
+        for _ in range(5):
+            with pool.endpoint(job_id="job") as selected:
+                self.assertIs(selected, endpoint)
+
+        # unknown jobs are balanced like new calls
+        with pool.endpoint(job_id="other") as selected:
+            self.assertIsNot(selected, endpoint)
+
+
+class Unavailable(grpc.RpcError):
+    def code(self):
+        return grpc.StatusCode.UNAVAILABLE
+
+
+class DeadlineTest(TestCase):
+    def setUp(self):
+        self.now = 100.0
+        patcher = mock.patch("backend.utils.communication.time.monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.timeouts = []
+
+    def details(self, method, timeout=None):
+        return replace_timeout(mock.Mock(method=method), timeout)
+
+    def continuation(self, details, request):
+        self.timeouts.append(details.timeout)
+        return Unavailable()
+
+    def test_per_method_deadlines(self):
+        interceptor = DeadlineClientInterceptor(deadlines={"default": 30, "search": 10})
+
+        for method, timeout in (
+            ("/indexer.Indexer/search", None),
+            (b"/indexer.Indexer/get", None),
+            ("/indexer.Indexer/search", 2),
+        ):
+            interceptor.intercept_unary_unary(self.continuation, self.details(method, timeout), None)
+
+        # unlisted methods fall back to the default, explicit timeouts are kept
+        self.assertEqual(self.timeouts, [10, 30, 2])
+
+    def test_without_default(self):
+        interceptor = DeadlineClientInterceptor(deadlines={"search": 10})
+        interceptor.intercept_unary_unary(self.continuation, self.details("/indexer.Indexer/get"), None)
+
+        self.assertEqual(self.timeouts, [None])
+
+    def test_retries_share_one_deadline(self):
+        policy = mock.Mock()
+        policy.sleep.side_effect = lambda try_i, max_sleep_ms: setattr(self, "now", self.now + 0.25)
+
+        retry = RetryOnRpcErrorClientInterceptor(
+            max_attempts=10,
+            sleeping_policy=policy,
+            status_for_retry=(grpc.StatusCode.UNAVAILABLE,),
+        )
+        interceptor = DeadlineClientInterceptor(deadlines={"search": 1})
+
+        response = interceptor.intercept_unary_unary(
+            lambda details, request: retry.intercept_unary_unary(self.continuation, details, request),
+            self.details("/indexer.Indexer/search"),
+            None,
+        )
+
+        self.assertIsInstance(response, Unavailable)
+        np.testing.assert_allclose(self.timeouts, [1.0, 0.75, 0.5, 0.25])
+
+        # no sleep is longer than the time left
+        self.assertEqual([x.args[1] for x in policy.sleep.call_args_list], [1000, 750, 500, 250])
+
+
+class RetryBudgetTest(TestCase):
+    def setUp(self):
+        self.now = 100.0
+        patcher = mock.patch("backend.utils.communication.time.monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_withdraw_until_empty(self):
+        budget = RetryBudget(ratio=0.5, min_per_second=1, max_tokens=2)
+
+        self.assertTrue(budget.withdraw())
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+
+        # two calls pay for one retry
+        budget.deposit()
+        self.assertFalse(budget.withdraw())
+        budget.deposit()
+        self.assertTrue(budget.withdraw())
+
+    def test_refill_over_time(self):
+        budget = RetryBudget(ratio=0.1, min_per_second=2, max_tokens=3)
+
+        for _ in range(3):
+            budget.withdraw()
+
+        self.now += 0.5
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+
+        # tokens never exceed max_tokens
+        self.now += 60
+        self.assertEqual(sum(budget.withdraw() for _ in range(5)), 3)
+
+
+class IndexerUnavailableTest(FakeIndexerTestCase):
+    def setUp(self):
+        super().setUp()
+
+        breaker = RPCView.indexer.endpoints[0].breaker
+        self.addCleanup(breaker.reset)
+
+        for _ in range(breaker.failure_threshold):
+            breaker.failure()
+
+    def assertUnavailable(self, status_code, headers, data):
+        self.assertEqual(status_code, 503)
+        self.assertEqual(data, {"detail": "indexer_unavailable", "status_code": 503})
+        self.assertTrue(1 <= int(headers["Retry-After"]) <= 10)
+
+    def test_search(self):
+        response = self.search()
+
+        self.assertUnavailable(response.status_code, response, response.json())
+        self.assertEqual(self.servicer.calls["search"], 0)
+
+        # the failed start released the single-flight claim and the admission
+        self.assertEqual(self.search().status_code, 503)
+
+    def test_check_and_get(self):
+        response = APIClient().post("/search", {"params": {"job_id": "job"}}, format="json")
+        self.assertUnavailable(response.status_code, response, response.json())
+
+        response = APIClient().get("/get", {"id": "a"})
+        self.assertUnavailable(response.status_code, response, response.json())
+
+    async def test_async_views(self):
+        factory = AsyncRequestFactory()
+        request = factory.post(
+            "/search",
+            {"params": {"query": [{"type": "txt", "positive": True, "value": "cat"}]}},
+            content_type="application/json",
+        )
+
+        async def auser():
+            return AnonymousUser()
+
+        request.auser = auser
+        response = await AsyncSearch.as_view()(request)
+
+        self.assertUnavailable(response.status_code, response, json.loads(response.content))
+
+        request = factory.get("/get?id=a")
+        request.auser = auser
+        response = await AsyncGet.as_view()(request)
+
+        self.assertUnavailable(response.status_code, response, json.loads(response.content))
+
+
+class MetricsAccessTest(TestCase):
+    def get(self, user):
+        request = RequestFactory().get("/metrics")
+        request.user = user
+
+        return metrics(request)
+
+    def test_staff_only_without_token(self):
+        self.assertEqual(APIClient().get("/metrics").status_code, 403)
+        self.assertEqual(self.get(get_user_model().objects.create_user("user")).status_code, 403)
+
+        response = self.get(get_user_model().objects.create_user("staff", is_staff=True))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"iart_request_seconds", response.content)
+
+    @override_settings(METRICS_TOKEN="secret")
+    def test_token(self):
+        self.assertEqual(APIClient().get("/metrics", headers={"Authorization": "Bearer secret"}).status_code, 200)
+        self.assertEqual(APIClient().get("/metrics", headers={"Authorization": "Bearer other"}).status_code, 403)
+        self.assertEqual(APIClient().get("/metrics", headers={"Authorization": "secret"}).status_code, 403)
+
+
+class AdmissionControllerTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+        self.admission = AdmissionController(costs={"search": 3}, capacity=8, client_capacity=4, timeout=120)
+        self.request = indexer_pb2.SearchRequest()
+
+        self.now = 1000000.0
+        patcher = mock.patch("backend.utils.admission.time.time", side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def used(self, client=None):
+        return self.admission.used("admission:global" if client is None else f"admission:client:{client}")
+
+    def test_cheap_jobs_are_not_counted(self):
+        admission = AdmissionController(costs={"search": 1}, capacity=8, client_capacity=4)
+
+        self.assertEqual(admission.acquire(self.request, "a"), [])
+        self.assertEqual(self.used(), 0)
+
+    def test_take_and_release(self):
+        first = self.admission.acquire(self.request, "a")
+
+        self.assertEqual((self.used("a"), self.used()), (3, 3))
+
+        # over the client capacity, nothing stays taken
+        self.assertIsNone(self.admission.acquire(self.request, "a"))
+        self.assertEqual((self.used("a"), self.used()), (3, 3))
+
+        self.assertIsNotNone(self.admission.acquire(self.request, "b"))
+
+        # over the global capacity, the client capacity is given back
+        self.assertIsNone(self.admission.acquire(self.request, "c"))
+        self.assertEqual((self.used("c"), self.used()), (0, 6))
+
+        self.admission.release(first)
+        self.assertEqual((self.used("a"), self.used()), (0, 3))
+        self.assertIsNotNone(self.admission.acquire(self.request, "c"))
+
+    def test_one_increment_per_counter(self):
+        self.admission.release(self.admission.acquire(self.request, "a"))
+
+        with mock.patch("backend.utils.admission.cache", wraps=cache) as shared_cache:
+            self.admission.acquire(self.request, "a")
+
+        self.assertEqual([x[0] for x in shared_cache.method_calls], ["incr", "get_many", "incr", "get_many"])
+
+    def test_jobs_are_released_once(self):
+        self.admission.bind_job("job", self.admission.acquire(self.request, "a"))
+
+        self.admission.release_job("job")
+        self.admission.release_job("job")
+
+        self.assertEqual((self.used("a"), self.used()), (0, 0))
+
+    def test_jobs_in_flight_outlive_older_jobs(self):
+        # an older job leaves its bucket behind
+        self.admission.release(self.admission.acquire(self.request, "x"))
+
+        self.now += 100
+        first = self.admission.acquire(self.request, "a")
+
+        # the buckets of the older job expired, the job in flight still counts
+        self.now += 60
+        self.assertIsNotNone(self.admission.acquire(self.request, "b"))
+        self.assertEqual(self.used(), 6)
+
+        self.admission.release(first)
+        self.assertEqual(self.used(), 3)
+
+        self.assertIsNotNone(self.admission.acquire(self.request, "c"))
+        self.assertIsNone(self.admission.acquire(self.request, "d"))
+        self.assertEqual(self.used(), 6)
+
+    def test_leases_expire(self):
+        self.admission.acquire(self.request, "a")
+        self.admission.acquire(self.request, "b")
+
+        self.now += 119
+        self.assertIsNone(self.admission.acquire(self.request, "c"))
+
+        # jobs whose result is never fetched free their capacity
+        self.now += 1
+        self.assertEqual(self.used(), 0)
+        self.assertIsNotNone(self.admission.acquire(self.request, "c"))
+
+    def test_release_after_expiry(self):
+        slots = self.admission.acquire(self.request, "a")
+
+        self.now += 120
+        second = self.admission.acquire(self.request, "b")
+
+        # the expired lease is not taken from the current bucket
+        self.admission.release(slots)
+        self.assertEqual(self.used(), 3)
+
+        self.admission.release(second)
+        self.assertEqual(self.used(), 0)
+
+
+class StageMetricsTest(FakeIndexerTestCase):
+    def count(self, stage, cache_label):
+        labels = {"view": "search", "stage": stage, "cache": cache_label}
+
+        return registry.get_sample_value("iart_stage_seconds_count", labels) or 0
+
+    def requests(self, cache_label):
+        return registry.get_sample_value("iart_request_seconds_count", {"view": "search", "cache": cache_label}) or 0
+
+    def test_search_stages(self):
+        stages = ("parse", "cache", "grpc", "convert", "render")
+        before = {x: self.count(x, "miss") for x in stages}
+        requests = self.requests("miss"), self.requests("hit")
+
+        self.search()
+
+        for x in stages:
+            self.assertEqual(self.count(x, "miss"), before[x] + 1, x)
+
+        before = {x: self.count(x, "hit") for x in stages}
+        self.search()
+
+        # a cache hit needs no indexer call and no conversion
+        self.assertEqual({x: self.count(x, "hit") - before[x] for x in stages}, {
+            "parse": 1,
+            "cache": 1,
+            "grpc": 0,
+            "convert": 0,
+            "render": 1,
+        })
+        self.assertEqual((self.requests("miss"), self.requests("hit")), (requests[0] + 1, requests[1] + 1))
+
+
+class BenchmarkSearchTest(TestCase):
+    def test_leaves_no_trace(self):
+        cache.clear()
+
+        with self.settings(QUERY_LOG=True):
+            call_command("benchmark_search", "--entries", "10", "--requests", "2", stdout=io.StringIO())
+
+        query_log.flush()
+
+        self.assertEqual(SearchQuery.objects.count(), 0)
+        # every search reads, and creates, the version of the default index
+        self.assertIsNone(cache.get("version:collection_default"))
+        self.assertEqual(search_cache.local.bytes, 0)
@@ -1,13 +1,30 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
+if settings.ASYNC_VIEWS:
+    from .views import aio
+
+    Get = aio.AsyncGet
+    GetMany = aio.AsyncGetMany
+    Search = aio.AsyncSearch
+    CollectionRemove = aio.AsyncCollectionRemove
+else:
+    Get = views.Get
+    GetMany = views.GetMany
+    Search = views.Search
+    CollectionRemove = views.CollectionRemove
+
 urlpatterns = [
-    path("get", views.Get.as_view(), name="get"),
+    path("get", Get.as_view(), name="get"),
+    path("get_many", GetMany.as_view(), name="get_many"),
     path("upload", views.Upload.as_view(), name="upload"),
-    path("search", views.Search.as_view(), name="search"),
+    path("search", Search.as_view(), name="search"),
+    path("search_cache_stats", views.SearchCacheStats.as_view(), name="search_cache_stats"),
+    path("metrics", views.metrics, name="metrics"),
     #
     path("add_collection", views.CollectionAdd.as_view(), name="add_collection"),
-    path("remove_collection", views.CollectionRemove.as_view(), name="remove_collection"),
+    path("remove_collection", CollectionRemove.as_view(), name="remove_collection"),
     path("list_collection", views.CollectionList.as_view(), name="list_collection"),
     #
     path("get_csrf_token", views.get_csrf_token, name="get_csrf_token"),
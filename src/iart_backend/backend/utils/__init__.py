@@ -6,7 +6,36 @@ from .urls import (
     upload_url_to_image,
     upload_url_to_preview,
     upload_path_to_image,
+    url_templates,
 )
-from .communication import RetryOnRpcErrorClientInterceptor, ExponentialBackoff
+from .communication import (
+    RetryOnRpcErrorClientInterceptor,
+    DeadlineClientInterceptor,
+    ExponentialBackoff,
+    RetryBudget,
+    CircuitBreaker,
+    CircuitOpenError,
+)
+from .indexer import IndexerEndpoint, IndexerPool, indexer_pool
+from .admission import AdmissionController, admission
 from .dicts import unflat_dict, flat_dict
 from .archive import TarArchive, ZipArchive
+from .cache import (
+    LRUCache,
+    ResultCache,
+    search_cache,
+    entry_cache,
+    entry_cache_key,
+    invalidate_entries,
+    invalidate_collection,
+    invalidate_collection_access,
+    query_image_cache,
+    version_cache,
+    cache_version,
+    cache_versions,
+    collection_version_name,
+    bump_cache_version,
+)
+from .querylog import QueryLog, query_log
+from .vectors import pack_vectors, encode_buffer, VECTOR_DTYPES
+from .metrics import timed, stage, mark_cache, request_timing, render_metrics
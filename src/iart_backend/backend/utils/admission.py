@@ -0,0 +1,147 @@
+import sys
+import math
+import time
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+
+if settings.INDEXER_PATH is not None:
+    sys.path.append(settings.INDEXER_PATH)
+
+from iart_indexer import indexer_pb2
+
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionController:
+    """
+    Limits the estimated cost of the search jobs running in the indexer, for
+    all clients together and for every single client. Every job holds a lease
+    on its cost that expires timeout seconds after it was taken, so jobs whose
+    result is never fetched cannot block the indexer forever. Leases are
+    counted in the shared cache, summed per pool (one per client and one for
+    all of them) in buckets of the time they were taken; the cost in use is
+    the sum of the buckets of the last timeout seconds.
+    """
+
+    def __init__(
+        self,
+        *,
+        costs,
+        min_cost: int = 2,
+        capacity: int = 32,
+        client_capacity: int = 8,
+        timeout: int = 120,
+        buckets: int = 12,
+        retry_after: int = 5,
+    ):
+        self.costs = costs
+        self.min_cost = min_cost
+        self.capacity = capacity
+        self.client_capacity = client_capacity
+        self.timeout = timeout
+        self.buckets = buckets
+        self.bucket_seconds = timeout / buckets
+        self.retry_after = retry_after
+
+    def estimate(self, grpc_request):
+        cost = self.costs.get("search", 1)
+
+        if grpc_request.mapping == indexer_pb2.SearchRequest.MAPPING_UMAP:
+            cost += self.costs.get("umap", 0)
+
+            if any(x.key == "grid_method" and x.string_val for x in grpc_request.mapping_options):
+                cost += self.costs.get("grid", 0)
+
+        if grpc_request.clustering != indexer_pb2.SearchRequest.CLUSTERING_DEFAULT:
+            k = next((x.int_val for x in grpc_request.clustering_options if x.key == "k"), 1)
+            cost += self.costs.get("cluster", 0) * k
+
+        return math.ceil(cost)
+
+    def acquire(self, grpc_request, client):
+        """
+        Returns the (counter, cost) pairs taken for a job of grpc_request, an
+        empty list for cheap jobs, or None if the job has to wait.
+        """
+
+        cost = self.estimate(grpc_request)
+
+        if cost < self.min_cost:
+            return []
+
+        client_slots = self.take(f"admission:client:{client}", self.client_capacity, cost)
+
+        if client_slots is None:
+            logger.info(f"AdmissionController::acquire {client} is at capacity")
+            return None
+
+        global_slots = self.take("admission:global", self.capacity, cost)
+
+        if global_slots is None:
+            self.release(client_slots)
+            logger.info("AdmissionController::acquire indexer is at capacity")
+            return None
+
+        return client_slots + global_slots
+
+    def bucket_keys(self, pool):
+        # buckets of the leases that have not expired yet, the current one last
+        current = int(time.time() // self.bucket_seconds)
+
+        return [f"{pool}:{x}" for x in range(current - self.buckets + 1, current + 1)]
+
+    def used(self, pool):
+        return sum(cache.get_many(self.bucket_keys(pool)).values())
+
+    def take(self, pool, capacity, cost):
+        # a job larger than the capacity takes all of it instead of never running
+        cost = min(cost, capacity)
+        keys = self.bucket_keys(pool)
+
+        try:
+            cache.incr(keys[-1], cost)
+        except ValueError:
+            # a bucket is only written while it is the current one and lives
+            # as long as the leases it counts
+            cache.add(keys[-1], 0, timeout=math.ceil(self.timeout + self.bucket_seconds))
+            cache.incr(keys[-1], cost)
+
+        # the lease is counted before the sum is read, concurrent takes may
+        # both be refused but never both be admitted over the capacity
+        if sum(cache.get_many(keys).values()) > capacity:
+            self.release([(keys[-1], cost)])
+            return None
+
+        return [(keys[-1], cost)]
+
+    def release(self, slots):
+        for key, cost in slots or ():
+            try:
+                cache.decr(key, cost)
+            except ValueError:
+                # the bucket expired together with the leases it counted
+                continue
+
+    def bind_job(self, job_id, slots):
+        if slots:
+            cache.set(f"admission:job:{job_id}", slots, timeout=self.timeout)
+
+    def release_job(self, job_id):
+        key = f"admission:job:{job_id}"
+        slots = cache.get(key)
+
+        if slots is not None and cache.delete(key):
+            self.release([tuple(x) for x in slots])
+
+
+admission = AdmissionController(
+    costs=settings.SEARCH_COSTS,
+    min_cost=settings.SEARCH_ADMISSION_MIN_COST,
+    capacity=settings.SEARCH_ADMISSION_CAPACITY,
+    client_capacity=settings.SEARCH_ADMISSION_CLIENT_CAPACITY,
+    timeout=settings.SEARCH_ADMISSION_TIMEOUT,
+    retry_after=settings.SEARCH_ADMISSION_RETRY,
+)
@@ -0,0 +1,511 @@
+import time
+import zlib
+import itertools
+import logging
+import threading
+
+from collections import OrderedDict
+
+import msgpack
+
+from django.conf import settings
+from django.core.cache import cache
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """
+    Bounded in-process cache. Entries are evicted in least recently used order
+    as soon as the summed size of all entries exceeds max_bytes.
+    """
+
+    def __init__(self, *, max_bytes: int, max_entry_bytes: int = None):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes if max_entry_bytes is not None else max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None:
+                return None
+
+            value, size, expires = entry
+
+            if expires is not None and expires < time.monotonic():
+                self._remove(key)
+                return None
+
+            self.entries.move_to_end(key)
+
+            return value
+
+    def set(self, key, value, size, timeout=None):
+        if size > self.max_entry_bytes:
+            return False
+
+        expires = None
+
+        if timeout is not None:
+            expires = time.monotonic() + timeout
+
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+            self.entries[key] = (value, size, expires)
+            self.bytes += size
+
+            while self.bytes > self.max_bytes:
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+        return True
+
+    def delete(self, key):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def _remove(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.bytes -= size
+
+
+class ResultCache:
+    """
+    Two-tier cache for search results. Values are kept unpacked in a
+    per-process LRU, next to their msgpack encoding for clients that take the
+    encoded result, and encoded and compressed in the shared django cache.
+    Errors of the shared cache count as misses.
+    """
+
+    # unpacked python objects take several times the memory of their msgpack
+    # encoding, local entries are sized by the encoding times this factor
+    OBJECT_FACTOR = 4
+
+    CODEC_NONE = b"n"
+    CODEC_ZLIB = b"d"
+    CODEC_ZSTD = b"z"
+
+    def __init__(
+        self,
+        *,
+        max_bytes: int,
+        max_entry_bytes: int = None,
+        level: int = 3,
+        local_timeout: int = None,
+    ):
+        self.local = LRUCache(max_bytes=max_bytes, max_entry_bytes=max_entry_bytes)
+        self.local_timeout = local_timeout
+        self.level = level
+        self.hits_local = 0
+        self.hits_remote = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        if zstandard is not None:
+            self.codec = self.CODEC_ZSTD
+        else:
+            self.codec = self.CODEC_ZLIB
+
+    def count(self, hits_local=0, hits_remote=0, misses=0):
+        with self.lock:
+            self.hits_local += hits_local
+            self.hits_remote += hits_remote
+            self.misses += misses
+
+    def compress(self, data):
+        if self.codec == self.CODEC_ZSTD:
+            return self.codec + zstandard.ZstdCompressor(level=self.level).compress(data)
+
+        return self.codec + zlib.compress(data, self.level)
+
+    def decompress(self, data):
+        codec, payload = data[:1], data[1:]
+
+        if codec == self.CODEC_ZSTD:
+            return zstandard.ZstdDecompressor().decompress(payload)
+
+        if codec == self.CODEC_ZLIB:
+            return zlib.decompress(payload)
+
+        if codec == self.CODEC_NONE:
+            return payload
+
+        # entries written before compression was introduced are plain msgpack
+        return data
+
+    def set_local(self, key, value, packed):
+        # value is None for entries that were only requested encoded so far
+        size = len(packed) * (self.OBJECT_FACTOR + 1)
+        self.local.set(key, (value, packed), size, timeout=self.local_timeout)
+
+    def get(self, key):
+        entry = self.local.get(key)
+
+        if entry is not None and entry[0] is not None:
+            self.count(hits_local=1)
+            return entry[0]
+
+        packed = self.get_packed(key)
+
+        if packed is None:
+            return None
+
+        value = msgpack.unpackb(packed)
+        self.set_local(key, value, packed)
+
+        return value
+
+    def get_packed(self, key):
+        """
+        Returns the msgpack encoded value without unpacking it.
+        """
+
+        entry = self.local.get(key)
+
+        if entry is not None:
+            self.count(hits_local=1)
+            return entry[1]
+
+        try:
+            data = cache.get(key)
+        except Exception as e:
+            logger.error(f"ResultCache::get_packed cache get error {e}")
+            data = None
+
+        if data is None:
+            self.count(misses=1)
+            return None
+
+        try:
+            packed = self.decompress(data)
+        except Exception as e:
+            logger.error(f"ResultCache::get_packed decode error {e}")
+            self.count(misses=1)
+            return None
+
+        self.count(hits_remote=1)
+        self.set_local(key, None, packed)
+
+        return packed
+
+    def body_key(self, key, encoding):
+        return f"{key}:body:{encoding}"
+
+    def get_body(self, key, encoding):
+        """
+        Returns the stored response body for key in the given content encoding.
+        An empty body marks a response that was too large to be stored.
+        """
+
+        try:
+            return cache.get(self.body_key(key, encoding))
+        except Exception as e:
+            logger.error(f"ResultCache::get_body cache get error {e}")
+
+        return None
+
+    def set_bodies(self, key, bodies, timeout=None):
+        for encoding, body in bodies.items():
+            try:
+                if timeout is None:
+                    cache.set(self.body_key(key, encoding), body)
+                else:
+                    cache.set(self.body_key(key, encoding), body, timeout)
+            except Exception as e:
+                logger.error(f"ResultCache::set_bodies cache set error {e}")
+
+    def stamp_key(self, key):
+        return f"{key}:stored"
+
+    def stamp(self, key, timeout=None):
+        """
+        Records when the value of key was stored, see age.
+        """
+
+        try:
+            if timeout is None:
+                cache.set(self.stamp_key(key), time.time())
+            else:
+                cache.set(self.stamp_key(key), time.time(), timeout)
+        except Exception as e:
+            logger.error(f"ResultCache::stamp cache set error {e}")
+
+    def age(self, key):
+        """
+        Returns the seconds since the value of key was stamped, or None.
+        """
+
+        try:
+            stored = cache.get(self.stamp_key(key))
+        except Exception as e:
+            logger.error(f"ResultCache::age cache get error {e}")
+            return None
+
+        if stored is None:
+            return None
+
+        return time.time() - stored
+
+    def touch(self, key, encodings=(), timeout=None):
+        """
+        Restarts the timeout of key, of its stamp and of its stored response
+        bodies in the shared cache. Returns False if key is not cached.
+        """
+
+        args = () if timeout is None else (timeout,)
+
+        try:
+            if not cache.touch(key, *args):
+                return False
+
+            cache.touch(self.stamp_key(key), *args)
+
+            for encoding in encodings:
+                cache.touch(self.body_key(key, encoding), *args)
+        except Exception as e:
+            logger.error(f"ResultCache::touch cache touch error {e}")
+            return False
+
+        return True
+
+    def get_many(self, keys):
+        values = {}
+        remote_keys = []
+
+        for key in keys:
+            entry = self.local.get(key)
+
+            if entry is None:
+                remote_keys.append(key)
+            elif entry[0] is not None:
+                values[key] = entry[0]
+            else:
+                values[key] = msgpack.unpackb(entry[1])
+                self.set_local(key, values[key], entry[1])
+
+        hits_local = len(values)
+
+        if remote_keys:
+            try:
+                remote = cache.get_many(remote_keys)
+            except Exception as e:
+                logger.error(f"ResultCache::get_many cache get error {e}")
+                remote = {}
+
+            for key, data in remote.items():
+                try:
+                    packed = self.decompress(data)
+                    value = msgpack.unpackb(packed)
+                except Exception as e:
+                    logger.error(f"ResultCache::get_many decode error {e}")
+                    continue
+
+                self.set_local(key, value, packed)
+                values[key] = value
+
+        self.count(
+            hits_local=hits_local,
+            hits_remote=len(values) - hits_local,
+            misses=len(keys) - len(values),
+        )
+
+        return values
+
+    def set(self, key, value, timeout=None):
+        packed = msgpack.packb(value)
+        self.set_local(key, value, packed)
+
+        try:
+            if timeout is None:
+                cache.set(key, self.compress(packed))
+            else:
+                cache.set(key, self.compress(packed), timeout)
+        except Exception as e:
+            logger.error(f"ResultCache::set cache set error {e}")
+
+    def delete(self, key):
+        self.local.delete(key)
+        cache.delete(key)
+
+    def delete_many(self, keys):
+        for key in keys:
+            self.local.delete(key)
+
+        cache.delete_many(keys)
+
+    def stats(self):
+        with self.lock:
+            hits_local, hits_remote, misses = self.hits_local, self.hits_remote, self.misses
+
+        lookups = hits_local + hits_remote + misses
+
+        return {
+            "lookups": lookups,
+            "hits_local": hits_local,
+            "hits_remote": hits_remote,
+            "misses": misses,
+            "hit_ratio": (hits_local + hits_remote) / lookups if lookups else 0.0,
+            "local_hit_ratio": hits_local / lookups if lookups else 0.0,
+            "evictions": self.local.evictions,
+            "entries": len(self.local.entries),
+            "bytes": self.local.bytes,
+            "max_bytes": self.local.max_bytes,
+            "codec": self.codec.decode(),
+        }
+
+
+query_image_cache = ResultCache(
+    max_bytes=settings.QUERY_IMAGE_CACHE_SIZE,
+    max_entry_bytes=settings.QUERY_IMAGE_CACHE_SIZE // 8,
+    level=settings.SEARCH_CACHE_COMPRESSION_LEVEL,
+    local_timeout=settings.QUERY_IMAGE_CACHE_TIMEOUT,
+)
+
+search_cache = ResultCache(
+    max_bytes=settings.SEARCH_CACHE_LOCAL_SIZE,
+    max_entry_bytes=settings.SEARCH_CACHE_LOCAL_SIZE // 4,
+    level=settings.SEARCH_CACHE_COMPRESSION_LEVEL,
+    local_timeout=settings.SEARCH_CACHE_LOCAL_TIMEOUT,
+)
+
+entry_cache = ResultCache(
+    max_bytes=settings.ENTRY_CACHE_LOCAL_SIZE,
+    level=settings.SEARCH_CACHE_COMPRESSION_LEVEL,
+    local_timeout=settings.ENTRY_CACHE_LOCAL_TIMEOUT,
+)
+
+# version counters, each entry has a size of one
+version_cache = LRUCache(max_bytes=settings.CACHE_VERSION_LOCAL_SIZE)
+
+
+def entry_cache_key(hash_id, fields):
+    return f"get:{hash_id}:{'+'.join(fields)}"
+
+
+def invalidate_entries(hash_ids):
+    # the field names are defined with their converters in the views, which
+    # import this module
+    from backend.views.utils import DEFAULT_FIELDS
+
+    # entries are cached once per field projection, drop all of them
+    projections = [
+        fields
+        for length in range(len(DEFAULT_FIELDS) + 1)
+        for fields in itertools.combinations(DEFAULT_FIELDS, length)
+    ]
+
+    keys = [entry_cache_key(hash_id, fields) for hash_id in hash_ids for fields in projections]
+
+    for i in range(0, len(keys), 1024):
+        entry_cache.delete_many(keys[i : i + 1024])
+
+
+def version_start():
+    # microseconds, counters are bumped by one per invalidation
+    return time.time_ns() // 1000
+
+
+def cache_version(name):
+    """
+    Returns the current value of a version counter stored in the django cache.
+    Values are kept per process for CACHE_VERSION_LOCAL_TIMEOUT seconds, bumps
+    of other processes are seen once that passed. Counters start at the
+    current time in microseconds, so a counter lost to an eviction restarts
+    above the lost value as long as that was bumped less often than once per
+    microsecond since it was created and the clocks of the hosts agree.
+    """
+
+    return cache_versions([name])[name]
+
+
+def cache_versions(names):
+    """
+    Returns the current values of several version counters with a single
+    lookup, see cache_version.
+    """
+
+    versions = {}
+
+    for name in names:
+        version = version_cache.get(name)
+
+        if version is not None:
+            versions[name] = version
+
+    keys = {f"version:{x}": x for x in names if x not in versions}
+
+    if not keys:
+        return versions
+
+    stored = cache.get_many(list(keys))
+
+    for key, name in keys.items():
+        if key not in stored:
+            cache.add(key, version_start(), timeout=None)
+            stored[key] = cache.get(key, version_start())
+
+        versions[name] = stored[key]
+        version_cache.set(name, stored[key], 1, settings.CACHE_VERSION_LOCAL_TIMEOUT)
+
+    return versions
+
+
+def collection_version_name(hash_id=None):
+    # the default index has a counter of its own
+    if hash_id is None:
+        return "collection_default"
+
+    return f"collection:{hash_id}"
+
+
+def bump_cache_version(name):
+    key = f"version:{name}"
+
+    try:
+        version = cache.incr(key)
+    except ValueError:
+        version = version_start()
+        cache.set(key, version, timeout=None)
+
+    # bumps of this process are seen at once
+    version_cache.set(name, version, 1, settings.CACHE_VERSION_LOCAL_TIMEOUT)
+
+    return version
+
+
+def invalidate_collection_access():
+    """
+    Drops the cached collection access of all users. Collection saves and
+    deletes do this through signals, bulk changes have to call it.
+    """
+
+    return bump_cache_version("collection_access")
+
+
+def invalidate_collection(hash_id=None):
+    """
+    Moves all searches that include the collection, or the default index if
+    hash_id is None, to new cache keys.
+    """
+
+    return bump_cache_version(collection_version_name(hash_id))
@@ -1,36 +1,209 @@
 import logging
 import time
 import abc
+import threading
+import collections
 
 from random import randint
-from typing import Optional, Tuple
+from typing import Dict, Optional, Tuple
 
 import grpc
 
 
 class SleepingPolicy(abc.ABC):
     @abc.abstractmethod
-    def sleep(self, try_i: int):
+    def sleep(self, try_i: int, max_sleep_ms: Optional[int] = None):
         """
         How long to sleep in milliseconds.
         :param try_i: the number of retry (starting from zero)
+        :param max_sleep_ms: upper bound for the sleep, e.g. the time left until the deadline
         """
         assert try_i >= 0
 
 
 class ExponentialBackoff(SleepingPolicy):
     def __init__(self, *, init_backoff_ms: int, max_backoff_ms: int, multiplier: int):
-        self.init_backoff = randint(0, init_backoff_ms)
+        self.init_backoff = init_backoff_ms
         self.max_backoff = max_backoff_ms
         self.multiplier = multiplier
 
-    def sleep(self, try_i: int):
-        sleep_range = min(self.init_backoff * self.multiplier ** try_i, self.max_backoff)
+    def sleep(self, try_i: int, max_sleep_ms: Optional[int] = None):
+        # full jitter, drawn for every sleep so that concurrent callers spread out
+        sleep_range = min(self.init_backoff * self.multiplier**try_i, self.max_backoff)
         sleep_ms = randint(0, sleep_range)
+
+        if max_sleep_ms is not None:
+            sleep_ms = min(sleep_ms, max_sleep_ms)
+
         logging.debug(f"Sleeping for {sleep_ms}")
         time.sleep(sleep_ms / 1000)
 
 
+class RetryBudget:
+    """
+    Process-wide limit for retries. Every call deposits ratio tokens and every
+    retry withdraws one, on top of min_per_second retries that are always
+    allowed. While the indexer is down retries are bounded by the budget
+    instead of multiplying the load by the number of attempts.
+    """
+
+    def __init__(self, *, ratio: float, min_per_second: float, max_tokens: float = None):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens if max_tokens is not None else max(10 * min_per_second, 1)
+        self.tokens = self.max_tokens
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, tokens):
+        now = time.monotonic()
+        self.tokens = min(self.max_tokens, self.tokens + tokens + (now - self.updated) * self.min_per_second)
+        self.updated = now
+
+    def deposit(self):
+        with self.lock:
+            self._refill(self.ratio)
+
+    def withdraw(self):
+        with self.lock:
+            self._refill(0)
+
+            if self.tokens < 1:
+                return False
+
+            self.tokens -= 1
+
+            return True
+
+
+class CircuitOpenError(grpc.RpcError):
+    """
+    Raised instead of calling an endpoint whose circuit is open. Behaves like
+    an UNAVAILABLE rpc error, so callers need no extra error handling.
+    """
+
+    def __init__(self, address: str, retry_after: float = 0.0):
+        super().__init__(f"Circuit for {address} is open")
+        self.address = address
+        self.retry_after = retry_after
+
+    def code(self):
+        return grpc.StatusCode.UNAVAILABLE
+
+    def details(self):
+        return str(self)
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive failures and fails calls fast
+    from then on. After reset_timeout seconds a single trial call is let
+    through; its outcome closes the circuit or keeps it open for another
+    reset_timeout.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, *, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0.0
+        self.lock = threading.Lock()
+
+    def available(self):
+        return self.state == self.CLOSED or time.monotonic() - self.opened >= self.reset_timeout
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+
+            if time.monotonic() - self.opened < self.reset_timeout:
+                return False
+
+            # let one trial call through, a trial that never reports back is
+            # replaced after another reset_timeout
+            self.state = self.HALF_OPEN
+            self.opened = time.monotonic()
+
+            return True
+
+    def retry_after(self):
+        # seconds until the next trial call is let through
+        return max(0.0, self.reset_timeout - (time.monotonic() - self.opened))
+
+    def success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened = time.monotonic()
+
+    def reset(self):
+        self.success()
+
+
+class _ClientCallDetails(
+    collections.namedtuple(
+        "_ClientCallDetails",
+        ("method", "timeout", "metadata", "credentials", "wait_for_ready", "compression"),
+    ),
+    grpc.ClientCallDetails,
+):
+    pass
+
+
+def replace_timeout(client_call_details, timeout):
+    return _ClientCallDetails(
+        client_call_details.method,
+        timeout,
+        client_call_details.metadata,
+        client_call_details.credentials,
+        getattr(client_call_details, "wait_for_ready", None),
+        getattr(client_call_details, "compression", None),
+    )
+
+
+class DeadlineClientInterceptor(grpc.UnaryUnaryClientInterceptor, grpc.StreamUnaryClientInterceptor):
+    """
+    Sets the deadline of every call that has none, looked up by method name
+    (e.g. "search") with a fallback to the "default" entry.
+    """
+
+    def __init__(self, *, deadlines: Dict[str, float]):
+        self.deadlines = deadlines
+
+    def _intercept_call(self, continuation, client_call_details, request_or_iterator):
+        if client_call_details.timeout is None:
+            method = client_call_details.method
+
+            if isinstance(method, bytes):
+                method = method.decode()
+
+            timeout = self.deadlines.get(method.rsplit("/", 1)[-1], self.deadlines.get("default"))
+
+            if timeout is not None:
+                client_call_details = replace_timeout(client_call_details, timeout)
+
+        return continuation(client_call_details, request_or_iterator)
+
+    def intercept_unary_unary(self, continuation, client_call_details, request):
+        return self._intercept_call(continuation, client_call_details, request)
+
+    def intercept_stream_unary(self, continuation, client_call_details, request_iterator):
+        return self._intercept_call(continuation, client_call_details, request_iterator)
+
+
 class RetryOnRpcErrorClientInterceptor(grpc.UnaryUnaryClientInterceptor, grpc.StreamUnaryClientInterceptor):
     def __init__(
         self,
@@ -38,12 +211,21 @@ class RetryOnRpcErrorClientInterceptor(grpc.UnaryUnaryClientInterceptor, grpc.St
         max_attempts: int,
         sleeping_policy: SleepingPolicy,
         status_for_retry: Optional[Tuple[grpc.StatusCode]] = None,
+        retry_budget: Optional[RetryBudget] = None,
     ):
         self.max_attempts = max_attempts
         self.sleeping_policy = sleeping_policy
         self.status_for_retry = status_for_retry
+        self.retry_budget = retry_budget
 
     def _intercept_call(self, continuation, client_call_details, request_or_iterator):
+        deadline = None
+
+        if client_call_details.timeout is not None:
+            deadline = time.monotonic() + client_call_details.timeout
+
+        if self.retry_budget is not None:
+            self.retry_budget.deposit()
 
         for try_i in range(self.max_attempts):
             response = continuation(client_call_details, request_or_iterator)
@@ -58,7 +240,28 @@ class RetryOnRpcErrorClientInterceptor(grpc.UnaryUnaryClientInterceptor, grpc.St
                 if self.status_for_retry and response.code() not in self.status_for_retry:
                     return response
 
-                self.sleeping_policy.sleep(try_i)
+                # Retries share one deadline, don't sleep past it
+                max_sleep_ms = None
+
+                if deadline is not None:
+                    max_sleep_ms = int((deadline - time.monotonic()) * 1000)
+
+                    if max_sleep_ms <= 0:
+                        return response
+
+                if self.retry_budget is not None and not self.retry_budget.withdraw():
+                    logging.warning(f"RetryOnRpcErrorClientInterceptor: retry budget exhausted")
+                    return response
+
+                self.sleeping_policy.sleep(try_i, max_sleep_ms)
+
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+
+                    if remaining <= 0:
+                        return response
+
+                    client_call_details = replace_timeout(client_call_details, remaining)
             else:
                 return response
 
@@ -0,0 +1,355 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import weakref
+import threading
+
+from contextlib import contextmanager
+
+import grpc
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .communication import (
+    RetryOnRpcErrorClientInterceptor,
+    DeadlineClientInterceptor,
+    ExponentialBackoff,
+    RetryBudget,
+    CircuitBreaker,
+    CircuitOpenError,
+)
+
+if settings.INDEXER_PATH is not None:
+    sys.path.append(settings.INDEXER_PATH)
+
+from iart_indexer import indexer_pb2, indexer_pb2_grpc
+
+
+logger = logging.getLogger(__name__)
+
+
+CHANNEL_OPTIONS = [
+    ("grpc.max_send_message_length", 50 * 1024 * 1024),
+    ("grpc.max_receive_message_length", 50 * 1024 * 1024),
+    # keep reconnect attempts frequent so that probes notice a replica coming back
+    ("grpc.max_reconnect_backoff_ms", 10000),
+]
+
+# status codes that point to a broken endpoint rather than to a bad request
+ENDPOINT_ERRORS = (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED)
+
+# shared by the channels of all endpoints
+retry_budget = RetryBudget(
+    ratio=settings.GRPC_RETRY_BUDGET_RATIO,
+    min_per_second=settings.GRPC_RETRY_BUDGET_MIN,
+)
+
+
+def aio_service_config(deadlines):
+    """
+    grpc.aio retries in the core instead of an interceptor, so that the backoff
+    does not block the event loop. Deadlines are set per method and the retry
+    throttling of the core takes the place of the retry budget.
+    """
+
+    service = indexer_pb2.DESCRIPTOR.services_by_name["Indexer"].full_name
+    retry_policy = {
+        "maxAttempts": 4,
+        "initialBackoff": "0.1s",
+        "maxBackoff": "1.6s",
+        "backoffMultiplier": 2,
+        "retryableStatusCodes": ["UNAVAILABLE"],
+    }
+
+    method_config = []
+
+    for method, timeout in deadlines.items():
+        if method == "default":
+            name = {}
+        else:
+            name = {"service": service, "method": method}
+
+        config = {"name": [name], "retryPolicy": retry_policy}
+
+        if timeout is not None:
+            config["timeout"] = f"{timeout}s"
+
+        method_config.append(config)
+
+    if "default" not in deadlines:
+        method_config.append({"name": [{}], "retryPolicy": retry_policy})
+
+    return {
+        "methodConfig": method_config,
+        "retryThrottling": {
+            "maxTokens": 10,
+            "tokenRatio": max(settings.GRPC_RETRY_BUDGET_RATIO, 0.001),
+        },
+    }
+
+
+class IndexerEndpoint:
+    """
+    One indexer replica. Channels are created on first use in each process,
+    a channel inherited through fork (gunicorn, celery) is not usable.
+    """
+
+    def __init__(self, address: str, *, deadlines=None, failure_threshold: int = 3, reset_timeout: float = 10.0):
+        self.address = address
+        self.deadlines = deadlines if deadlines is not None else {}
+        self.breaker = CircuitBreaker(failure_threshold=failure_threshold, reset_timeout=reset_timeout)
+        self.outstanding = 0
+        self.healthy = True
+        self.pid = None
+        self.raw_channel = None
+        self.retry_channel = None
+        self.aio_channels = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return f"IndexerEndpoint({self.address})"
+
+    @property
+    def channel(self):
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.raw_channel = grpc.insecure_channel(self.address, options=CHANNEL_OPTIONS)
+                    self.retry_channel = grpc.intercept_channel(
+                        self.raw_channel,
+                        DeadlineClientInterceptor(deadlines=self.deadlines),
+                        RetryOnRpcErrorClientInterceptor(
+                            max_attempts=4,
+                            sleeping_policy=ExponentialBackoff(init_backoff_ms=100, max_backoff_ms=1600, multiplier=2),
+                            status_for_retry=(grpc.StatusCode.UNAVAILABLE,),
+                            retry_budget=retry_budget,
+                        ),
+                    )
+                    self.pid = os.getpid()
+
+        return self.retry_channel
+
+    @property
+    def stub(self):
+        return indexer_pb2_grpc.IndexerStub(self.channel)
+
+    @property
+    def aio_stub(self):
+        # grpc.aio channels are bound to the event loop they were created in
+        loop = asyncio.get_running_loop()
+        channel = self.aio_channels.get(loop)
+
+        if channel is None:
+            channel = grpc.aio.insecure_channel(
+                self.address,
+                options=[
+                    *CHANNEL_OPTIONS,
+                    ("grpc.enable_retries", 1),
+                    ("grpc.service_config", json.dumps(aio_service_config(self.deadlines))),
+                ],
+            )
+            self.aio_channels[loop] = channel
+
+        return indexer_pb2_grpc.IndexerStub(channel)
+
+    def probe(self, timeout: float):
+        # probe the connection itself, without the retrying interceptor
+        self.channel
+        future = grpc.channel_ready_future(self.raw_channel)
+
+        try:
+            future.result(timeout=timeout)
+            return True
+        except grpc.FutureTimeoutError:
+            future.cancel()
+            return False
+
+
+class IndexerPool:
+    """
+    Spreads indexer calls over a list of replicas. Endpoints are selected
+    round robin or by the fewest outstanding requests. Each endpoint has a
+    circuit breaker that opens after failure_threshold consecutive connection
+    errors or timeouts and then fails calls fast. Endpoints that fail a health
+    probe are ejected until a probe succeeds again.
+
+    Search jobs only exist on the replica that started them, so the endpoint
+    of every job is kept in the shared cache and later calls for the job are
+    sent to the same replica.
+    """
+
+    BALANCING = ("least_outstanding", "round_robin")
+
+    def __init__(
+        self,
+        addresses,
+        *,
+        balancing: str = "least_outstanding",
+        deadlines=None,
+        failure_threshold: int = 3,
+        reset_timeout: float = 10.0,
+        probe_interval: float = 5.0,
+        probe_timeout: float = 1.0,
+        job_timeout: int = 3600,
+    ):
+        if not addresses:
+            raise ValueError("IndexerPool needs at least one endpoint")
+
+        if balancing not in self.BALANCING:
+            raise ValueError(f"Unknown balancing {balancing}")
+
+        self.endpoints = [
+            IndexerEndpoint(
+                x,
+                deadlines=deadlines,
+                failure_threshold=failure_threshold,
+                reset_timeout=reset_timeout,
+            )
+            for x in dict.fromkeys(addresses)
+        ]
+        self.addresses = {x.address: x for x in self.endpoints}
+        self.balancing = balancing
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.job_timeout = job_timeout
+        self.next = 0
+        self.probe_pid = None
+        self.lock = threading.Lock()
+
+    def select(self):
+        self.start_probes()
+
+        with self.lock:
+            # with every endpoint down, calls fail fast on the open circuits
+            endpoints = [x for x in self.endpoints if x.healthy and x.breaker.available()] or self.endpoints
+
+            if self.balancing == "round_robin":
+                self.next = (self.next + 1) % len(endpoints)
+                return endpoints[self.next]
+
+            fewest = min(x.outstanding for x in endpoints)
+
+            return random.choice([x for x in endpoints if x.outstanding == fewest])
+
+    def job_key(self, job_id):
+        return f"job_endpoint:{job_id}"
+
+    def bind_job(self, job_id, endpoint):
+        if len(self.endpoints) > 1:
+            cache.set(self.job_key(job_id), endpoint.address, timeout=self.job_timeout)
+
+    def job_endpoint(self, job_id):
+        if len(self.endpoints) > 1:
+            return self.addresses.get(cache.get(self.job_key(job_id)))
+
+        return self.endpoints[0]
+
+    def endpoint(self, job_id=None):
+        """
+        Yields the endpoint for the next call and keeps track of its outstanding
+        requests and connection errors. Calls for an existing search job have
+        to pass its job_id.
+        """
+
+        endpoint = None
+
+        if job_id is not None:
+            endpoint = self.job_endpoint(job_id)
+
+        if endpoint is None:
+            endpoint = self.select()
+
+        return self.track(endpoint)
+
+    @contextmanager
+    def track(self, endpoint):
+        if not endpoint.breaker.allow():
+            raise CircuitOpenError(endpoint.address, retry_after=endpoint.breaker.retry_after())
+
+        with self.lock:
+            endpoint.outstanding += 1
+
+        try:
+            yield endpoint
+        except grpc.RpcError as error:
+            self.record(endpoint, error.code() not in ENDPOINT_ERRORS)
+            raise
+        else:
+            self.record(endpoint, True)
+        finally:
+            with self.lock:
+                endpoint.outstanding -= 1
+
+    def record(self, endpoint, success):
+        if success:
+            endpoint.breaker.success()
+            return
+
+        was_open = endpoint.breaker.state == CircuitBreaker.OPEN
+        endpoint.breaker.failure()
+
+        if not was_open and endpoint.breaker.state == CircuitBreaker.OPEN:
+            logger.warning(f"IndexerPool::record circuit for {endpoint.address} opened")
+
+    def start_probes(self):
+        if len(self.endpoints) < 2 or not self.probe_interval or self.probe_pid == os.getpid():
+            return
+
+        with self.lock:
+            if self.probe_pid == os.getpid():
+                return
+
+            self.probe_pid = os.getpid()
+
+        threading.Thread(target=self.run_probes, name="indexer-probes", daemon=True).start()
+
+    def run_probes(self):
+        while True:
+            time.sleep(self.probe_interval)
+
+            for endpoint in self.endpoints:
+                try:
+                    self.probe(endpoint)
+                except Exception as e:
+                    logger.error(f"IndexerPool::run_probes {endpoint.address} {e}")
+
+    def probe(self, endpoint):
+        healthy = endpoint.probe(self.probe_timeout)
+
+        with self.lock:
+            if healthy and not endpoint.healthy:
+                logger.info(f"IndexerPool::probe {endpoint.address} is back")
+                endpoint.healthy = True
+            elif not healthy and endpoint.healthy:
+                logger.warning(f"IndexerPool::probe eject {endpoint.address}")
+                endpoint.healthy = False
+
+        return healthy
+
+    def stats(self):
+        return [
+            {
+                "address": x.address,
+                "healthy": x.healthy,
+                "outstanding": x.outstanding,
+                "circuit": x.breaker.state,
+                "failures": x.breaker.failures,
+            }
+            for x in self.endpoints
+        ]
+
+
+indexer_pool = IndexerPool(
+    settings.GRPC_ENDPOINTS or [f"{settings.GRPC_HOST}:{settings.GRPC_PORT}"],
+    balancing=settings.GRPC_BALANCING,
+    deadlines=settings.GRPC_DEADLINES,
+    failure_threshold=settings.GRPC_CIRCUIT_FAILURES,
+    reset_timeout=settings.GRPC_CIRCUIT_RESET,
+    probe_interval=settings.GRPC_PROBE_INTERVAL,
+    probe_timeout=settings.GRPC_PROBE_TIMEOUT,
+)
@@ -0,0 +1,129 @@
+import os
+import time
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+
+registry = CollectorRegistry()
+
+# sub-millisecond buckets for cache lookups up to the long-poll search timeout
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+request_seconds = Histogram(
+    "iart_request_seconds",
+    "Total time per request or task",
+    ["view", "cache"],
+    buckets=BUCKETS,
+    registry=registry,
+)
+
+stage_seconds = Histogram(
+    "iart_stage_seconds",
+    "Time per request or task spent in one stage",
+    ["view", "stage", "cache"],
+    buckets=BUCKETS,
+    registry=registry,
+)
+
+current_timer = ContextVar("current_timer", default=None)
+
+
+class StageTimer:
+    """
+    Sums up the time spent in each stage of one request or task. The cache
+    label is only known after the cache lookup, so all observations are
+    exported together once the request is done.
+    """
+
+    def __init__(self, view: str):
+        self.view = view
+        self.cache = "none"
+        self.stages = {}
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def observe(self):
+        for name, seconds in self.stages.items():
+            stage_seconds.labels(self.view, name, self.cache).observe(seconds)
+
+        request_seconds.labels(self.view, self.cache).observe(time.perf_counter() - self.start)
+
+
+@contextmanager
+def timed(view: str):
+    """
+    Starts a StageTimer for the current request or task. Stages are attached
+    through stage() from anywhere below, including code run by sync_to_async.
+    """
+
+    timer = StageTimer(view)
+    token = current_timer.set(timer)
+
+    try:
+        yield timer
+    finally:
+        current_timer.reset(token)
+        timer.observe()
+
+
+@contextmanager
+def stage(name: str):
+    timer = current_timer.get()
+
+    if timer is None:
+        yield
+        return
+
+    with timer.stage(name):
+        yield
+
+
+def mark_cache(hit: bool):
+    timer = current_timer.get()
+
+    if timer is not None:
+        timer.cache = "hit" if hit else "miss"
+
+
+def request_timing():
+    """
+    Returns the seconds since the start of the current request or task and its
+    cache outcome.
+    """
+
+    timer = current_timer.get()
+
+    if timer is None:
+        return None, "none"
+
+    return time.perf_counter() - timer.start, timer.cache
+
+
+def render_metrics():
+    # with several worker processes prometheus_client keeps the values in
+    # PROMETHEUS_MULTIPROC_DIR and every worker reports the merged values;
+    # celery workers only show up here if they write to the same directory
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        merged = CollectorRegistry()
+        multiprocess.MultiProcessCollector(merged)
+
+        return generate_latest(merged), CONTENT_TYPE_LATEST
+
+    return generate_latest(registry), CONTENT_TYPE_LATEST
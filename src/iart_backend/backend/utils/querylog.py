@@ -0,0 +1,59 @@
+import time
+import atexit
+import logging
+import threading
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+class QueryLog:
+    """
+    Buffers the logged searches of one process and writes them with a single
+    bulk insert once max_entries are buffered or the oldest one is max_age
+    seconds old. Entries still buffered when a process is killed are lost;
+    the log only decides which searches are kept warm.
+    """
+
+    def __init__(self, *, max_entries: int = 100, max_age: float = 10.0):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.entries = []
+        self.oldest = None
+        self.lock = threading.Lock()
+
+    def add(self, **fields):
+        with self.lock:
+            if not self.entries:
+                self.oldest = time.monotonic()
+
+            self.entries.append(fields)
+            full = len(self.entries) >= self.max_entries or time.monotonic() - self.oldest >= self.max_age
+
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            entries, self.entries = self.entries, []
+
+        if not entries:
+            return
+
+        # imported on use, the utils package does not depend on the models
+        from backend.models import SearchQuery
+
+        try:
+            SearchQuery.objects.bulk_create([SearchQuery(**x) for x in entries])
+        except Exception as e:
+            logger.error(f"QueryLog::flush {len(entries)} entries lost {e}")
+
+
+query_log = QueryLog(
+    max_entries=settings.QUERY_LOG_BUFFER_SIZE,
+    max_age=settings.QUERY_LOG_BUFFER_AGE,
+)
+
+atexit.register(query_log.flush)
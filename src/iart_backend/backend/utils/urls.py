@@ -12,14 +12,30 @@ def media_url_to_preview(id):
 
 
 def upload_url_to_image(id):
-    print(f"{settings.UPLOAD_URL}{id[0:2]}/{id[2:4]}/{id}.{settings.IMAGE_EXT}")
     return f"{settings.UPLOAD_URL}{id[0:2]}/{id[2:4]}/{id}.{settings.IMAGE_EXT}"
 
 
 def upload_url_to_preview(id):
-    print(f"{settings.UPLOAD_URL}{id[0:2]}/{id[2:4]}/{id}_m.{settings.IMAGE_EXT}")
     return f"{settings.UPLOAD_URL}{id[0:2]}/{id[2:4]}/{id}_m.{settings.IMAGE_EXT}"
 
 
+def url_templates():
+    """
+    Templates of the urls above for clients that build them from the image id.
+    {id} is replaced by the id, {id[0:2]} and {id[2:4]} by its first and second
+    pair of characters. Entries of user collections use the upload templates.
+    """
+
+    path = "{id[0:2]}/{id[2:4]}/{id}"
+
+    return {
+        "image": f"{settings.MEDIA_URL}{path}.{settings.IMAGE_EXT}",
+        "preview": f"{settings.MEDIA_URL}{path}_m.{settings.IMAGE_EXT}",
+        "upload_image": f"{settings.UPLOAD_URL}{path}.{settings.IMAGE_EXT}",
+        # uploads have no preview of their own, the image is used instead
+        "upload_preview": f"{settings.UPLOAD_URL}{path}.{settings.IMAGE_EXT}",
+    }
+
+
 def upload_path_to_image(id):
     return os.path.join(settings.UPLOAD_ROOT, id[0:2], id[2:4], f"{id}.{settings.IMAGE_EXT}")
@@ -0,0 +1,73 @@
+import base64
+
+import numpy as np
+
+
+VECTOR_DTYPES = {
+    "float16": np.float16,
+    "float32": np.float32,
+}
+
+
+def encode_buffer(values, dtype="float32"):
+    """
+    Encodes a flat numeric array as base64 little-endian buffer of the given dtype.
+    """
+
+    buffer = np.asarray(values, dtype=np.dtype(VECTOR_DTYPES[dtype]).newbyteorder("<"))
+
+    return {
+        "dtype": dtype,
+        "byteorder": "little",
+        "length": len(buffer),
+        "data": base64.b64encode(buffer.tobytes()).decode(),
+    }
+
+
+def is_vector(value):
+    return (
+        isinstance(value, list)
+        and len(value) > 0
+        and all(isinstance(x, (int, float)) and not isinstance(x, bool) for x in value)
+    )
+
+
+def pack_vectors(entries, keys=("feature", "coordinates"), dtype="float32"):
+    """
+    Moves all numeric lists below the given entry keys into one contiguous buffer.
+    Every list is replaced by a {"offset", "length"} reference into the buffer,
+    counted in elements. Returns the new entries and the encoded buffer.
+    """
+
+    chunks = []
+    offset = 0
+
+    def replace(value):
+        nonlocal offset
+
+        if is_vector(value):
+            reference = {"offset": offset, "length": len(value)}
+            chunks.append(value)
+            offset += len(value)
+
+            return reference
+
+        if isinstance(value, dict):
+            return {k: replace(v) for k, v in value.items()}
+
+        if isinstance(value, list):
+            return [replace(v) for v in value]
+
+        return value
+
+    packed_entries = []
+
+    for entry in entries:
+        packed_entries.append({**entry, **{k: replace(entry[k]) for k in keys if k in entry}})
+
+    if chunks:
+        buffer = np.concatenate([np.asarray(x, dtype=VECTOR_DTYPES[dtype]) for x in chunks])
+    else:
+        buffer = np.zeros(0, dtype=VECTOR_DTYPES[dtype])
+
+    return packed_entries, encode_buffer(buffer, dtype)
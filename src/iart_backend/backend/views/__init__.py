@@ -1,6 +1,7 @@
-from .get import Get
-from .search import Search
+from .get import Get, GetMany
+from .search import Search, SearchCacheStats
 from .upload import Upload
 from .user import get_csrf_token, Login, Logout, Register, User
 from .bookmark import BookmarkAdd, BookmarkRemove, BookmarkList
 from .collection import CollectionAdd, CollectionRemove, CollectionList
+from .metrics import metrics
@@ -0,0 +1,216 @@
+import json
+import asyncio
+import logging
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import status
+from rest_framework.authentication import SessionAuthentication
+from rest_framework.exceptions import APIException
+from rest_framework.settings import api_settings
+from backend.utils import indexer_pool, timed, stage
+from backend.renderers import (
+    PackedResult,
+    EncodedBody,
+    encoded_response,
+    accepts_msgpack,
+    dumps_json,
+    dumps_msgpack,
+    JSON_MEDIA_TYPE,
+    MSGPACK_MEDIA_TYPE,
+)
+
+from .get import Get, GetMany
+from .search import Search
+from .collection import CollectionRemove
+from .utils import IndexerCall, Gather, Sleep, Offload, advance
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncRPCView(View):
+    """
+    Base class for views served under ASGI. They run the flows of the sync
+    views and only differ in how the steps are done: indexer calls are
+    awaited on the grpc.aio channels of the pool, database and cache access
+    between them runs through sync_to_async.
+    """
+
+    indexer = indexer_pool
+    # view label of the latency metrics
+    metrics_name = None
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # same csrf handling as the rest framework views: only session
+        # authenticated requests have to carry a token
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def dispatch(self, request, *args, **kwargs):
+        with timed(self.metrics_name or type(self).__name__.lower()):
+            return await self.dispatch_timed(request, *args, **kwargs)
+
+    async def dispatch_timed(self, request, *args, **kwargs):
+        try:
+            user = await request.auser()
+
+            if user.is_authenticated:
+                SessionAuthentication().enforce_csrf(request)
+
+            response = super().dispatch(request, *args, **kwargs)
+
+            if asyncio.iscoroutine(response):
+                response = await response
+
+            return response
+        except Exception as exc:
+            response = await sync_to_async(self.handle_exception)(exc)
+
+            # the body is rendered with the negotiated format below
+            headers = {k: v for k, v in response.items() if k.lower() != "content-type"}
+
+            return self.render(response.data, status=response.status_code, headers=headers)
+
+    def handle_exception(self, exc):
+        # errors get the same body and headers as in the rest framework views
+        context = {"view": self, "args": self.args, "kwargs": self.kwargs, "request": self.request}
+        response = api_settings.EXCEPTION_HANDLER(exc, context)
+
+        if response is None:
+            raise exc
+
+        return response
+
+    def parse_params(self, request):
+        try:
+            with stage("parse"):
+                return json.loads(request.body or b"{}").get("params", {})
+        except ValueError:
+            raise APIException("unknown_error")
+
+    def render(self, data, **kwargs):
+        with stage("render"):
+            if isinstance(data, EncodedBody):
+                return encoded_response(data, **kwargs)
+
+            if isinstance(data, PackedResult) or accepts_msgpack(self.request):
+                return HttpResponse(dumps_msgpack(data), content_type=MSGPACK_MEDIA_TYPE, **kwargs)
+
+            return HttpResponse(dumps_json(data), content_type=JSON_MEDIA_TYPE, **kwargs)
+
+    async def run_flow(self, flow):
+        value, error = None, None
+
+        while True:
+            done, step = await sync_to_async(advance)(flow, value, error)
+
+            if done:
+                return step
+
+            value, error = None, None
+
+            try:
+                value = await self.run_step(step)
+            except Exception as e:
+                error = e
+
+    async def run_step(self, step):
+        if isinstance(step, IndexerCall):
+            with stage("grpc"):
+                return await self.call_indexer(step)
+
+        if isinstance(step, Gather):
+            semaphore = asyncio.Semaphore(step.limit)
+
+            async def call_indexer(call):
+                async with semaphore:
+                    return await self.try_call_indexer(call)
+
+            # the lookups overlap, they are timed as a whole
+            with stage("grpc"):
+                return await asyncio.gather(*[call_indexer(x) for x in step.calls])
+
+        if isinstance(step, Sleep):
+            with stage("wait"):
+                await asyncio.sleep(step.seconds)
+
+            return None
+
+        if isinstance(step, Offload):
+            # CPU bound work runs outside of the thread that serves the database
+            return await sync_to_async(step.fn, thread_sensitive=False)(*step.args)
+
+        raise ValueError(f"Unknown flow step {step}")
+
+    async def call_indexer(self, call):
+        endpoint = None
+
+        if call.job_id is not None:
+            endpoint = await sync_to_async(self.indexer.job_endpoint)(call.job_id)
+
+        with self.indexer.track(endpoint or self.indexer.select()) as endpoint:
+            call.endpoint = endpoint
+
+            return await getattr(endpoint.aio_stub, call.method)(call.request)
+
+    async def try_call_indexer(self, call):
+        try:
+            return await self.call_indexer(call)
+        except Exception as e:
+            return e
+
+
+class AsyncSearch(AsyncRPCView):
+    metrics_name = "search"
+
+    async def post(self, request, format=None):
+        params = self.parse_params(request)
+        user = await request.auser()
+        renderer_format = "msgpack" if accepts_msgpack(request) else "json"
+
+        # a search keeps per request state on its view
+        flow = Search().search_flow(request, params, user, renderer_format, settings.SEARCH_WAIT_TIMEOUT)
+
+        return self.render(await self.run_flow(flow))
+
+
+class AsyncGet(AsyncRPCView):
+    get_view = Get()
+    metrics_name = "get"
+
+    async def get_response(self, request, params):
+        data, headers = await self.run_flow(self.get_view.get_flow(request, params))
+
+        if data is None:
+            return HttpResponse(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        return self.render(data, headers=headers)
+
+    async def get(self, request, format=None):
+        return await self.get_response(request, self.get_view.query_params(request.GET))
+
+    async def post(self, request, format=None):
+        return await self.get_response(request, self.parse_params(request))
+
+
+class AsyncGetMany(AsyncRPCView):
+    get_view = GetMany()
+    metrics_name = "get_many"
+
+    async def post(self, request, format=None):
+        return self.render(await self.run_flow(self.get_view.get_many_flow(self.parse_params(request))))
+
+
+class AsyncCollectionRemove(AsyncRPCView):
+    remove_view = CollectionRemove()
+    metrics_name = "collection_remove"
+
+    async def post(self, request, format=None):
+        user = await request.auser()
+        await self.run_flow(self.remove_view.remove_flow(self.parse_params(request), user))
+
+        return self.render({})
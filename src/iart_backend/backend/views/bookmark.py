@@ -56,9 +56,9 @@ class BookmarkList(APIView):
         if not request.user.is_authenticated:
             raise APIException("not_authenticated")
 
-        image_user = ImageUserRelation.objects.filter(
+        image_ids = ImageUserRelation.objects.filter(
             user=request.user,
             library=True,
-        )
+        ).values_list("image__hash_id", flat=True)
 
-        return Response([{"id": x.image.hash_id} for x in image_user])
+        return Response([{"id": x} for x in image_ids])
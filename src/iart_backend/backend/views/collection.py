@@ -3,7 +3,6 @@ import csv
 import sys
 import json
 import uuid
-import grpc
 import imageio
 import logging
 import zipfile
@@ -11,11 +10,10 @@ import tarfile
 import traceback
 import dateutil.parser
 
-from .utils import RPCView
+from .utils import RPCView, IndexerCall
 from pathlib import Path
 from urllib.parse import urlparse
 from django.conf import settings
-from django.db.models import Count
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.exceptions import APIException
@@ -26,12 +24,15 @@ from backend.utils import (
     download_file,
     check_extension,
     unflat_dict,
+    invalidate_entries,
+    invalidate_collection,
+    CircuitOpenError,
 )
 
 if settings.INDEXER_PATH is not None:
     sys.path.append(settings.INDEXER_PATH)
 
-from iart_indexer import indexer_pb2, indexer_pb2_grpc
+from iart_indexer import indexer_pb2
 
 
 logger = logging.getLogger(__name__)
@@ -339,7 +340,7 @@ class CollectionList(APIView):
             raise APIException("not_authenticated")
 
         try:
-            user_collections = Collection.objects.filter(user=request.user).annotate(count=Count("image"))
+            user_collections = Collection.objects.filter(user=request.user)
 
             collections = [
                 {
@@ -348,7 +349,7 @@ class CollectionList(APIView):
                     "status": collection.status,
                     "progress": collection.progress,
                     "date": collection.date,
-                    "count": collection.count,
+                    "count": collection.image_count,
                 }
                 for collection in user_collections
             ]
@@ -361,43 +362,62 @@ class CollectionList(APIView):
 
 
 class CollectionRemove(RPCView):
-    def post(self, request, format=None):
-        if not request.user.is_authenticated:
+    metrics_name = "collection_remove"
+
+    def remove_collection(self, hash_id, user):
+        # only the owner may remove a collection
+        collection = Collection.objects.get(hash_id=hash_id, user=user)
+        images = Image.objects.filter(collection=collection)
+
+        for image in images.values("hash_id"):
+            for res in settings.IMAGE_RESOLUTIONS:
+                suffix = res.get("suffix", "")
+                image_hash_id = image["hash_id"]
+
+                image_output_file = os.path.join(
+                    settings.UPLOAD_ROOT,
+                    image_hash_id[0:2],
+                    image_hash_id[2:4],
+                    f"{image_hash_id}{suffix}.{settings.IMAGE_EXT}",
+                )
+
+                if os.path.exists(image_output_file):
+                    os.remove(image_output_file)
+
+        image_ids = list(images.values_list("hash_id", flat=True))
+
+        images.delete()
+        collection.delete()
+
+        return image_ids
+
+    def remove_flow(self, params, user):
+        if not user.is_authenticated:
             raise APIException("not_authenticated")
 
-        hash_id = request.data["params"].get("hash_id")
+        hash_id = params.get("hash_id")
 
         if hash_id is None:
             raise APIException("unknown_error")
 
         try:
-            collection = Collection.objects.get(hash_id=hash_id)
-            images = Image.objects.filter(collection=collection)
+            image_ids = self.remove_collection(hash_id, user)
 
-            for image in images.values("hash_id"):
-                for res in settings.IMAGE_RESOLUTIONS:
-                    suffix = res.get("suffix", "")
-                    hash_id = image["hash_id"]
+            # the rows are gone whatever the indexer answers
+            invalidate_entries(image_ids)
+            invalidate_collection(hash_id)
 
-                    image_output_file = os.path.join(
-                        settings.UPLOAD_ROOT,
-                        hash_id[0:2],
-                        hash_id[2:4],
-                        f"{hash_id}{suffix}.{settings.IMAGE_EXT}",
-                    )
+            yield IndexerCall("collection_delete", indexer_pb2.CollectionDeleteRequest(id=hash_id))
 
-                    if os.path.exists(image_output_file):
-                        os.remove(image_output_file)
-
-            images.delete()
-            collection.delete()
-
-            stub = indexer_pb2_grpc.IndexerStub(self.channel)
-            request = indexer_pb2.CollectionDeleteRequest(id=hash_id)
-            response = stub.collection_delete(request)
-
-            return Response()
+            return
+        except CircuitOpenError:
+            raise
         except Exception as error:
             logger.error(traceback.format_exc())
 
         raise APIException("unknown_error")
+
+    def post(self, request, format=None):
+        self.run_flow(self.remove_flow(request.data["params"], request.user))
+
+        return Response()
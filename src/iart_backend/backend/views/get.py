@@ -1,11 +1,15 @@
-import os
 import sys
 import grpc
+import time
+import msgpack
+import hashlib
 import logging
 
-from .utils import RPCView
+from .utils import RPCView, IndexerCall, Gather, DEFAULT_FIELDS, parse_fields, entry_fields_from_proto
 from django.conf import settings
 from django.conf import settings as DjangoSettings
+from django.utils.http import http_date, parse_http_date_safe, parse_etags
+from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.exceptions import APIException
 from backend.models import UploadedImage, ImageUserRelation
@@ -14,81 +18,222 @@ from backend.utils import (
     media_url_to_preview,
     upload_url_to_image,
     upload_url_to_preview,
+    entry_cache,
+    entry_cache_key,
+    stage,
+    mark_cache,
+    CircuitOpenError,
 )
 
 if DjangoSettings.INDEXER_PATH is not None:
     sys.path.append(DjangoSettings.INDEXER_PATH)
 
 
-from iart_indexer import indexer_pb2, indexer_pb2_grpc
-from iart_indexer.utils import (
-    meta_from_proto,
-    classifier_from_proto,
-    feature_from_proto,
-)
+from iart_indexer import indexer_pb2
 
 logger = logging.getLogger(__name__)
 
 
 class Get(RPCView):
+    metrics_name = "get"
+
     def parse_request(self, params):
         return indexer_pb2.GetRequest(id=params["id"])
 
-    def rpc_get(self, params):
+    def entry_record(self, entry, modified):
+        # entries are cached together with the validators of the response
+        return {
+            "entry": entry,
+            "modified": int(modified),
+            "etag": hashlib.sha256(msgpack.packb(entry)).hexdigest()[:32],
+        }
+
+    def rpc_get(self, params, fields=DEFAULT_FIELDS):
+        record = self.rpc_get_record(params, fields)
+
+        if record is not None:
+            return {"entry": record["entry"]}
+
+    def record_from_proto(self, response, fields=DEFAULT_FIELDS):
+        entry = {
+            "id": response.id,
+            **entry_fields_from_proto(response, fields),
+            "path": media_url_to_image(response.id),
+            "preview": media_url_to_preview(response.id),
+        }
+
+        return self.entry_record(entry, time.time())
+
+    def rpc_get_record(self, params, fields=DEFAULT_FIELDS):
         grpc_request = self.parse_request(params)
-        stub = indexer_pb2_grpc.IndexerStub(self.channel)
-
-        try:
-            response = stub.get(grpc_request)
-
-            return {
-                "entry": {
-                    "id": response.id,
-                    "meta": meta_from_proto(response.meta),
-                    "origin": meta_from_proto(response.origin),
-                    "classifier": classifier_from_proto(response.classifier),
-                    "feature": feature_from_proto(response.feature),
-                    "path": media_url_to_image(response.id),
-                    "preview": media_url_to_preview(response.id),
-                },
-            }
-
-        except grpc.RpcError as error:
-            pass
+        records = self.run_flow(self.indexer_records_flow([grpc_request.id], fields))
 
-    def post(self, request, format=None):
-        result = self.rpc_get(request.data["params"])
+        return records.get(grpc_request.id)
+
+    def indexer_records_flow(self, hash_ids, fields=DEFAULT_FIELDS):
+        calls = [IndexerCall("get", indexer_pb2.GetRequest(id=x)) for x in hash_ids]
+        responses = yield Gather(calls, settings.GET_MANY_WORKERS)
+        records = {}
+
+        for hash_id, response in zip(hash_ids, responses):
+            if isinstance(response, CircuitOpenError):
+                raise response
+
+            if isinstance(response, grpc.RpcError):
+                # not in the index, e.g. an uploaded image
+                continue
 
-        if result is not None:
-            return Response(result)
+            if isinstance(response, Exception):
+                raise response
 
-        try:
-            hash_id = request.data["params"].get("id")
-            image_db = UploadedImage.objects.get(hash_id=hash_id)
+            with stage("convert"):
+                record = self.record_from_proto(response, fields)
 
-            image_path = os.path.join(
-                settings.UPLOAD_ROOT,
-                image_db.hash_id[0:2],
-                image_db.hash_id[2:4],
-                f"{image_db.hash_id}.jpg",
-            )
+            with stage("cache"):
+                entry_cache.set(entry_cache_key(hash_id, fields), record)
 
-            return Response(
+            records[hash_id] = record
+
+        return records
+
+    def upload_entry(self, image_db):
+        return {
+            "id": image_db.hash_id,
+            "meta": [
                 {
-                    "entry": {
-                        "id": hash_id,
-                        "meta": [
-                            {
-                                "name": "title",
-                                "value_str": image_db.name,
-                            }
-                        ],
-                        "path": upload_url_to_image(hash_id),
-                        "preview": upload_url_to_image(hash_id),
-                    },
+                    "name": "title",
+                    "value_str": image_db.name,
                 }
-            )
-        except UploadedImage.DoesNotExist:
-            pass
+            ],
+            "path": upload_url_to_image(image_db.hash_id),
+            "preview": upload_url_to_image(image_db.hash_id),
+        }
+
+    def get_records(self, hash_ids, fields=DEFAULT_FIELDS):
+        return self.run_flow(self.records_flow(hash_ids, fields))
+
+    def records_flow(self, hash_ids, fields=DEFAULT_FIELDS):
+        keys = {entry_cache_key(hash_id, fields): hash_id for hash_id in hash_ids}
+
+        with stage("cache"):
+            records = {keys[k]: v for k, v in entry_cache.get_many(list(keys)).items()}
+
+        missing_ids = [x for x in hash_ids if x not in records]
+        mark_cache(not missing_ids)
+
+        if missing_ids:
+            records.update((yield from self.indexer_records_flow(missing_ids, fields)))
+
+        missing_ids = [x for x in missing_ids if x not in records]
+
+        if missing_ids:
+            with stage("db"):
+                records.update(self.upload_records(missing_ids))
+
+        return records
+
+    def upload_records(self, hash_ids):
+        return {
+            image_db.hash_id: self.entry_record(self.upload_entry(image_db), image_db.date.timestamp())
+            for image_db in UploadedImage.objects.filter(hash_id__in=hash_ids)
+        }
+
+    def not_modified(self, request, etag, modified):
+        if_none_match = request.headers.get("If-None-Match")
+
+        if if_none_match is not None:
+            etags = parse_etags(if_none_match)
+            return "*" in etags or etag in etags
+
+        if_modified_since = parse_http_date_safe(request.headers.get("If-Modified-Since", ""))
+
+        return if_modified_since is not None and modified <= if_modified_since
+
+    def get_flow(self, request, params):
+        """
+        Returns the response data and headers, or None as data if the client's
+        copy is still valid; shared by the sync and the async view.
+        """
+
+        fields = parse_fields(params)
+        hash_id = params.get("id")
+
+        if hash_id is None:
+            raise APIException("unknown_resource")
+
+        records = yield from self.records_flow([hash_id], fields)
+
+        if hash_id not in records:
+            raise APIException("unknown_resource")
+
+        record = records[hash_id]
+        headers = self.validator_headers(record)
+
+        if self.not_modified(request, headers["ETag"], record["modified"]):
+            return None, headers
+
+        return {"entry": record["entry"]}, headers
+
+    def get_response(self, request, params):
+        data, headers = self.run_flow(self.get_flow(request, params))
+
+        if data is None:
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        return Response(data, headers=headers)
+
+    def validator_headers(self, record):
+        return {
+            "ETag": f'"{record["etag"]}"',
+            "Last-Modified": http_date(record["modified"]),
+            "Cache-Control": "private, no-cache",
+        }
+
+    def query_params(self, query_params):
+        params = {"id": query_params.get("id")}
+        fields = [x for f in query_params.getlist("fields") for x in f.split(",") if x]
+
+        if fields:
+            params["fields"] = fields
+
+        return params
+
+    def get(self, request, format=None):
+        return self.get_response(request, self.query_params(request.query_params))
+
+    def post(self, request, format=None):
+        with stage("parse"):
+            params = request.data["params"]
+
+        return self.get_response(request, params)
+
+
+class GetMany(Get):
+    metrics_name = "get_many"
+
+    def get(self, request, format=None):
+        return self.http_method_not_allowed(request)
+
+    def get_many_flow(self, params):
+        fields = parse_fields(params)
+        hash_ids = params.get("ids")
+
+        if not isinstance(hash_ids, list) or not all(isinstance(x, str) for x in hash_ids):
+            raise APIException("unknown_resource")
+
+        if len(hash_ids) > settings.GET_MANY_MAX_IDS:
+            raise APIException("too_many_ids")
+
+        hash_ids = list(dict.fromkeys(hash_ids))
+        records = yield from self.records_flow(hash_ids, fields)
+
+        return {
+            "entries": [records[x]["entry"] for x in hash_ids if x in records],
+            "missing": [x for x in hash_ids if x not in records],
+        }
+
+    def post(self, request, format=None):
+        with stage("parse"):
+            params = request.data["params"]
 
-        raise APIException("unknown_resource")
+        return Response(self.run_flow(self.get_many_flow(params)))
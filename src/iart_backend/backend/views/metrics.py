@@ -0,0 +1,28 @@
+import hmac
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.views.decorators.http import require_GET
+from backend.utils import render_metrics
+
+
+def metrics_allowed(request):
+    if request.user.is_authenticated and request.user.is_staff:
+        return True
+
+    if not settings.METRICS_TOKEN:
+        return False
+
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+
+    return scheme.lower() == "bearer" and hmac.compare_digest(token.encode(), settings.METRICS_TOKEN.encode())
+
+
+@require_GET
+def metrics(request):
+    if not metrics_allowed(request):
+        return HttpResponseForbidden()
+
+    data, content_type = render_metrics()
+
+    return HttpResponse(data, content_type=content_type)
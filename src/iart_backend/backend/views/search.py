@@ -1,42 +1,103 @@
 import os
 import sys
 import grpc
-import msgpack
+import time
+import imageio
 import hashlib
 import logging
-
-from .utils import RPCView
+import itertools
+
+import numpy as np
+
+from .utils import (
+    RPCView,
+    IndexerCall,
+    Sleep,
+    Offload,
+    DEFAULT_FIELDS,
+    parse_fields,
+    fields_key,
+    entry_fields_from_proto,
+)
 from django.conf import settings as DjangoSettings
-from django.db.models import Count
+from django.db.models import Q
 from django.core.cache import cache
+from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.exceptions import APIException
+from rest_framework.exceptions import APIException, Throttled
+from rest_framework.throttling import BaseThrottle
 from backend.models import Image, ImageUserRelation, Collection
+from backend.renderers import PackedResult, EncodedBody, encoded_response, body_encodings, preferred_encoding
+from backend.tasks import cache_search_bodies
 from backend.utils import (
     media_url_to_preview,
     media_url_to_image,
     upload_url_to_preview,
     upload_url_to_image,
+    url_templates,
+    image_normalize,
+    image_resize,
+    search_cache,
+    admission,
+    pack_vectors,
+    encode_buffer,
+    VECTOR_DTYPES,
+    cache_version,
+    cache_versions,
+    collection_version_name,
+    query_image_cache,
+    stage,
+    mark_cache,
+    request_timing,
+    query_log,
+    CircuitOpenError,
 )
 
 if DjangoSettings.INDEXER_PATH is not None:
     sys.path.append(DjangoSettings.INDEXER_PATH)
 
 
-from iart_indexer import indexer_pb2, indexer_pb2_grpc
-from iart_indexer.utils import (
-    meta_from_proto,
-    classifier_from_proto,
-    feature_from_proto,
-    suggestions_from_proto,
-)
+from iart_indexer import indexer_pb2
+from iart_indexer.utils import suggestions_from_proto
 
 from google.protobuf.json_format import MessageToJson
 
 logger = logging.getLogger(__name__)
 
+# the columnar format and results without per-entry urls are converted and
+# cached like field projections of their own
+COLUMNS = ("columns",)
+URL_TEMPLATES = "url_templates"
+
+
+def parse_format(params):
+    result_format = params.get("format", "entries")
+
+    if result_format == "columns":
+        return COLUMNS
+
+    if result_format != "entries":
+        raise APIException("unknown_format")
+
+    urls = params.get("urls", "entries")
+
+    if urls == "templates":
+        return (*parse_fields(params), URL_TEMPLATES)
+
+    if urls != "entries":
+        raise APIException("unknown_urls")
+
+    return parse_fields(params)
+
 
 class Search(RPCView):
+    metrics_name = "search"
+    admission = admission
+    # canonical request and hash of the current search, for the query log
+    logged_request = None
+    # user or address whose jobs share one admission capacity
+    client = None
+
     def parse_search_request(self, params, ids=None, collection_ids=None):
         grpc_request = indexer_pb2.SearchRequest()
 
@@ -107,18 +168,15 @@ class Search(RPCView):
                 else:
                     term.text.flag = indexer_pb2.NumberSearchTerm.NOT
 
-        print(f"Search Collections: {user_collection_ids} {collection_ids}", flush=True)
+        logger.debug(f"Search::parse_search_request collections:{user_collection_ids} {collection_ids}")
+
         if user_collection_ids:
             grpc_request.collections.extend(list(user_collection_ids))
-
-            print(f"Search Collections: A", flush=True)
         elif collection_ids is not None:
             grpc_request.collections.extend(collection_ids)
             grpc_request.include_default_collection = True
-            print(f"Search Collections: B", flush=True)
         else:
             grpc_request.include_default_collection = True
-            print(f"Search Collections: C", flush=True)
 
         for v in params.get("full_text", []):
             term = grpc_request.terms.add()
@@ -179,54 +237,10 @@ class Search(RPCView):
                 elif q.get("type") == "idx":
                     term = grpc_request.terms.add()
 
-                    image_id = q["value"]
-                    roi_defined = False
-
-                    if q.get("roi"):
-                        roi = q.get("roi")
-                        roi_defined = True
-
-                        term.feature.image.roi.x = roi.get("x")
-                        term.feature.image.roi.y = roi.get("y")
-                        term.feature.image.roi.width = roi.get("width")
-                        term.feature.image.roi.height = roi.get("height")
-
-                    image_path = os.path.join(
-                        DjangoSettings.UPLOAD_ROOT,
-                        image_id[0:2],
-                        image_id[2:4],
-                        f"{image_id}.jpg",
-                    )
-
-                    if os.path.exists(image_path):
-                        with open(image_path, "rb") as f:
-                            term.feature.image.encoded = f.read()
-                    else:
-                        # resubmit image from index
-                        if roi_defined:
-                            image_path = os.path.join(
-                                DjangoSettings.MEDIA_ROOT,
-                                image_id[0:2],
-                                image_id[2:4],
-                                f"{image_id}.jpg",
-                            )
-
-                            if os.path.exists(image_path):
-                                with open(image_path, "rb") as f:
-                                    term.feature.image.encoded = f.read()
-                        else:
-                            term.feature.image.id = q["value"]
-
                     if q.get("weights"):
-                        for k, v in q["weights"].items():
-                            plugins = term.feature.plugins.add()
-                            plugins.name = k.lower()
-                            plugins.weight = v
+                        self.build_image_query(term.feature, q["value"], q.get("roi"), q["weights"])
                     else:
-                        for k, v in weights.items():
-                            plugins = term.feature.plugins.add()
-                            plugins.name = k.lower()
-                            plugins.weight = v
+                        self.build_image_query(term.feature, q["value"], q.get("roi"), weights)
 
                     if q.get("positive", True):
                         term.feature.flag = indexer_pb2.ImageTextSearchTerm.POSITIVE
@@ -241,128 +255,608 @@ class Search(RPCView):
 
         return grpc_request
 
-    def rpc_load(self, params, ids=None, collection_ids=None, user=None):
-        grpc_request = self.parse_search_request(
-            params,
-            ids=ids,
-            collection_ids=collection_ids,
+    def build_image_query(self, feature_term, image_id, roi, weights):
+        plugins = tuple(sorted((k.lower(), v) for k, v in weights.items()))
+
+        if roi:
+            roi = (roi.get("x"), roi.get("y"), roi.get("width"), roi.get("height"))
+
+        # the finished term is shared by all workers, so that refinements of an
+        # image search read and shrink the query image only once
+        cache_key = "query_image:" + hashlib.sha256(repr((image_id, roi or None, plugins)).encode()).hexdigest()
+        cached = query_image_cache.get(cache_key)
+
+        if cached is not None:
+            feature_term.MergeFromString(cached)
+            return
+
+        if roi:
+            feature_term.image.roi.x = roi[0]
+            feature_term.image.roi.y = roi[1]
+            feature_term.image.roi.width = roi[2]
+            feature_term.image.roi.height = roi[3]
+
+        encoded = self.read_query_image(image_id, roi)
+
+        if encoded is not None:
+            feature_term.image.encoded = encoded
+        else:
+            # images of the index are sent by id, the indexer uses their
+            # stored features instead of extracting them again
+            feature_term.image.id = image_id
+
+        for name, weight in plugins:
+            plugin = feature_term.plugins.add()
+            plugin.name = name
+            plugin.weight = weight
+
+        if roi and encoded is None:
+            # the region needs the image file, which is missing right now
+            logger.warning(f"Search::build_image_query no image file for roi of {image_id}")
+            return
+
+        query_image_cache.set(
+            cache_key,
+            feature_term.SerializeToString(),
+            timeout=DjangoSettings.QUERY_IMAGE_CACHE_TIMEOUT,
         )
-        logger.info(f"Search::rpc_load parse_search_request:'{MessageToJson(grpc_request)}'")
 
-        for collection_id in grpc_request.collections:
-            try:
-                collection_db = Collection.objects.get(hash_id = collection_id)
-            except Collection.DoesNotExist:
-                logger.error(f"Search::rpc_load collection is not known")
-                return None
+    def read_query_image(self, image_id, roi):
+        """
+        Returns the encoded query image, or None if the indexer can look the
+        image up by its id. Uploads are always read; images of the index only
+        if a region of them is searched.
+        """
+
+        roots = [DjangoSettings.UPLOAD_ROOT]
+
+        if roi:
+            roots.append(DjangoSettings.MEDIA_ROOT)
+
+        for root in roots:
+            image_path = os.path.join(root, image_id[0:2], image_id[2:4], f"{image_id}.jpg")
+
+            if os.path.exists(image_path):
+                with open(image_path, "rb") as f:
+                    encoded = f.read()
+
+                # region coordinates refer to the stored image, so it is only
+                # shrunk if the whole image is searched
+                if not roi:
+                    encoded = self.shrink_query_image(encoded)
+
+                return encoded
+
+        return None
+
+    def shrink_query_image(self, encoded):
+        # feature extractors work on small inputs, sending the stored
+        # resolution only makes the request larger
+        max_dim = DjangoSettings.QUERY_IMAGE_MAX_DIM
+
+        if max_dim is None:
+            return encoded
+
+        try:
+            image = image_normalize(imageio.imread(encoded))
+
+            if max(image.shape[:2]) <= max_dim:
+                return encoded
+
+            return imageio.imwrite("<bytes>", image_resize(image, max_dim=max_dim), format="jpg")
+        except Exception as e:
+            logger.error(f"Search::shrink_query_image exception:'{e}'")
+
+        return encoded
+
+    def canonicalize_search_request(self, grpc_request):
+        def canonicalize_messages(field):
+            serialized = sorted(set(x.SerializeToString(deterministic=True) for x in field))
+
+            del field[:]
+
+            for x in serialized:
+                field.add().ParseFromString(x)
+
+        def canonicalize_values(field):
+            values = sorted(set(field))
+
+            del field[:]
+            field.extend(values)
+
+        for term in grpc_request.terms:
+            if term.HasField("image_text"):
+                canonicalize_messages(term.image_text.plugins)
+
+            if term.HasField("feature"):
+                canonicalize_messages(term.feature.plugins)
+
+        canonicalize_messages(grpc_request.terms)
+        canonicalize_messages(grpc_request.mapping_options)
+        canonicalize_messages(grpc_request.clustering_options)
+        canonicalize_values(grpc_request.collections)
+        canonicalize_values(grpc_request.ids)
+
+        # reading aggregate.fields would add an empty aggregate to the request
+        if grpc_request.HasField("aggregate"):
+            canonicalize_values(grpc_request.aggregate.fields)
+
+        return grpc_request
+
+    def search_request_key(self, grpc_request):
+        # the collection list is the only part of a request that depends on the
+        # user, all other fields are hashed separately and shared between users
+        shared_request = indexer_pb2.SearchRequest()
+        shared_request.CopyFrom(grpc_request)
+        del shared_request.collections[:]
+
+        shared_hash = hashlib.sha256(shared_request.SerializeToString(deterministic=True)).hexdigest()
+
+        # every searched collection adds its version, a change to one of them
+        # only moves the keys of searches that include it
+        names = {x: collection_version_name(x) for x in grpc_request.collections}
+
+        if grpc_request.include_default_collection:
+            names[None] = collection_version_name()
 
-            if user is None and collection_db.visibility != "V":
-                logger.error(f"Search::rpc_load collection is not visible")
+        versions = cache_versions(names.values())
+        scope = "\n".join(f"{names[x]}={versions[names[x]]}" for x in names)
+        scope_hash = hashlib.sha256(scope.encode()).hexdigest()
+
+        return f"search:{shared_hash}:{scope_hash}"
+
+    def check_collection_access(self, collection_ids, user, owned_ids=None):
+        collection_ids = set(collection_ids)
+
+        if owned_ids is not None:
+            collection_ids -= set(owned_ids)
+
+        if not collection_ids:
+            return True
+
+        if user is not None and user.is_authenticated:
+            user_key = user.id
+            visible = Q(visibility="V") | Q(visibility="A") | Q(user=user)
+        else:
+            user_key = "anonymous"
+            visible = Q(visibility="V")
+
+        # ids of collections this user is known to have access to; every
+        # collection create, delete or visibility change starts a new version,
+        # the timeout bounds how long bulk updates without signals go unseen
+        version = cache_version("collection_access")
+        access_key = f"collection_access:{version}:{user_key}"
+        access_ids = cache.get(access_key, set())
+
+        missing_ids = collection_ids - access_ids
+
+        if missing_ids:
+            access_ids = access_ids | set(
+                Collection.objects.filter(visible, hash_id__in=missing_ids).values_list("hash_id", flat=True)
+            )
+            cache.set(access_key, access_ids, DjangoSettings.COLLECTION_ACCESS_TIMEOUT)
+
+        return collection_ids <= access_ids
+
+    def result_key(self, request_hash, fields):
+        return f"{request_hash}:{fields_key(fields)}"
+
+    def cached_result(self, key, raw=None):
+        # raw results are returned still encoded, see raw_format
+        if raw is None:
+            return search_cache.get(key)
+
+        if raw == "msgpack":
+            data = search_cache.get_packed(key)
+
+            if data is None:
                 return None
 
-            if user and collection_db.user != user and collection_db.visibility == "U":
-                logger.error(f"Search::rpc_load collection is from another user")
+            return {"packed": data}
+
+        body = search_cache.get_body(key, raw)
+
+        if body:
+            return {"body": body, "encoding": raw}
+
+        result = search_cache.get(key)
+
+        if body is None and result is not None:
+            self.schedule_bodies(key)
+
+        return result
+
+    def schedule_bodies(self, key):
+        # bodies are compressed by a task, only once a client can use them
+        if not cache.add(f"{key}:bodies", True, DjangoSettings.SEARCH_CACHE_BODY_TASK_TIMEOUT):
+            return
+
+        try:
+            cache_search_bodies.delay(key)
+        except Exception as e:
+            logger.error(f"Search::schedule_bodies {key} {e}")
+
+    def raw_format(self, request, params, user, renderer_format):
+        """
+        Cached results are sent as they are stored, as long as nothing is added
+        for the user and the whole result is requested: msgpack clients get
+        the packed result, json clients a precompressed body.
+        """
+
+        if user.is_authenticated or params.get("vectors"):
+            return None
+
+        if params.get("offset") or params.get("limit") is not None:
+            return None
+
+        if renderer_format == "msgpack":
+            return "msgpack"
+
+        if renderer_format == "json":
+            return preferred_encoding(request, body_encodings(DjangoSettings.SEARCH_CACHE_BODY_ENCODINGS))
+
+        return None
+
+    def prepare_search(self, params, ids=None, collection_ids=None, user=None):
+        with stage("parse"):
+            grpc_request = self.parse_search_request(
+                params,
+                ids=ids,
+                collection_ids=collection_ids,
+            )
+            grpc_request = self.canonicalize_search_request(grpc_request)
+            logger.info(f"Search::rpc_load parse_search_request:'{MessageToJson(grpc_request)}'")
+
+        with stage("acl"):
+            if not self.check_collection_access(grpc_request.collections, user, collection_ids):
+                logger.error(f"Search::rpc_load collection is not known or not visible")
                 return None
 
+        with stage("parse"):
+            return grpc_request, self.search_request_key(grpc_request)
 
-        grpc_request_bin = grpc_request.SerializeToString()
-        grpc_request_hash = hashlib.sha256(grpc_request_bin).hexdigest()
+    def claim_inflight(self, grpc_request_hash):
+        # identical searches running at the same time share one indexer job,
+        # the first caller starts it and publishes the job id for the others
+        return cache.add(f"inflight:{grpc_request_hash}", "", timeout=DjangoSettings.SEARCH_INFLIGHT_TIMEOUT)
 
-        response_cache = cache.get(grpc_request_hash)
+    def release_inflight(self, grpc_request_hash):
+        cache.delete(f"inflight:{grpc_request_hash}")
 
-        if response_cache is not None:
-            return msgpack.unpackb(response_cache)
+    def finish_inflight(self, job_id, grpc_request_hash):
+        # once the job is done later identical searches are answered from the
+        # cache, or start a job of their own if it failed
+        if grpc_request_hash is None:
+            return
+
+        key = f"inflight:{grpc_request_hash}"
+
+        if cache.get(key) == job_id:
+            cache.delete(key)
 
-        stub = indexer_pb2_grpc.IndexerStub(self.channel)
-        response = stub.search(grpc_request)
+    def get_inflight(self, grpc_request_hash):
+        # None: the first caller failed, "": the job is about to be started
+        return cache.get(f"inflight:{grpc_request_hash}")
+
+    def publish_job(self, job_id, grpc_request_hash):
         try:
-            cache.set(response.id, grpc_request_hash)
+            cache.set(job_id, grpc_request_hash)
+            cache.set(
+                f"inflight:{grpc_request_hash}",
+                job_id,
+                timeout=DjangoSettings.SEARCH_INFLIGHT_TIMEOUT,
+            )
         except Exception as e:
-            logger.error("Search::rpc_load cache set error {e}")
-            pass
-        return {"job_id": response.id}
+            logger.error(f"Search::rpc_load cache set error {e}")
 
-    def rpc_check_load(self, job_id, collections=None):
-        stub = indexer_pb2_grpc.IndexerStub(self.channel)
-        request = indexer_pb2.ListSearchResultRequest(id=job_id)
+    def rpc_load(self, params, ids=None, collection_ids=None, user=None, fields=DEFAULT_FIELDS, raw=None):
+        return self.run_flow(self.load_flow(params, ids, collection_ids, user, fields, raw))
+
+    def load_flow(self, params, ids=None, collection_ids=None, user=None, fields=DEFAULT_FIELDS, raw=None):
+        prepared = self.prepare_search(params, ids, collection_ids, user)
+
+        if prepared is None:
+            return None
+
+        grpc_request, grpc_request_hash = prepared
+        self.logged_request = prepared
+
+        with stage("cache"):
+            response_cache = self.cached_result(self.result_key(grpc_request_hash, fields), raw)
+            mark_cache(response_cache is not None)
+
+        if response_cache is not None:
+            return response_cache
+
+        if not self.claim_inflight(grpc_request_hash):
+            job_id = yield from self.inflight_flow(grpc_request_hash)
+
+            if job_id:
+                return {"job_id": job_id}
+
+        slots = self.admit(grpc_request, grpc_request_hash, self.client)
+        job_id = yield from self.start_job_flow(grpc_request, grpc_request_hash, slots)
+
+        return {"job_id": job_id}
+
+    def start_job_flow(self, grpc_request, grpc_request_hash, slots):
+        call = IndexerCall("search", grpc_request)
 
         try:
-            response = stub.list_search_result(request)
+            response = yield call
+        except Exception:
+            self.admission.release(slots)
+            self.release_inflight(grpc_request_hash)
+            raise
+
+        self.admission.bind_job(response.id, slots)
+        self.indexer.bind_job(response.id, call.endpoint)
+        self.publish_job(response.id, grpc_request_hash)
+
+        return response.id
+
+    def client_key(self, request, user):
+        if user.is_authenticated:
+            return f"user:{user.id}"
+
+        return f"addr:{BaseThrottle().get_ident(request)}"
+
+    def admit(self, grpc_request, grpc_request_hash, client):
+        """
+        Takes admission capacity for a new indexer job. Expensive jobs are
+        rejected with a retry-after while the indexer or the client is at
+        capacity.
+        """
+
+        with stage("admission"):
+            slots = self.admission.acquire(grpc_request, client)
+
+        if slots is None:
+            self.release_inflight(grpc_request_hash)
+            raise Throttled(wait=self.admission.retry_after)
+
+        return slots
+
+    def log_query(self, prepared, fields=DEFAULT_FIELDS):
+        if prepared is None or not DjangoSettings.QUERY_LOG:
+            return
+
+        grpc_request, grpc_request_hash = prepared
+        latency, cache_outcome = request_timing()
+        request = grpc_request.SerializeToString(deterministic=True)
+
+        if len(request) > DjangoSettings.QUERY_LOG_MAX_REQUEST_BYTES:
+            request = None
+
+        # written in bulk by the query log, not by the request
+        query_log.add(
+            request_hash=grpc_request_hash,
+            fields=fields_key(fields),
+            request=request,
+            latency=latency or 0.0,
+            cache=cache_outcome,
+        )
 
-            if collections is not None:
-                collection_ids = [c["hash_id"] for c in collections]
-            else:
-                collection_ids = []
-
-            entries = []
-
-            for e in response.entries:
-                entry = {
-                    "id": e.id,
-                    "meta": meta_from_proto(e.meta),
-                    "origin": meta_from_proto(e.origin),
-                    "classifier": classifier_from_proto(e.classifier),
-                    "feature": feature_from_proto(e.feature),
-                    "coordinates": list(e.coordinates),
-                    "distance": e.distance,
-                    "cluster": e.cluster,
-                    "padded": e.padded,
-                }
+    def warm(self, grpc_request, fields=DEFAULT_FIELDS, timeout=None):
+        """
+        Keeps the result of a logged search cached. A result stored less than
+        SEARCH_WARM_MAX_AGE seconds ago only gets a new timeout, otherwise the
+        search runs again. Returns True if the result is cached afterwards.
+        """
 
-                entry["collection"] = {
-                    "id": e.collection.id,
-                    "name": e.collection.name,
-                    "is_public": e.collection.is_public,
-                    "user": e.collection.id in collection_ids,
-                }
+        if timeout is None:
+            timeout = DjangoSettings.SEARCH_WAIT_TIMEOUT
 
-                if e.collection.id in collection_ids:
-                    entry["path"] = upload_url_to_image(e.id)
-                    entry["preview"] = upload_url_to_image(e.id)
-                else:
-                    entry["path"] = media_url_to_image(e.id)
-                    entry["preview"] = media_url_to_preview(e.id)
+        return self.run_flow(self.warm_flow(grpc_request, fields, timeout))
 
-                entries.append(entry)
+    def warm_flow(self, grpc_request, fields, timeout):
+        grpc_request_hash = self.search_request_key(grpc_request)
+        key = self.result_key(grpc_request_hash, fields)
 
-            aggregations = []
+        age = search_cache.age(key)
 
-            for e in response.aggregate:
-                aggr = {
-                    "field": e.field_name,
-                    "entries": [],
-                }
+        if age is not None and age < DjangoSettings.SEARCH_WARM_MAX_AGE:
+            if search_cache.touch(key, body_encodings(DjangoSettings.SEARCH_CACHE_BODY_ENCODINGS)):
+                return True
 
-                for x in e.entries:
-                    aggr["entries"].append(
-                        {
-                            "name": x.key,
-                            "count": x.int_val,
-                        }
-                    )
+        if not self.claim_inflight(grpc_request_hash):
+            # the search is running right now
+            return False
 
-                aggregations.append(aggr)
+        # warming gives way to user searches
+        slots = self.admission.acquire(grpc_request, "warm")
 
-            if collections:
-                aggregations.append(
+        if slots is None:
+            self.release_inflight(grpc_request_hash)
+            return False
+
+        job_id = yield from self.start_job_flow(grpc_request, grpc_request_hash, slots)
+
+        # the stale result stays cached for other searches until it is replaced
+        result = yield from self.wait_flow(job_id, fields, timeout, refresh=True)
+
+        return result is not None and not result.get("job_id")
+
+    def inflight_flow(self, grpc_request_hash):
+        deadline = time.monotonic() + DjangoSettings.SEARCH_INFLIGHT_WAIT
+
+        while True:
+            job_id = self.get_inflight(grpc_request_hash)
+
+            if job_id is None or job_id:
+                return job_id
+
+            if time.monotonic() > deadline:
+                return None
+
+            yield Sleep(DjangoSettings.SEARCH_WAIT_MIN_INTERVAL)
+
+    def cached_job_result(self, job_id, fields=DEFAULT_FIELDS, raw=None):
+        with stage("cache"):
+            request_hash = cache.get(job_id)
+
+            if request_hash is None:
+                mark_cache(False)
+                return None, None
+
+            # later pages of a finished job are served from the cache
+            result = self.cached_result(self.result_key(request_hash, fields), raw)
+            mark_cache(result is not None)
+
+        return request_hash, result
+
+    def result_from_proto(self, response, fields=DEFAULT_FIELDS):
+        if fields == COLUMNS:
+            return self.columns_from_proto(response)
+
+        templates = URL_TEMPLATES in fields
+
+        if templates:
+            fields = tuple(x for x in fields if x != URL_TEMPLATES)
+
+        entries = []
+
+        for e in response.entries:
+            entry = {
+                "id": e.id,
+                **entry_fields_from_proto(e, fields),
+                "coordinates": list(e.coordinates),
+                "distance": e.distance,
+                "cluster": e.cluster,
+                "padded": e.padded,
+            }
+
+            entry["collection"] = {
+                "id": e.collection.id,
+                "name": e.collection.name,
+                "is_public": e.collection.is_public,
+                "user": False,
+            }
+
+            if not templates:
+                entry["path"] = media_url_to_image(e.id)
+                entry["preview"] = media_url_to_preview(e.id)
+
+            entries.append(entry)
+
+        # stored with the fields of the unpaged response, so that it can be
+        # sent from the cache as it is
+        result = {
+            "entries": entries,
+            "aggregations": self.aggregations_from_proto(response),
+            "offset": 0,
+            "limit": None,
+            "total": len(entries),
+        }
+
+        if templates:
+            # clients build path and preview from the id and collection.user
+            result["url_templates"] = url_templates()
+
+        return result
+
+    def columns_from_proto(self, response):
+        """
+        Parallel arrays of the values map and cluster views need for every
+        point. Metadata of single points is loaded with get or get_many.
+        """
+
+        entries = response.entries
+        count = len(entries)
+
+        coordinates = np.fromiter(
+            itertools.chain.from_iterable(e.coordinates for e in entries),
+            dtype=np.float32,
+        )
+
+        if coordinates.size == 2 * count:
+            coordinates = coordinates.reshape(count, 2)
+            x, y = coordinates[:, 0].tolist(), coordinates[:, 1].tolist()
+        else:
+            # not every entry is mapped to 2d, missing values become null
+            coordinates = np.full((count, 2), np.nan, dtype=np.float32)
+
+            for i, e in enumerate(entries):
+                values = e.coordinates[:2]
+                coordinates[i, : len(values)] = values
+
+            x, y = ([None if np.isnan(v) else v for v in c] for c in coordinates.T.tolist())
+
+        return {
+            "columns": {
+                "id": [e.id for e in entries],
+                "x": x,
+                "y": y,
+                "cluster": np.fromiter((e.cluster for e in entries), dtype=np.int32, count=count).tolist(),
+                "distance": np.fromiter((e.distance for e in entries), dtype=np.float32, count=count).tolist(),
+                "padded": np.fromiter((e.padded for e in entries), dtype=bool, count=count).tolist(),
+                "collection": [e.collection.id for e in entries],
+            },
+            "aggregations": self.aggregations_from_proto(response),
+            "offset": 0,
+            "limit": None,
+            "total": count,
+        }
+
+    def aggregations_from_proto(self, response):
+        aggregations = []
+
+        for e in response.aggregate:
+            aggr = {
+                "field": e.field_name,
+                "entries": [],
+            }
+
+            for x in e.entries:
+                aggr["entries"].append(
                     {
-                        "field": "collection",
-                        "entries": collections,
+                        "name": x.key,
+                        "count": x.int_val,
                     }
                 )
 
-            result = {
-                "entries": entries,
-                "aggregations": aggregations,
-            }
+            aggregations.append(aggr)
 
-            request_hash = cache.get(job_id)
+        return aggregations
+
+    def rpc_check_load(self, job_id, fields=DEFAULT_FIELDS, raw=None):
+        return self.run_flow(self.check_flow(job_id, fields, raw))
+
+    def check_flow(self, job_id, fields=DEFAULT_FIELDS, raw=None, refresh=False):
+        if refresh:
+            # the cached result is about to be replaced by the one of the job
+            request_hash, response_cache = cache.get(job_id), None
+        else:
+            request_hash, response_cache = self.cached_job_result(job_id, fields, raw)
+
+        if response_cache is not None:
+            self.admission.release_job(job_id)
+            return response_cache
+
+        request = indexer_pb2.ListSearchResultRequest(id=job_id)
+
+        try:
+            response = yield IndexerCall("list_search_result", request, job_id=job_id)
+
+            # the job is done, its capacity is free for the next one
+            self.admission.release_job(job_id)
+
+            with stage("convert"):
+                result = yield Offload(self.result_from_proto, response, fields)
 
             if request_hash is not None:
-                cache_data = msgpack.packb(result)
-                cache.set(request_hash, msgpack.packb(result))
+                key = self.result_key(request_hash, fields)
+
+                with stage("cache"):
+                    search_cache.set(key, result)
+                    search_cache.stamp(key)
+                    self.finish_inflight(job_id, request_hash)
 
             return result
+        except CircuitOpenError:
+            self.finish_inflight(job_id, request_hash)
+            # answered with a 503 by the exception handler
+            raise
         except grpc.RpcError as error:
             if error.code() == grpc.StatusCode.FAILED_PRECONDITION:
                 return {"job_id": job_id}
@@ -371,66 +865,256 @@ class Search(RPCView):
         except Exception as e:
             logger.exception(f"Search::rpc_check_load exception:'{e}'")
 
+        self.finish_inflight(job_id, request_hash)
+
         return None
 
+    def wait_for_result(self, job_id, fields=DEFAULT_FIELDS, timeout=None, raw=None):
+        if timeout is None:
+            timeout = DjangoSettings.SEARCH_SYNC_WAIT_TIMEOUT
+
+        return self.run_flow(self.wait_flow(job_id, fields, timeout, raw))
+
+    def wait_flow(self, job_id, fields, timeout, raw=None, refresh=False):
+        deadline = time.monotonic() + timeout
+        interval = DjangoSettings.SEARCH_WAIT_MIN_INTERVAL
+
+        while True:
+            result = yield from self.check_flow(job_id, fields, raw, refresh)
+
+            if result is None or not result.get("job_id"):
+                return result
+
+            remaining = deadline - time.monotonic()
+
+            if remaining <= 0:
+                return result
+
+            yield Sleep(min(interval, remaining))
+
+            interval = min(interval * 2, DjangoSettings.SEARCH_WAIT_MAX_INTERVAL)
+
+    def paginate_result(self, result, params):
+        if "columns" in result:
+            total = len(result["columns"]["id"])
+        else:
+            total = len(result["entries"])
+
+        try:
+            offset = max(int(params.get("offset", 0)), 0)
+            limit = params.get("limit")
+
+            if limit is not None:
+                limit = max(int(limit), 0)
+        except (TypeError, ValueError):
+            raise APIException("invalid_pagination")
+
+        if offset == 0 and limit is None:
+            return {**result, "offset": 0, "limit": None, "total": total}
+
+        end = total if limit is None else offset + limit
+
+        if "columns" in result:
+            return {
+                **result,
+                "columns": {k: v[offset:end] for k, v in result["columns"].items()},
+                "offset": offset,
+                "limit": limit,
+                "total": total,
+            }
+
+        return {
+            **result,
+            "entries": result["entries"][offset:end],
+            "offset": offset,
+            "limit": limit,
+            "total": total,
+        }
+
+    def pack_result_vectors(self, result, params):
+        dtype = params.get("vectors")
+
+        if dtype not in VECTOR_DTYPES:
+            raise APIException("unknown_vector_dtype")
+
+        if "columns" in result:
+            # the numeric columns are sent as binary buffers instead of lists
+            columns = dict(result["columns"])
+
+            for name in ("x", "y", "distance"):
+                columns[name] = encode_buffer(columns[name], dtype=dtype)
+
+            return {**result, "columns": columns}
+
+        entries, vectors = pack_vectors(result["entries"], dtype=dtype)
+
+        return {**result, "entries": entries, "vectors": vectors}
+
+    def add_collection_data(self, result, collections):
+        # cached results are shared between users, the user's own collections
+        # are only marked on the way out
+        if not collections:
+            return result
+
+        if "columns" in result:
+            return {
+                **result,
+                "aggregations": [*result["aggregations"], {"field": "collection", "entries": collections}],
+            }
+
+        collection_ids = set(c["hash_id"] for c in collections)
+
+        def map_data(entry):
+            if entry["collection"]["id"] not in collection_ids:
+                return entry
+
+            if "url_templates" in result:
+                return {**entry, "collection": {**entry["collection"], "user": True}}
+
+            return {
+                **entry,
+                "collection": {**entry["collection"], "user": True},
+                "path": upload_url_to_image(entry["id"]),
+                "preview": upload_url_to_image(entry["id"]),
+            }
+
+        return {
+            **result,
+            "entries": list(map(map_data, result["entries"])),
+            "aggregations": [
+                *result["aggregations"],
+                {
+                    "field": "collection",
+                    "entries": collections,
+                },
+            ],
+        }
+
     def add_user_data(self, result, user):
         images = ImageUserRelation.objects.filter(
             image__hash_id__in=[x["id"] for x in result["entries"]],
             user=user,
-        )
-        user_lut = {x.image.hash_id: {"bookmarked": x.library} for x in images}
+        ).values_list("image__hash_id", "library")
+        user_lut = {hash_id: {"bookmarked": library} for hash_id, library in images}
 
         def map_data(entry):
             return {**entry, "user": user_lut.get(entry["id"], {"bookmarked": False})}
 
-        result["entries"] = list(map(map_data, result["entries"]))
+        # result may be shared with the in-process cache and must not be modified
+        return {**result, "entries": list(map(map_data, result["entries"]))}
 
-        return result
-
-    def post(self, request, format=None):
-        params = request.data["params"]
-        collections = None
+    def user_collections(self, user):
+        if not user.is_authenticated:
+            return None
 
-        if request.user.is_authenticated:
-            collections = [
+        with stage("acl"):
+            return [
                 {
-                    "hash_id": collection.hash_id,
-                    "name": collection.name,
-                    "count": collection.count,
+                    "hash_id": collection["hash_id"],
+                    "name": collection["name"],
+                    "count": collection["image_count"],
                 }
-                for collection in Collection.objects.filter(user=request.user).annotate(count=Count("image"))
+                for collection in Collection.objects.filter(user=user).values("hash_id", "name", "image_count")
             ]
 
+    def bookmark_ids(self, user):
+        if not user.is_authenticated:
+            raise APIException("not_authenticated")
+
+        with stage("acl"):
+            return list(
+                ImageUserRelation.objects.filter(
+                    user=user,
+                    library=True,
+                ).values_list("image__hash_id", flat=True)
+            )
+
+    def finish_result(self, result, params, collections, user):
+        if result is None:
+            raise APIException("unknown_error")
+
+        if "packed" in result:
+            return PackedResult(result["packed"])
+
+        if "body" in result:
+            return EncodedBody(result["body"], result["encoding"])
+
+        if "entries" in result or "columns" in result:
+            with stage("shape"):
+                result = self.paginate_result(result, params)
+
+                if params.get("vectors"):
+                    result = self.pack_result_vectors(result, params)
+
+            with stage("annotate"):
+                result = self.add_collection_data(result, collections)
+
+                # bookmarks are part of the entry metadata, columns leave them to get_many
+                if result.get("entries") and user.is_authenticated:
+                    result = self.add_user_data(result, user)
+
+        return result
+
+    def search_flow(self, request, params, user, renderer_format, wait_timeout):
+        """
+        Answers one search request; shared by the sync and the async view.
+        """
+
+        with stage("parse"):
+            fields = parse_format(params)
+
+        collections = self.user_collections(user)
+        self.client = self.client_key(request, user)
+        raw = self.raw_format(request, params, user, renderer_format)
+
         if params.get("job_id"):
-            result = self.rpc_check_load(params["job_id"], collections)
+            if params.get("wait", False):
+                result = yield from self.wait_flow(params["job_id"], fields, wait_timeout, raw)
+            else:
+                result = yield from self.check_flow(params["job_id"], fields, raw)
+        else:
+            image_ids = None
+            collection_ids = None
 
-            if result is None:
-                raise APIException("unknown_error")
+            if params.get("bookmarks", False):
+                image_ids = self.bookmark_ids(user)
 
-            if result.get("entries") and request.user.is_authenticated:
-                result = self.add_user_data(result, request.user)
+            if collections:
+                collection_ids = [c["hash_id"] for c in collections]
 
-            return Response(result)
+            result = yield from self.load_flow(params, image_ids, collection_ids, user, fields, raw)
 
-        image_ids = None
-        collection_ids = None
+            if result is not None and result.get("job_id") and params.get("wait", False):
+                result = yield from self.wait_flow(result["job_id"], fields, wait_timeout, raw)
 
-        if params.get("bookmarks", False):
-            if not request.user.is_authenticated:
-                raise APIException("not_authenticated")
+        result = self.finish_result(result, params, collections, user)
+        self.log_query(self.logged_request, fields)
+
+        return result
 
-            image_user_db = ImageUserRelation.objects.filter(
-                user=request.user,
-                library=True,
+    def post(self, request, format=None):
+        with stage("parse"):
+            params = request.data["params"]
+
+        result = self.run_flow(
+            self.search_flow(
+                request,
+                params,
+                request.user,
+                request.accepted_renderer.format,
+                DjangoSettings.SEARCH_SYNC_WAIT_TIMEOUT,
             )
-            image_ids = [x.image.hash_id for x in image_user_db]
+        )
 
-        if collections:
-            collection_ids = [c["hash_id"] for c in collections]
+        if isinstance(result, EncodedBody):
+            return encoded_response(result)
 
-        result = self.rpc_load(params, image_ids, collection_ids, request.user)
+        return Response(result)
 
-        if result is None:
-            raise APIException("unknown_error")
 
-        return Response(result)
+class SearchCacheStats(APIView):
+    def get(self, request, format=None):
+        if not request.user.is_authenticated or not request.user.is_staff:
+            raise APIException("not_authenticated")
+
+        return Response(search_cache.stats())
@@ -1,26 +1,183 @@
-import grpc
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
 
 from django.conf import settings
 from rest_framework.views import APIView
-from backend.utils import RetryOnRpcErrorClientInterceptor, ExponentialBackoff
+from rest_framework.response import Response
+from rest_framework.exceptions import APIException
+from backend.utils import indexer_pool, timed, stage
+
+if settings.INDEXER_PATH is not None:
+    sys.path.append(settings.INDEXER_PATH)
+
+from iart_indexer.utils import (
+    meta_from_proto,
+    classifier_from_proto,
+    feature_from_proto,
+)
+
+
+ENTRY_FIELDS = {
+    "meta": lambda e: meta_from_proto(e.meta),
+    "origin": lambda e: meta_from_proto(e.origin),
+    "classifier": lambda e: classifier_from_proto(e.classifier),
+    "feature": lambda e: feature_from_proto(e.feature),
+}
+
+DEFAULT_FIELDS = tuple(sorted(ENTRY_FIELDS))
+
+
+def parse_fields(params):
+    fields = params.get("fields")
+
+    if fields is None:
+        return DEFAULT_FIELDS
+
+    if isinstance(fields, str):
+        fields = [fields]
+
+    if not isinstance(fields, (list, tuple)) or any(x not in ENTRY_FIELDS for x in fields):
+        raise APIException("unknown_fields")
+
+    return tuple(sorted(set(fields)))
+
+
+def fields_key(fields):
+    return "+".join(fields)
+
+
+def entry_fields_from_proto(entry, fields):
+    return {field: ENTRY_FIELDS[field](entry) for field in fields}
+
+
+class IndexerCall:
+    """
+    Indexer call requested by a view flow. Flows are generators that hold the
+    logic shared by the sync and async views: they yield the steps that
+    block and get the result, or the raised error, sent back. The endpoint
+    that served the call is set on it.
+    """
+
+    def __init__(self, method, request, job_id=None):
+        self.method = method
+        self.request = request
+        self.job_id = job_id
+        self.endpoint = None
+
+
+class Gather:
+    """
+    Independent indexer calls that may run in parallel, at most limit at a
+    time. The flow gets a list with the reply or the raised error of each.
+    """
+
+    def __init__(self, calls, limit):
+        self.calls = calls
+        self.limit = limit
+
+
+class Sleep:
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+
+class Offload:
+    """
+    CPU bound work that must not block the event loop of async views.
+    """
+
+    def __init__(self, fn, *args):
+        self.fn = fn
+        self.args = args
+
+
+def advance(flow, value=None, error=None):
+    """
+    Resumes flow with the result or error of its last step. Returns (False,
+    next step) or (True, return value of the flow).
+    """
+
+    try:
+        if error is not None:
+            return False, flow.throw(error)
+
+        return False, flow.send(value)
+    except StopIteration as stop:
+        return True, stop.value
 
 
 class RPCView(APIView):
-    interceptors = (
-        RetryOnRpcErrorClientInterceptor(
-            max_attempts=4,
-            sleeping_policy=ExponentialBackoff(init_backoff_ms=100, max_backoff_ms=1600, multiplier=2),
-            status_for_retry=(grpc.StatusCode.UNAVAILABLE,),
-        ),
-    )
-
-    channel = grpc.intercept_channel(
-        grpc.insecure_channel(
-            f"{settings.GRPC_HOST}:{settings.GRPC_PORT}",
-            options=[
-                ("grpc.max_send_message_length", 50 * 1024 * 1024),
-                ("grpc.max_receive_message_length", 50 * 1024 * 1024),
-            ],
-        ),
-        *interceptors,
-    )
+    indexer = indexer_pool
+    # view label of the latency metrics
+    metrics_name = None
+
+    def dispatch(self, request, *args, **kwargs):
+        with timed(self.metrics_name or type(self).__name__.lower()):
+            return super().dispatch(request, *args, **kwargs)
+
+    def run_flow(self, flow):
+        value, error = None, None
+
+        while True:
+            done, step = advance(flow, value, error)
+
+            if done:
+                return step
+
+            value, error = None, None
+
+            try:
+                value = self.run_step(step)
+            except Exception as e:
+                error = e
+
+    def run_step(self, step):
+        if isinstance(step, IndexerCall):
+            with stage("grpc"):
+                return self.call_indexer(step)
+
+        if isinstance(step, Gather):
+            if len(step.calls) == 1:
+                with stage("grpc"):
+                    return [self.try_call_indexer(step.calls[0])]
+
+            # the worker threads don't see the request's stage timer, the
+            # fan-out is timed as a whole
+            with stage("grpc"), ThreadPoolExecutor(max_workers=min(len(step.calls), step.limit)) as executor:
+                return list(executor.map(self.try_call_indexer, step.calls))
+
+        if isinstance(step, Sleep):
+            with stage("wait"):
+                time.sleep(step.seconds)
+
+            return None
+
+        if isinstance(step, Offload):
+            return step.fn(*step.args)
+
+        raise ValueError(f"Unknown flow step {step}")
+
+    def call_indexer(self, call):
+        with self.indexer.endpoint(job_id=call.job_id) as endpoint:
+            call.endpoint = endpoint
+
+            return getattr(endpoint.stub, call.method)(call.request)
+
+    def try_call_indexer(self, call):
+        try:
+            return self.call_indexer(call)
+        except Exception as e:
+            return e
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+
+        # rendering would otherwise happen after the view has returned, plain
+        # http responses are already rendered
+        if isinstance(response, Response):
+            with stage("render"):
+                response.render()
+
+        return response
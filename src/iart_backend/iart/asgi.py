@@ -0,0 +1,34 @@
+"""
+ASGI config for iart project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
+"""
+
+import os
+
+import django
+from django.core.handlers.asgi import ASGIHandler, ASGIRequest
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'iart.settings')
+
+
+class Request(ASGIRequest):
+    # with FORCE_SCRIPT_NAME = "/" the script prefix is stripped including the
+    # leading slash of the path, which the wsgi handler keeps
+    def __init__(self, scope, body_file):
+        super().__init__(scope, body_file)
+
+        if not self.path_info.startswith("/"):
+            self.path_info = "/" + self.path_info
+            self.META["PATH_INFO"] = self.path_info
+
+
+class Handler(ASGIHandler):
+    request_class = Request
+
+
+django.setup(set_prefix=False)
+application = Handler()
@@ -61,6 +61,11 @@ INSTALLED_APPS = [
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": ("rest_framework.authentication.SessionAuthentication",),
     "EXCEPTION_HANDLER": "backend.exceptions.utils.custom_exception_handler",
+    "DEFAULT_RENDERER_CLASSES": (
+        "backend.renderers.ORJSONRenderer",
+        "backend.renderers.MsgpackRenderer",
+        "rest_framework.renderers.BrowsableAPIRenderer",
+    ),
 }
 
 MIDDLEWARE = [
@@ -103,6 +108,50 @@ CACHES = {
     }
 }
 
+# in-process LRU in front of the search result cache (per worker); the size is
+# estimated from the msgpack size of the results, see ResultCache.OBJECT_FACTOR
+SEARCH_CACHE_LOCAL_SIZE = 128 * 1024 * 1024
+SEARCH_CACHE_LOCAL_TIMEOUT = 60 * 60
+SEARCH_CACHE_COMPRESSION_LEVEL = 3
+
+# content encodings in which rendered search responses are kept for anonymous
+# cache hits; they are compressed by a task scheduled on the first such hit,
+# at most once per task timeout, and results whose uncompressed body is above
+# the size limit are not compressed at all
+SEARCH_CACHE_BODY_ENCODINGS = ["br", "gzip"]
+SEARCH_CACHE_BODY_MAX_BYTES = 1024 * 1024
+SEARCH_CACHE_BODY_TASK_TIMEOUT = 60
+
+# query terms of image-by-example searches are cached per worker and in the
+# shared cache; uploaded query images are shrunk to QUERY_IMAGE_MAX_DIM pixels
+# on their long side before they are sent (None sends them as stored)
+QUERY_IMAGE_CACHE_SIZE = 64 * 1024 * 1024
+QUERY_IMAGE_CACHE_TIMEOUT = 60 * 60
+QUERY_IMAGE_MAX_DIM = 512
+
+# per worker cache of converted image entries returned by get and get_many;
+# invalidations only reach other workers once their local copy times out
+ENTRY_CACHE_LOCAL_SIZE = 32 * 1024 * 1024
+ENTRY_CACHE_LOCAL_TIMEOUT = 60
+
+# versions of the collections and of the collection access, which are part of
+# the search cache keys, are kept per process for CACHE_VERSION_LOCAL_TIMEOUT
+# seconds; invalidations of other processes take effect after at most that
+CACHE_VERSION_LOCAL_SIZE = 10000
+CACHE_VERSION_LOCAL_TIMEOUT = 2
+
+# collections a user may search are cached per user; saves and deletes of a
+# collection drop them (other processes follow within CACHE_VERSION_LOCAL_TIMEOUT
+# seconds), changes that skip the model signals (queryset.update, raw sql) at
+# the latest after COLLECTION_ACCESS_TIMEOUT seconds unless the call site runs
+# invalidate_collection_access
+COLLECTION_ACCESS_TIMEOUT = 60
+
+# get_many resolves at most GET_MANY_MAX_IDS ids with GET_MANY_WORKERS parallel
+# indexer calls
+GET_MANY_MAX_IDS = 250
+GET_MANY_WORKERS = 8
+
 # Database
 # https://docs.djangoproject.com/en/2.1/ref/settings/#databases
 
@@ -211,6 +260,110 @@ UPLOAD_URL = FORCE_SCRIPT_NAME + "upload/"
 GRPC_HOST = "localhost"
 GRPC_PORT = 50051
 
+# indexer replicas as "host:port", GRPC_HOST:GRPC_PORT is used if empty;
+# requests are balanced by "least_outstanding" requests or "round_robin"
+GRPC_ENDPOINTS = []
+GRPC_BALANCING = "least_outstanding"
+
+# replicas that fail a health probe are ejected until a probe succeeds again,
+# probes run every GRPC_PROBE_INTERVAL seconds
+GRPC_PROBE_INTERVAL = 5.0
+GRPC_PROBE_TIMEOUT = 1.0
+
+# deadline in seconds per indexer method, "default" applies to all others;
+# the streaming indexing call has no deadline
+GRPC_DEADLINES = {
+    "default": 30,
+    "search": 10,
+    "list_search_result": 30,
+    "get": 5,
+    "collection_delete": 60,
+}
+
+# the circuit of a replica opens after GRPC_CIRCUIT_FAILURES consecutive
+# connection errors or timeouts; calls fail fast until a trial call after
+# GRPC_CIRCUIT_RESET seconds succeeds
+GRPC_CIRCUIT_FAILURES = 5
+GRPC_CIRCUIT_RESET = 10.0
+
+# retries per process are limited to GRPC_RETRY_BUDGET_RATIO of all calls plus
+# GRPC_RETRY_BUDGET_MIN retries per second
+GRPC_RETRY_BUDGET_RATIO = 0.1
+GRPC_RETRY_BUDGET_MIN = 2
+
+# long-poll search requests (params.wait) are held until the indexer job is
+# done or the timeout is reached. A sync worker is blocked while it waits, so
+# sync views hold a request for at most SEARCH_SYNC_WAIT_TIMEOUT seconds, well
+# below the gunicorn worker timeout (30s by default). Async views (ASYNC_VIEWS)
+# do not block a worker and wait up to SEARCH_WAIT_TIMEOUT seconds
+SEARCH_WAIT_TIMEOUT = 20
+SEARCH_SYNC_WAIT_TIMEOUT = 3
+SEARCH_WAIT_MIN_INTERVAL = 0.05
+SEARCH_WAIT_MAX_INTERVAL = 1.0
+
+# identical concurrent searches are coalesced into one indexer job; followers
+# wait up to SEARCH_INFLIGHT_WAIT seconds for the first caller's job id
+SEARCH_INFLIGHT_TIMEOUT = 60
+SEARCH_INFLIGHT_WAIT = 2.0
+
+# search jobs are weighted by their estimated indexer cost: SEARCH_COSTS
+# "search" for every job plus "umap" for a umap mapping, "grid" for a grid
+# layout on top and "cluster" per requested cluster. Jobs from
+# SEARCH_ADMISSION_MIN_COST on only start while the cost in flight stays
+# within SEARCH_ADMISSION_CAPACITY overall and SEARCH_ADMISSION_CLIENT_CAPACITY
+# per user (or address for anonymous users); other clients are told to retry
+# after SEARCH_ADMISSION_RETRY seconds. Every job holds its cost for at most
+# SEARCH_ADMISSION_TIMEOUT seconds after it started, so capacity of jobs whose
+# result is never fetched is freed after that.
+SEARCH_COSTS = {"search": 1, "umap": 4, "grid": 2, "cluster": 0.25}
+SEARCH_ADMISSION_MIN_COST = 2
+SEARCH_ADMISSION_CAPACITY = 32
+SEARCH_ADMISSION_CLIENT_CAPACITY = 8
+SEARCH_ADMISSION_TIMEOUT = 120
+SEARCH_ADMISSION_RETRY = 5
+
+# searches are logged for QUERY_LOG_MAX_AGE seconds with at most
+# QUERY_LOG_MAX_ROWS rows; requests above QUERY_LOG_MAX_REQUEST_BYTES (e.g.
+# image queries) are logged without the request itself; every process writes
+# its log in one insert per QUERY_LOG_BUFFER_SIZE searches or
+# QUERY_LOG_BUFFER_AGE seconds
+QUERY_LOG = True
+QUERY_LOG_MAX_AGE = 7 * 24 * 60 * 60
+QUERY_LOG_MAX_ROWS = 100000
+QUERY_LOG_MAX_REQUEST_BYTES = 64 * 1024
+QUERY_LOG_BUFFER_SIZE = 100
+QUERY_LOG_BUFFER_AGE = 10.0
+
+# celery beat keeps the SEARCH_WARM_TOP most frequent searches of the last
+# SEARCH_WARM_WINDOW seconds cached: results stored less than
+# SEARCH_WARM_MAX_AGE seconds ago get a new timeout, older and expired ones are
+# searched again; keep the interval below the cache TIMEOUT
+SEARCH_WARM_TOP = 100
+SEARCH_WARM_WINDOW = 24 * 60 * 60
+SEARCH_WARM_INTERVAL = 60 * 60
+SEARCH_WARM_TIMEOUT = 120
+SEARCH_WARM_MAX_AGE = 6 * 60 * 60
+
+CELERY_BEAT_SCHEDULE = {
+    "warm_search_cache": {
+        "task": "backend.tasks.warm_search_cache",
+        "schedule": SEARCH_WARM_INTERVAL,
+    },
+    "prune_query_log": {
+        "task": "backend.tasks.prune_query_log",
+        "schedule": 60 * 60,
+    },
+}
+
+# serve search, get, get_many and remove_collection from async views; requires
+# running under asgi (iart.asgi), e.g. gunicorn with uvicorn workers
+ASYNC_VIEWS = False
+
+# /metrics is served to staff users and to scrapers that send
+# "Authorization: Bearer <METRICS_TOKEN>"; celery workers report their task
+# timings through the PROMETHEUS_MULTIPROC_DIR they share with the web workers
+METRICS_TOKEN = None
+
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 INDEXER_PATH = "/indexer"
@@ -237,6 +390,19 @@ config_lut = {
     "upload_url": "UPLOAD_URL",
     "grpc_host": "GRPC_HOST",
     "grpc_port": "GRPC_PORT",
+    "grpc_endpoints": "GRPC_ENDPOINTS",
+    "grpc_balancing": "GRPC_BALANCING",
+    "grpc_deadlines": "GRPC_DEADLINES",
+    "search_wait_timeout": "SEARCH_WAIT_TIMEOUT",
+    "search_sync_wait_timeout": "SEARCH_SYNC_WAIT_TIMEOUT",
+    "search_cache_local_size": "SEARCH_CACHE_LOCAL_SIZE",
+    "async_views": "ASYNC_VIEWS",
+    "metrics_token": "METRICS_TOKEN",
+    "query_log": "QUERY_LOG",
+    "search_warm_top": "SEARCH_WARM_TOP",
+    "search_costs": "SEARCH_COSTS",
+    "search_admission_capacity": "SEARCH_ADMISSION_CAPACITY",
+    "search_admission_client_capacity": "SEARCH_ADMISSION_CLIENT_CAPACITY",
     "image_resolutions": "IMAGE_RESOLUTIONS",
     "image_ext": "IMAGE_EXT",
     "oidc_rp_client_secret": "OIDC_RP_CLIENT_SECRET",